@@ -6,8 +6,19 @@ print("起動中...")
 import openai
 openai.api_key="PUT YOUR API KEY HERE"
 import os
+import sys
 import datetime
 import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from llm_cache import LLMCache, cached_completion
+
+llm_cache = None  # travelogue.py / routeonly.py と共有するプロンプト単位の応答キャッシュ（最初に問い合わせるときに開く）
+
+def cached_chat(**kwargs):
+    """同じ内容のリクエストはAPIを呼ばずにキャッシュから応答本文を返す"""
+    global llm_cache
+    if llm_cache is None: llm_cache = LLMCache()
+    return cached_completion(llm_cache, openai.chat.completions.create, **kwargs)
 
 def zenkaku_to_hankaku(text):
     # 全角数字のUnicodeコードポイント
@@ -54,14 +65,12 @@ messages.append({"role": "user", "content": json.dumps(json_load, ensure_ascii=F
 messages.append({"role": "user", "content": """以下にその例を示します． 元のデータ： {       "time": "10:50 11:00",       "place": "移動（車）",       "description": "_"     },     {       "time": "11:00 13:10",       "place": "ふぐ館　魚平",       "description": "_"     },     {       "time": "xx:xx xx:xx",       "place": "魚平では、新鮮で美味しいふぐが食べれます。（皿の上でまだ動いてました・・・）　値段もお手ごろで、「てっさ」、「てっちり」など、おなかいっぱい食べて、1人7,000円ぐらいでした。",       "description": "_"     },     {       "time": "13:10 13:20",       "place": "移動（車）",       "description": "_"     }  例(処理結果)： {       "time": "10:50 11:00",       "place": "移動（車）",       "description": "_"     },     {       "time": "11:00 13:10",       "place": "ふぐ館　魚平",       "description": "魚平では、新鮮で美味しいふぐが食べれます。（皿の上でまだ動いてました・・・）　値段もお手ごろで、「てっさ」、「てっちり」など、おなかいっぱい食べて、1人7,000円ぐらいでした。"     },     {       "time": "13:10 13:20",       "place": "移動（車）",       "description": "_"     }"""})
 
 print("データを整形中...(1/2)")
-#APIにリクエストを送信
-response = openai.chat.completions.create(
+#APIにリクエストを送信（同じ内容ならキャッシュから取得）
+assistant_message = cached_chat(
   model="gpt-4o",
   messages=messages,
   temperature=0
 )
-#モデルの回答を取得
-assistant_message = response.choices[0].message.content
 #履歴をクリア
 messages.clear()
 
@@ -79,14 +88,12 @@ messages.append({"role": "system", "content": "旅行記のファイルを処理
 
 
 print("図面ファイルを作成中...(2/2)")
-#APIに再びリクエストを送信
-response = openai.chat.completions.create( model="gpt-4o", messages=messages, temperature=0 )
-#モデルの回答を取得
-assistant_message = response.choices[0].message.content
+#APIに再びリクエストを送信（同じ内容ならキャッシュから取得）
+assistant_message = cached_chat( model="gpt-4o", messages=messages, temperature=0 )
 #回答を履歴に追加
 messages.append({"role": "assistant", "content": assistant_message})
 
-textforarukikata= response.choices[0].message.content
+textforarukikata= assistant_message
 textforarukikata = textforarukikata.removeprefix(prefix)
 textforarukikata = textforarukikata.removesuffix(suffix)
 textforarukikata = textforarukikata.strip()
@@ -98,5 +105,6 @@ with open(path_w, mode='w', encoding='utf-8') as f:
 end = time.time()
 time_diff = end - start  # 処理完了後の時刻から処理開始前の時刻を減算する
 print(time_diff)
+if llm_cache is not None: print(llm_cache.report())
 
 print("図面ファイルの生成が完了しました．")
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+travelogue.py / routeonly.py を対話なしで動かすためのコマンドライン引数と実行マニフェスト
+
+旅行記IDは次の形で複数指定できる（指定順に並べ、重複は除く）。
+- 00018            : そのまま1件
+- 00018-10363      : 範囲（両端を含む。桁数は開始側に合わせてゼロ埋め）
+- 0002?, 001[0-4]* : glob（データセットのディレクトリにある <ID>.tra.json と照合）
+- 00018_to_10363.txt : カンマ区切りでIDを書いた従来のファイル
+--shard i/N を付けると、IDのハッシュで N 個に分けた i 番目（1始まり）だけを処理する。
+複数台で同じ指定を使い、--shard 1/4 〜 4/4 を割り当てれば重複なく分担できる。
+
+実行マニフェストは1行1レコードのJSONL（旅行記ID, 状態 done/failed/skipped/partial, 所要秒数, 時刻）。
+追記のみで、同じIDは時刻(at)が新しいレコードが優先される（同じ時刻ならファイルの後の行）。再実行時は done のIDをキャッシュの有無を調べずに読み込む。
+shard ごとのマニフェスト（<名前>_shard1of4.jsonl など）も一緒に読むので、各台の結果を集めた
+ディレクトリで --shard なしに実行すれば、地図の生成だけが行われる。
+"""
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import re
+import socket
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from pipeline_stages import STAGES, parse_stages
+
+_RANGE = re.compile(r"^(\d+)-(\d+)$")
+
+
+def parse_args(argv=None, description=None, default_manifest=None, processes=False, pipeline=False):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("ids", nargs="*",
+                        help="旅行記ID・範囲(00018-10363)・glob(0002*)・IDを書いた.txt（省略するとファイルのパスを聞く）")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="i/N",
+                        help="IDを N 個に分けた i 番目(1始まり)だけを処理する")
+    parser.add_argument("--manifest", default=None,
+                        help=f"実行マニフェスト(JSONL)のパス（既定: {default_manifest}、--shard 指定時は shard ごとに別ファイル）")
+    parser.add_argument("--retry-skipped", action="store_true",
+                        help="マニフェストで skipped（ファイル無し・テキスト無しなど）のIDもやり直す（failed は常にやり直す）")
+    parser.add_argument("--output", default=None, help="地図HTMLの出力先（既定: 処理したIDか日時から決める）")
+    parser.add_argument("--no-map", action="store_true", help="キャッシュの作成だけを行い、地図は生成しない")
+    if processes:
+        parser.add_argument("--processes", type=int, default=None, metavar="N",
+                            help="旅行記を丸ごと処理するワーカープロセスの数（0ならスレッドでバッチ処理）")
+    if pipeline:
+        parser.add_argument("--stages", type=parse_stages, default=list(STAGES), metavar="STAGE,...",
+                            help=f"実行するステージ（{','.join(STAGES)}。選ばなかったステージはチェックポイントだけを使う）")
+        parser.add_argument("--refresh", type=parse_stages, default=[], metavar="STAGE,...",
+                            help="チェックポイントがあってもやり直すステージ")
+    args = parser.parse_args(argv)
+    if args.manifest is None and default_manifest:
+        stem, ext = os.path.splitext(default_manifest)
+        args.manifest = f"{stem}_shard{args.shard[0]}of{args.shard[1]}{ext}" if args.shard else default_manifest
+    return args
+
+
+def parse_shard(text):
+    """"i/N" を (i, N) にする"""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"--shard は i/N の形で指定してください: {text}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"--shard の i は 1〜N にしてください: {text}")
+    return index, count
+
+
+def resolve_ids(specs, directory, suffix=".tra.json"):
+    """ID・範囲・glob・.txt の指定を、旅行記IDのリストに展開する"""
+    ids, available = [], None
+    for spec in specs:
+        spec = spec.strip()
+        match = _RANGE.match(spec)
+        if spec.endswith(".txt"):
+            # 無いファイルをIDとして扱うと、存在しない旅行記を黙って処理しようとするのでエラーにする
+            with open(spec, "r", encoding="utf-8") as f:
+                ids += [num.strip() for num in f.read().strip().split(",") if num.strip()]
+        elif match:
+            start, end = match.groups()
+            ids += [str(n).zfill(len(start)) for n in range(int(start), int(end) + 1)]
+        elif any(c in spec for c in "*?["):
+            if available is None:
+                try:
+                    available = sorted(name[:-len(suffix)] for name in os.listdir(directory) if name.endswith(suffix))
+                except FileNotFoundError:
+                    print(f"[WARNING] データセットのディレクトリが見つかりません: {directory}")
+                    available = []
+            ids += fnmatch.filter(available, spec)
+        elif spec:
+            ids.append(spec)
+    return list(dict.fromkeys(ids))
+
+
+def select_shard(ids, shard):
+    """IDのハッシュで分けた shard=(i, N) の分だけを返す（None ならすべて）"""
+    if not shard:
+        return ids
+    index, count = shard
+    return [file_num for file_num in ids if zlib.crc32(file_num.encode("utf-8")) % count == index - 1]
+
+
+class RunManifest:
+    """旅行記ごとの処理結果を追記するJSONL。複数スレッドから record() してよい"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}  # 旅行記ID -> 時刻が最も新しいレコード
+        self._session = {}  # この実行で記録した 旅行記ID -> 状態
+        self._seconds = {}  # 旅行記ID -> この実行で計った秒数
+        if not path:
+            return
+        stem, ext = os.path.splitext(path)
+        # shard ごとのファイルと本体のどちらが新しいかは読む順番では決まらないので、_load で時刻を比べる
+        for manifest_path in sorted(glob.glob(f"{glob.escape(stem)}_shard*of*{ext}")) + [path]:
+            if os.path.exists(manifest_path):
+                self._load(manifest_path)
+
+    def _load(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書き込み途中で止まった行
+                previous = self._index.get(entry["file_num"])
+                if previous is None or entry.get("at", "") >= previous.get("at", ""):
+                    self._index[entry["file_num"]] = entry
+
+    def status(self, file_num):
+        entry = self._index.get(file_num)
+        return entry["status"] if entry else None
+
+    def completed(self, pipeline=None):
+        """done の旅行記ID。pipeline を渡すと、同じ設定（ハッシュ）で完了したものだけ"""
+        return {file_num for file_num, entry in self._index.items()
+                if entry["status"] == "done" and (pipeline is None or entry.get("pipeline") == pipeline)}
+
+    def recorded(self, file_num):
+        """この実行で記録した状態（未記録なら None）"""
+        return self._session.get(file_num)
+
+    @contextmanager
+    def timed(self, *file_nums):
+        """with の中の所要時間を旅行記の秒数に足す（複数の旅行記をまとめて処理したときは等分する）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            share = (time.perf_counter() - start) / max(len(file_nums), 1)
+            with self._lock:
+                for file_num in file_nums:
+                    self._seconds[file_num] = self._seconds.get(file_num, 0.0) + share
+
+    def record(self, file_num, status, **extra):
+        with self._lock:
+            entry = {
+                "file_num": file_num, "status": status, "seconds": round(self._seconds.pop(file_num, 0.0), 3),
+                "host": socket.gethostname(), "at": datetime.now().isoformat(timespec="seconds"), **extra,
+            }
+            self._index[file_num] = entry
+            self._session[file_num] = status
+            if not self.path:
+                return
+            directory = os.path.dirname(self.path)
+            if directory: os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def report(self):
+        counts = {}
+        for status in self._session.values():
+            counts[status] = counts.get(status, 0) + 1
+        summary = " / ".join(f"{status} {count}件" for status, count in sorted(counts.items())) or "記録なし"
+        return f"📒 実行マニフェスト ({self.path}): {summary}"
+
+
+def read_id_file_interactively():
+    """引数でIDが指定されなかったときの従来の動作（.txt のパスを聞く）"""
+    input_file_path = input('ファイル番号が記載された.txtファイルのパスを入力してください: ')
+    with open(input_file_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    return [num.strip() for num in content.strip().split(',') if num.strip()]
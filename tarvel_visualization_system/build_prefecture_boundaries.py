@@ -0,0 +1,88 @@
+"""
+国土数値情報の行政区域データ(N03)から、都道府県の境界ポリゴン data/prefectures.geojson を作る
+
+    python build_prefecture_boundaries.py N03-20240101.geojson
+    python build_prefecture_boundaries.py N03-*.geojson --tolerance 0.002 --output data/prefectures.geojson
+
+N03 の GeoJSON は https://nlftp.mlit.go.jp/ksj/gml/datalist/KsjTmplt-N03-2024.html から、
+全国または都道府県ごとのファイルをダウンロードして使う。
+市区町村のポリゴンを都道府県名(N03_001)ごとに1つの MultiPolygon にまとめ、Douglas–Peucker 法で頂点を間引く。
+市区町村は重ならないので、まとめたあとも偶奇規則（prefecture_index.PrefectureIndex）でそのまま判定できる
+（境界を合成(dissolve)しないので shapely などは要らない）。
+間引きで隣の市区町村との間にできるわずかな隙間・重なりの上の点は「都道府県外」になり、ネットワークで問い合わせ直すだけで済む。
+"""
+import argparse
+import json
+import os
+
+from cache_files import write_json_atomic
+from routes import simplify_path
+
+SOURCE = "「国土数値情報（行政区域データ）」（国土交通省）(https://nlftp.mlit.go.jp/ksj/gml/datalist/KsjTmplt-N03-2024.html) を加工して作成"
+LICENSE = "国土数値情報ダウンロードサイト利用規約（CC BY 4.0 互換）"
+
+
+def simplify_ring(ring, tolerance, digits=5):
+    """リング [[経度, 緯度], ...] を間引いて丸める。3角形にならないほど小さくなったら None"""
+    points = simplify_path([point[:2] for point in ring], tolerance).round(digits).tolist()
+    if points[0] != points[-1]:
+        points.append(points[0])
+    return points if len(points) >= 4 else None
+
+
+def prefecture_polygons(features, tolerance):
+    """N03 の市区町村の Feature のリストから、都道府県名 -> [ポリゴン(リングのリスト), ...] を作る"""
+    prefectures = {}
+    for feature in features:
+        name = (feature.get("properties") or {}).get("N03_001")
+        geometry = feature.get("geometry") or {}
+        if not name:
+            continue
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+        for rings in polygons:
+            outer = simplify_ring(rings[0], tolerance)
+            if outer is None:
+                continue  # 間引くと消えるほど小さな島
+            holes = [hole for hole in (simplify_ring(ring, tolerance) for ring in rings[1:]) if hole]
+            prefectures.setdefault(name, []).append([outer] + holes)
+    return prefectures
+
+
+def build(paths, tolerance):
+    features = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            features += json.load(f).get("features", [])
+    prefectures = prefecture_polygons(features, tolerance)
+    return {
+        "type": "FeatureCollection",
+        "source": SOURCE,
+        "license": LICENSE,
+        "features": [
+            {"type": "Feature", "properties": {"N03_001": name}, "geometry": {"type": "MultiPolygon", "coordinates": polygons}}
+            for name, polygons in prefectures.items()
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="N03 の行政区域データから都道府県の境界ポリゴンを作る")
+    parser.add_argument("paths", nargs="+", help="N03 の GeoJSON（全国、または都道府県ごとのファイルを複数）")
+    parser.add_argument("--tolerance", type=float, default=0.002, help="間引きの許容誤差（度。0.002度 ≒ 200m）")
+    parser.add_argument("--output", default=os.path.join("data", "prefectures.geojson"))
+    args = parser.parse_args(argv)
+
+    collection = build(args.paths, args.tolerance)
+    write_json_atomic(args.output, collection, ensure_ascii=False, separators=(',', ':'))
+    polygons = sum(len(feature["geometry"]["coordinates"]) for feature in collection["features"])
+    print(f"🗾 {len(collection['features'])}都道府県 / {polygons}ポリゴン を {args.output} に保存しました。"
+          f"({os.path.getsize(args.output) / 1024 / 1024:.1f}MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+キャッシュファイル（results_cache/*.json, render_cache/*.json）の書き込み
+
+一時ファイルに書き切ってから os.replace で差し替えるので、複数のプロセスが同じディレクトリに
+書き込んでも、途中で止まっても、読み手が書きかけのJSONを読むことはない。
+"""
+import json
+import os
+import tempfile
+
+
+def write_json_atomic(path, data, **dump_kwargs):
+    """data を JSON にして path に書く（json.dump の引数はそのまま渡す）"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,150 @@
+"""
+タグ別の感情スコアを緯度経度のグリッドに集計したヒートマップ
+
+滞在地ごとの [緯度, 経度, スコア] をそのままブラウザに渡すと、点の数だけデータが増え、
+Leaflet.heat がパン・ズームのたびにカーネルを計算し直す。ここではタグごとに NumPy で
+セル（緯度経度の正方格子）に振り分け、セルごとの平均スコアと件数をズーム段階別に前計算する。
+地図には表示中のズームに対応する段階のセルだけを canvas の矩形で描くので、
+データ量は滞在地の数ではなく、点のあるセルの数に比例する。
+同じ集計結果は CSV / Parquet に書き出して分析に使える。
+"""
+import csv
+import json
+import os
+
+import numpy as np
+from branca.element import MacroElement
+from jinja2 import Template
+
+# (この段階を使い始めるズームレベル, セルの大きさ[度]) を粗い順に並べる
+DEFAULT_GRID_LEVELS = [(0, 0.2), (8, 0.05), (11, 0.01), (14, 0.0025)]
+
+
+def _bin_cells(points, cell_deg):
+    """[[緯度, 経度, スコア], ...] をセルに振り分け、(セル番号 [i, j] の配列, スコアの合計, 件数) を返す"""
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if not len(points):
+        return np.empty((0, 2), dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)
+    cells = np.floor(points[:, :2] / cell_deg).astype(np.int64)
+    keys, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    sums = np.bincount(inverse.ravel(), weights=points[:, 2], minlength=len(keys))
+    return keys, sums, counts
+
+
+def aggregate_cells(points, cell_deg):
+    """[[緯度, 経度, スコア], ...] をセルに集計し、(セル中心の [緯度, 経度] 配列, 平均スコア, 件数) を返す"""
+    keys, sums, counts = _bin_cells(points, cell_deg)
+    return (keys + 0.5) * cell_deg, sums / np.maximum(counts, 1), counts
+
+
+class EmotionGrid:
+    """
+    タグごとの点をズーム段階別のセルに集計する。
+    点は add_points() の時点でセルの合計・件数に足し込むので、持っておくのは点のあるセルの分だけ。
+    """
+
+    def __init__(self, points_by_tag=None, levels=None):
+        self.levels = sorted(levels or DEFAULT_GRID_LEVELS)
+        self._cells = {}  # タグ -> 段階ごとの {(i, j): [スコアの合計, 件数]}
+        for tag, points in (points_by_tag or {}).items():
+            self.add_points(tag, points)
+
+    def add(self, tag, lat, lon, score):
+        self.add_points(tag, [[lat, lon, score]])
+
+    def add_points(self, tag, points):
+        """[[緯度, 経度, スコア], ...] をまとめて足し込む（ジェネレーターでもよい）"""
+        if not isinstance(points, np.ndarray):
+            points = list(points)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if not points.size:
+            return
+        levels = self._cells.setdefault(tag, [{} for _ in self.levels])
+        for (min_zoom, cell_deg), cells in zip(self.levels, levels):
+            keys, sums, counts = _bin_cells(points, cell_deg)
+            for key, total, count in zip(map(tuple, keys.tolist()), sums.tolist(), counts.tolist()):
+                cell = cells.setdefault(key, [0.0, 0])
+                cell[0] += total
+                cell[1] += count
+
+    def tags(self):
+        return list(self._cells)
+
+    def aggregate(self, tag):
+        """[(最小ズーム, セルの大きさ, セル中心, 平均スコア, 件数), ...] を返す"""
+        result = []
+        for (min_zoom, cell_deg), cells in zip(self.levels, self._cells.get(tag) or [{} for _ in self.levels]):
+            keys = np.array(list(cells), dtype=float).reshape(-1, 2)
+            totals = np.array(list(cells.values()), dtype=float).reshape(-1, 2)
+            result.append((min_zoom, cell_deg, (keys + 0.5) * cell_deg, totals[:, 0] / np.maximum(totals[:, 1], 1), totals[:, 1].astype(np.int64)))
+        return result
+
+    def layer(self, tag):
+        return GridHeatLayer(self.aggregate(tag))
+
+    def export(self, path):
+        """全タグ・全段階の集計を .csv か .parquet に書き出す"""
+        columns = ["tag", "min_zoom", "cell_deg", "latitude", "longitude", "mean_score", "count"]
+        rows = [
+            (tag, min_zoom, cell_deg, round(float(center[0]), 6), round(float(center[1]), 6), float(mean), int(count))
+            for tag in self._cells
+            for min_zoom, cell_deg, centers, means, counts in self.aggregate(tag)
+            for center, mean, count in zip(centers, means, counts)
+        ]
+        if os.path.splitext(path)[1].lower() == ".parquet":
+            try:
+                import pandas as pd
+            except ImportError:
+                print("[WARNING] Parquetで書き出すには pandas と pyarrow が必要です。CSVで書き出してください。")
+                return
+            pd.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        else:
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(rows)
+        print(f"📊 感情グリッドの集計を {path} に書き出しました。({len(rows)}セル)")
+
+
+class GridHeatLayer(MacroElement):
+    """ズームに応じた段階のセルを、平均スコアで色分けした矩形として描く（FeatureGroup の子要素として追加する）"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var group = {{ this._parent.get_name() }}, map = {{ this._parent._parent.get_name() }};
+                var levels = {{ this.levels_json() }};
+                var renderer = L.canvas({padding: 0.5}), cells = L.layerGroup().addTo(group);
+                function color(score) { return 'hsl(' + Math.round(120 * Math.max(0, Math.min(1, score))) + ', 80%, 45%)'; }
+                function redraw() {
+                    if (!map.hasLayer(group)) { return; }
+                    var zoom = map.getZoom(), level = levels[0];
+                    levels.forEach(function(l) { if (zoom >= l.z) { level = l; } });
+                    var bounds = map.getBounds().pad(0.2), half = level.d / 2;
+                    cells.clearLayers();
+                    level.c.forEach(function(c) {
+                        if (!bounds.contains([c[0], c[1]])) { return; }
+                        L.rectangle([[c[0] - half, c[1] - half], [c[0] + half, c[1] + half]], {
+                            renderer: renderer, stroke: false, fillColor: color(c[2]),
+                            fillOpacity: Math.min(0.8, 0.25 + 0.15 * Math.log(1 + c[3]))
+                        }).bindTooltip('平均スコア ' + c[2].toFixed(2) + '（' + c[3] + '件）').addTo(cells);
+                    });
+                }
+                map.on('moveend', redraw);
+                group.on('add', redraw);
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, levels):
+        super(GridHeatLayer, self).__init__()
+        self._name = 'GridHeatLayer'
+        self.levels = levels
+
+    def levels_json(self):
+        return json.dumps([
+            {"z": min_zoom, "d": cell_deg,
+             "c": [[round(float(c[0]), 6), round(float(c[1]), 6), round(float(mean), 3), int(count)]
+                   for c, mean, count in zip(centers, means, counts)]}
+            for min_zoom, cell_deg, centers, means, counts in self.levels
+        ], separators=(',', ':'))
@@ -0,0 +1,112 @@
+"""
+大量の滞在地を描画するための軽量マーカーレイヤー
+
+folium.Marker は1つごとに変数とスクリプトを HTML に書き出すので、数万件を超えると
+HTML もブラウザも重くなる。ここでは旅行記1件分のマーカーを配列データとしてまとめて出力し、
+ブラウザ側のループでマーカーを作る（FastMarkerCluster と同じ考え方）。
+- mode="cluster": L.marker を MarkerCluster に一括追加する（アイコンはクラスタが解けたズームで見える）
+- mode="canvas" : 共有の canvas レンダラーに円マーカーを描き、ICON_MIN_ZOOM 以上では
+                  表示範囲内のものだけ travel_icons のアイコンを重ねる
+
+配列の各行は [緯度, 経度, アイコンキー or null, ツールチップ, ポップアップ] で、
+ポップアップは HTML 文字列か、遅延読み込み用の [旅行記番号, 通し番号]（lazy_popups.py）。
+"""
+import json
+
+from branca.element import MacroElement
+from jinja2 import Template
+
+RENDER_MODES = ("markers", "cluster", "canvas")
+
+# マーカーをグループにまとめて追加する（map_shards.py と共用）。
+# FeatureGroupSubGroup 自体には addLayers が無いので、サブグループへの登録（表示の切り替え用）だけを先に済ませ、
+# 親の MarkerCluster には addLayers で一括追加する（1つずつ addLayer するとクラスタの計算が毎回走る）。
+ADD_LAYERS_JS = """
+    window.travelAddLayers = window.travelAddLayers || function(group, layers) {
+        var parent = group.getParentGroup && group.getParentGroup(), map = group._map;
+        if (parent && parent.addLayers) {
+            group._map = null;
+            layers.forEach(function(layer) { group.addLayer(layer); });
+            group._map = map;
+            if (map) { parent.addLayers(layers); }
+        } else if (group.addLayers) {
+            group.addLayers(layers);
+        } else {
+            layers.forEach(function(layer) { group.addLayer(layer); });
+        }
+    };
+"""
+
+
+def choose_render_mode(mode, marker_count, threshold):
+    """"auto" のときはマーカー数がしきい値を超えたら "cluster"、それ以外は "markers" にする"""
+    if mode in RENDER_MODES:
+        return mode
+    return "cluster" if marker_count > threshold else "markers"
+
+
+class FastMarkers(MacroElement):
+    """配列データからマーカーをまとめて作る（FeatureGroup / FeatureGroupSubGroup の子要素として追加する）"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this.add_layers_js }}
+            (function() {
+                var group = {{ this._parent.get_name() }}, map = {{ this._parent._parent.get_name() }};
+                var rows = {{ this.rows_json() }}, markers = [];
+                {%- if this.mode == "canvas" %}
+                window.travelCanvasRenderer = window.travelCanvasRenderer || L.canvas({padding: 0.5});
+                {%- endif %}
+                rows.forEach(function(r) {
+                    var mk;
+                    {%- if this.mode == "canvas" %}
+                    mk = L.circleMarker([r[0], r[1]], {renderer: travelCanvasRenderer, radius: {{ this.radius }},
+                        color: {{ this.color|tojson }}, weight: 1, fillOpacity: 0.8});
+                    {%- else %}
+                    mk = r[2] ? L.marker([r[0], r[1]], {icon: travel_icons[r[2]]}) : L.marker([r[0], r[1]]);
+                    {%- endif %}
+                    mk.bindTooltip(r[3]);
+                    if (typeof r[4] === 'string') {
+                        mk.bindPopup(r[4], {maxWidth: 350});
+                    } else {
+                        mk.bindPopup('読み込み中…', {maxWidth: 350});
+                        mk.travelPopupId = r[4];
+                    }
+                    markers.push(mk);
+                });
+                travelAddLayers(group, markers);
+                {%- if this.mode == "canvas" %}
+                // 拡大したときだけ、表示範囲内の滞在地にタグのアイコンを重ねる（クリックは下の円マーカーが受ける）
+                var icons = L.layerGroup().addTo(group);
+                function refreshIcons() {
+                    icons.clearLayers();
+                    if (!map.hasLayer(group) || map.getZoom() < {{ this.icon_min_zoom }}) { return; }
+                    var bounds = map.getBounds(), shown = 0;
+                    for (var i = 0; i < rows.length && shown < {{ this.max_icons }}; i++) {
+                        if (rows[i][2] && bounds.contains([rows[i][0], rows[i][1]])) {
+                            icons.addLayer(L.marker([rows[i][0], rows[i][1]], {icon: travel_icons[rows[i][2]], interactive: false}));
+                            shown++;
+                        }
+                    }
+                }
+                map.on('moveend', refreshIcons);
+                group.on('add', refreshIcons);
+                {%- endif %}
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, rows, mode="cluster", color="blue", radius=5, icon_min_zoom=14, max_icons=500):
+        super(FastMarkers, self).__init__()
+        self._name = 'FastMarkers'
+        self.rows = rows
+        self.mode = mode
+        self.color = color
+        self.radius = radius
+        self.icon_min_zoom = icon_min_zoom
+        self.max_icons = max_icons
+        self.add_layers_js = ADD_LAYERS_JS
+
+    def rows_json(self):
+        # ポップアップ・ツールチップのHTMLは旅行記の本文を含むので、"</script>" で <script> が途切れないようにする
+        return json.dumps(self.rows, ensure_ascii=False, separators=(',', ':')).replace("</", "<\\/")
@@ -0,0 +1,88 @@
+"""
+ローカルの地名辞書（ガゼッティア）を使うオフラインのジオコーダー
+
+タブ区切り(TSV)のファイルを読み込み、正規化した地名のハッシュ索引をメモリ上に作る。
+ネットワークを使わないので、よく出てくる地名はミリ秒未満で引ける。
+
+ファイル形式（1行目はヘッダー、aliases と kind は省略可）:
+    name	latitude	longitude	prefecture	kind	aliases
+    京都駅	34.985849	135.758767	京都府	station	京都
+    草津温泉	36.622	138.596	群馬県	onsen	草津
+"""
+import csv
+import os
+
+from geocode_cache import normalize_place_name
+
+KIND_PRIORITY = {"station": 0, "landmark": 1, "onsen": 1, "municipality": 2}
+
+
+def normalize_prefecture(name):
+    """「京都府」「京都」のような表記揺れをそろえる（北海道はそのまま）"""
+    name = normalize_place_name(name)
+    if name == "東京都" or (len(name) > 2 and name.endswith(("府", "県"))):
+        name = name[:-1]
+    return name
+
+
+class Gazetteer:
+    """正規化地名 → [(緯度, 経度, 都道府県, 種別), ...] の索引"""
+
+    name = "gazetteer"
+    bucket = None  # ローカル参照なのでレート制御しない
+    cacheable = False  # ジオコーディングキャッシュにも保存しない
+
+    def __init__(self):
+        self._index = {}
+        self._prefectures = {}  # 都道府県名の文字列を共有してメモリを節約する
+
+    @classmethod
+    def load(cls, path):
+        gazetteer = cls()
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                try:
+                    lat, lon = float(row["latitude"]), float(row["longitude"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                names = [row.get("name")] + (row.get("aliases") or "").split(",")
+                gazetteer.add(names, lat, lon, row.get("prefecture") or "", row.get("kind") or "")
+        print(f"📖 地名辞書を読み込みました: {path} ({len(gazetteer)}語)")
+        return gazetteer
+
+    def add(self, names, lat, lon, prefecture, kind=""):
+        prefecture = self._prefectures.setdefault(normalize_prefecture(prefecture), normalize_prefecture(prefecture))
+        entry = (lat, lon, prefecture, kind)
+        for name in names:
+            key = normalize_place_name(name)
+            if key:
+                self._index.setdefault(key, []).append(entry)
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, name, region_hint=None):
+        """
+        地名の座標を返す。region_hint の都道府県に絞り込み、見つからなければ None。
+        region_hint が不明（「日本」など）のときは、候補が1つに定まる場合だけ返す。
+        """
+        candidates = self._index.get(normalize_place_name(name))
+        if not candidates:
+            return None
+        prefecture = normalize_prefecture(region_hint or "")
+        if prefecture and prefecture != "日本":
+            candidates = [c for c in candidates if c[2] == prefecture]
+        elif len({(c[0], c[1]) for c in candidates}) > 1:
+            return None
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda c: KIND_PRIORITY.get(c[3], 9))
+        return best[0], best[1]
+
+
+def load_gazetteer(path):
+    """ファイルがあれば Gazetteer を、なければ None を返す"""
+    if not path or not os.path.exists(path):
+        print(f"[INFO] 地名辞書が見つからないため、オフラインジオコーディングは使いません: {path}")
+        return None
+    return Gazetteer.load(path)
@@ -0,0 +1,91 @@
+"""
+旅行記・実行をまたいで共有するジオコーディング結果のキャッシュ（SQLite）
+
+キーは正規化した (地名, region_hint, プロバイダー)。
+「見つからなかった」という結果も保存し、NEGATIVE_TTL を過ぎたら再問い合わせする。
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode_cache.sqlite3")
+NEGATIVE_TTL = 30 * 24 * 60 * 60  # 見つからなかった結果の有効期間（秒）
+MISS = object()  # キャッシュに無いことを表す（None は「見つからなかった」という結果）
+
+
+def normalize_place_name(name):
+    """全角/半角・空白・大文字小文字の揺れをそろえる"""
+    if not name:
+        return ""
+    name = unicodedata.normalize("NFKC", name)
+    return re.sub(r"\s+", " ", name).strip().lower()
+
+
+class GeocodeCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, negative_ttl=NEGATIVE_TTL):
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocodes ("
+            " provider TEXT NOT NULL, name TEXT NOT NULL, region TEXT NOT NULL,"
+            " latitude REAL, longitude REAL, found INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (provider, name, region))"
+        )
+        self._conn.commit()
+        self.stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+    @staticmethod
+    def _key(name, region_hint, provider):
+        return provider, normalize_place_name(name), normalize_place_name(region_hint)
+
+    def get(self, name, region_hint, provider):
+        """(lat, lon) / None(見つからなかった) / MISS(未登録または期限切れ) を返す"""
+        key = self._key(name, region_hint, provider)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT latitude, longitude, found, created_at FROM geocodes WHERE provider = ? AND name = ? AND region = ?", key
+            ).fetchone()
+            if row is None or (not row[2] and time.time() - row[3] > self.negative_ttl):
+                self.stats[provider]["misses"] += 1
+                return MISS
+            self._conn.execute("UPDATE geocodes SET hits = hits + 1 WHERE provider = ? AND name = ? AND region = ?", key)
+            self._conn.commit()
+            self.stats[provider]["hits"] += 1
+            return (row[0], row[1]) if row[2] else None
+
+    def put(self, name, region_hint, provider, coords):
+        """ジオコーディング結果を保存する。coords が None なら「見つからなかった」として保存"""
+        lat, lon = coords if coords else (None, None)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocodes (provider, name, region, latitude, longitude, found, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*self._key(name, region_hint, provider), lat, lon, 1 if coords else 0, time.time()),
+            )
+            self._conn.commit()
+
+    def report(self):
+        """プロバイダーごとのヒット率と、保存件数・累計ヒット数を表示用の文字列で返す"""
+        lines = ["📦 ジオコーディングキャッシュ:"]
+        for provider, s in sorted(self.stats.items()):
+            total = s["hits"] + s["misses"]
+            rate = s["hits"] / total * 100 if total else 0.0
+            lines.append(f"   {provider}: ヒット {s['hits']} / ミス {s['misses']} (ヒット率 {rate:.1f}%)")
+        with self._lock:
+            entries, found, hits = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(found), 0), COALESCE(SUM(hits), 0) FROM geocodes"
+            ).fetchone()
+        lines.append(f"   保存件数 {entries} (うち座標あり {found}) / 累計ヒット {hits}")
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
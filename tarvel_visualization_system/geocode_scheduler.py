@@ -0,0 +1,270 @@
+"""
+プロバイダーごとのトークンバケットでジオコーディングを並列に流すスケジューラー
+
+- Nominatim は 1リクエスト/秒、国土地理院(GSI) は別のレートで、それぞれ上限まで使い切る
+- HTTP は keep-alive の Session をプロバイダーごとに使い回す
+- 多数の滞在地・旅行記からの問い合わせをスレッドプールで同時に受け付ける
+- 接続先URLは差し替え可能なので、mock_geocode_server.py に向けて動作確認できる
+- プロバイダーは name と lookup(name, region_hint) を持つオブジェクトなら何でもよい
+  （bucket=None ならレート制御なし、cacheable=False ならキャッシュしない。gazetteer.Gazetteer など）
+- geocode_hedged() は複数プロバイダーを競争させ、最初に得られた妥当な結果を採用する
+  （2番手はすぐに、または1番手のp95遅延を過ぎてから投げる）。プロバイダーごとの遅延分布と成功率を記録する
+"""
+import bisect
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from geocode_cache import MISS
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+GSI_URL = "https://msearch.gsi.go.jp/address-search/AddressSearch"
+LATENCY_BUCKETS = [0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0]  # 遅延ヒストグラムの境界(秒)
+HEDGE_MIN_SAMPLES = 20  # p95 を使うのに必要な観測数
+HEDGE_DEFAULT_DELAY = 1.0  # 観測が少ないうちの2番手を投げるまでの待ち時間(秒)
+
+
+def in_japan(coords):
+    """日本周辺の座標かどうか（競争させたときに採用してよい結果かの判定に使う）"""
+    return coords is not None and 20.0 <= coords[0] <= 46.0 and 122.0 <= coords[1] <= 154.0
+
+
+class LatencyStats:
+    """プロバイダー1つ分の遅延ヒストグラムと直近の遅延（p95 計算用）"""
+
+    def __init__(self, window=500):
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.recent = deque(maxlen=window)
+
+    def record(self, seconds):
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.recent.append(seconds)
+
+    def percentile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def format_histogram(self):
+        labels = [f"<{b * 1000:g}ms" if b < 1 else f"<{b:g}s" for b in LATENCY_BUCKETS] + [f">={LATENCY_BUCKETS[-1]:g}s"]
+        return " ".join(f"{label}:{count}" for label, count in zip(labels, self.histogram) if count)
+
+
+class TokenBucket:
+    """
+    rate(回/秒) で補充され、最大 capacity 回まで連続で取り出せるトークンバケット。
+    clock と sleep はテストで時刻を進めるために差し替えられる
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel_event=None):
+        """
+        トークンが1つ取れるまで待ち、True を返す。
+        待っている間に cancel_event がセットされたら、トークンを取らずに False を返す
+        """
+        while True:
+            with self._lock:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if cancel_event is not None:
+                cancel_event.wait(wait)
+            else:
+                self._sleep(wait)
+
+
+def _make_session(pool_size, user_agent=None):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if user_agent:
+        session.headers["User-Agent"] = user_agent
+    return session
+
+
+class NominatimProvider:
+    name = "nominatim"
+
+    def __init__(self, url=NOMINATIM_URL, user_agent="travel-map-final", rate=1.0, pool_size=4, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate)
+        self.session = _make_session(pool_size, user_agent)
+
+    def lookup(self, name, region_hint):
+        query = f"{name}, {region_hint}" if region_hint else name
+        print(f"🗺️ Geocoding (Nominatim): '{query}'...")
+        response = self.session.get(self.url, params={"q": query, "format": "json", "limit": 1}, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data and isinstance(data, list):
+            return float(data[0]["lat"]), float(data[0]["lon"])
+        return None
+
+
+class GSIProvider:
+    name = "gsi"
+
+    def __init__(self, url=GSI_URL, rate=5.0, pool_size=4, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate)
+        self.session = _make_session(pool_size)
+
+    def lookup(self, name, region_hint=None):
+        print(f"🗺️ Geocoding (GSI): '{name}'...")
+        response = self.session.get(self.url, params={"q": name}, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data and isinstance(data, list):
+            lon, lat = data[0]["geometry"]["coordinates"][:2]
+            return lat, lon
+        return None
+
+
+class GeocodeScheduler:
+    """キャッシュ → トークンバケット → HTTP の順に問い合わせを捌く"""
+
+    def __init__(self, providers, cache=None, max_workers=8):
+        self.providers = {p.name: p for p in providers}
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # 競争させる問い合わせ用（_executor 上のタスクから投げてもデッドロックしないよう別にする）
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_workers * len(self.providers))
+        self._lock = threading.Lock()
+        self.stats = {name: {"requests": 0, "found": 0, "errors": 0, "cancelled": 0, "won": 0} for name in self.providers}
+        self.latency = {name: LatencyStats() for name in self.providers}
+
+    def geocode(self, provider_name, name, region_hint="", cancel_event=None, sent_event=None):
+        """
+        1つのプロバイダーで地名を引く。見つからない・失敗した場合は None。
+        cancel_event がセットされたら、トークンを取る前（順番待ちの途中を含む）にやめて None を返す。
+        sent_event はトークンを取って問い合わせを送る直前にセットする。
+        """
+        provider = self.providers[provider_name]
+        use_cache = self.cache is not None and getattr(provider, "cacheable", True)
+        cache_region = region_hint if provider_name != "gsi" else ""
+        if use_cache:
+            cached = self.cache.get(name, cache_region, provider_name)
+            if cached is not MISS:
+                return cached
+        # 取り消された問い合わせにトークンを使わない（Nominatim は1回/秒しかない）
+        cancelled = cancel_event is not None and cancel_event.is_set()
+        if not cancelled and getattr(provider, "bucket", None) is not None:
+            cancelled = not provider.bucket.acquire(cancel_event)
+        if cancelled:
+            with self._lock: self.stats[provider_name]["cancelled"] += 1
+            return None
+        if sent_event is not None:
+            sent_event.set()
+        started = time.monotonic()
+        try:
+            coords = provider.lookup(name, region_hint)
+        except Exception as e:
+            with self._lock:
+                self.stats[provider_name]["requests"] += 1
+                self.stats[provider_name]["errors"] += 1
+                self.latency[provider_name].record(time.monotonic() - started)
+            print(f"[WARNING] ジオコーディング({provider_name})に失敗: {name}: {e}")
+            return None
+        with self._lock:
+            self.stats[provider_name]["requests"] += 1
+            self.stats[provider_name]["found"] += 1 if coords else 0
+            self.latency[provider_name].record(time.monotonic() - started)
+        if use_cache:
+            self.cache.put(name, cache_region, provider_name, coords)
+        return coords
+
+    def hedge_delay(self, provider_name):
+        """2番手を投げるまでの待ち時間。観測が十分あれば provider_name の p95 遅延を使う"""
+        with self._lock:
+            stats = self.latency[provider_name]
+            if len(stats.recent) < HEDGE_MIN_SAMPLES:
+                return HEDGE_DEFAULT_DELAY
+            return stats.percentile(0.95)
+
+    def geocode_hedged(self, name, region_hint, precedence, delay=None, acceptable=in_japan):
+        """
+        precedence の順にプロバイダーを競争させ、最初に得られた妥当な結果を返す。
+        delay=0 なら全プロバイダーを同時に、None なら直前のプロバイダーの p95 遅延ごとに順に投げる。
+        待ち時間は直前のプロバイダーが実際に問い合わせを送ってから数える（トークンバケットの順番待ちは含めない）。
+        同時に結果がそろった場合は precedence の順で優先し、残りの問い合わせは取り消す。
+        """
+        precedence = [p for p in precedence if p in self.providers]
+        cancel_event = threading.Event()
+        futures = {}
+        pending_names = list(precedence)
+        winner = None
+        while pending_names or futures:
+            if pending_names:
+                provider_name = pending_names.pop(0)
+                sent = threading.Event()
+                futures[self._hedge_executor.submit(self.geocode, provider_name, name, region_hint, cancel_event, sent)] = provider_name
+                timeout = None
+                if pending_names:
+                    # 送信するか、どれかの問い合わせが終わるまで待ってから2番手の時計を動かす
+                    for f in futures: f.add_done_callback(lambda _, sent=sent: sent.set())
+                    sent.wait()
+                    timeout = self.hedge_delay(provider_name) if delay is None else delay
+            else:
+                timeout = None
+            done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+            results = sorted(((precedence.index(futures[f]), futures[f], f.result()) for f in done))
+            for f in done:
+                del futures[f]
+            winner = next(((provider_name, coords) for _, provider_name, coords in results if acceptable(coords)), None)
+            if winner:
+                break
+        cancel_event.set()
+        for f, provider_name in futures.items():
+            if f.cancel():
+                with self._lock: self.stats[provider_name]["cancelled"] += 1
+        if winner is None:
+            return None
+        with self._lock: self.stats[winner[0]]["won"] += 1
+        return winner[1]
+
+    def has_provider(self, provider_name):
+        return provider_name in self.providers
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def map(self, fn, items):
+        """items の各要素に fn を並列適用し、入力順の結果リストを返す"""
+        return list(self._executor.map(fn, items))
+
+    def report(self):
+        lines = ["📊 ジオコーディング問い合わせ:"]
+        for name, s in self.stats.items():
+            rate = s["found"] / s["requests"] * 100 if s["requests"] else 0.0
+            line = f"   {name}: {s['requests']}件 (該当 {s['found']} = {rate:.1f}% / 失敗 {s['errors']} / 取消 {s['cancelled']} / 採用 {s['won']})"
+            p95 = self.latency[name].percentile(0.95)
+            if p95 is not None:
+                line += f" p50={self.latency[name].percentile(0.5):.2f}s p95={p95:.2f}s [{self.latency[name].format_histogram()}]"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        self._hedge_executor.shutdown(wait=True)
@@ -0,0 +1,180 @@
+"""
+旅行記が数千件あっても重くならない、検索・絞り込みつきのレイヤーパネル
+
+folium.LayerControl は旅行記ごとのレイヤーにチェックボックスを1行ずつ作るので、
+件数に比例して読み込み時の DOM が増える。このパネルは
+- 見えている行だけを描画する（仮想スクロール）
+- 旅行記ID・地域の前方一致検索、region_hint とタグでの絞り込みができる
+- 旅行記のレイヤーは最初にチェックされたときに作る（中身は map_shards.py のシャードから読み込む）
+"""
+import json
+
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from jinja2 import Template
+
+
+class TravelLayerPanel(JSCSSMixin, MacroElement):
+    """地図に1つだけ追加する。ShardLoader と一緒に使う"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var cluster = {{ this.cluster.get_name() if this.cluster else "null" }};
+                var entries = {{ this.entries_json() }};
+                var rowHeight = 22, filtered = entries, layers = {};
+
+                function layerFor(entry, kind) {
+                    var state = layers[entry.i] = layers[entry.i] || {};
+                    if (!state[kind]) {
+                        state[kind] = cluster ? L.featureGroup.subGroup(cluster) : L.featureGroup();
+                        travelShards.load(entry.f, function(collection) { travelShards.populate(state[kind], collection, kind, entry.i); });
+                    }
+                    return state[kind];
+                }
+                function isOn(entry, kind) {
+                    var state = layers[entry.i];
+                    return !!(state && state[kind] && map.hasLayer(state[kind]));
+                }
+                function setOn(entry, kind, on) {
+                    if (on) { if (!isOn(entry, kind)) { map.addLayer(layerFor(entry, kind)); } }
+                    else if (isOn(entry, kind)) { map.removeLayer(layers[entry.i][kind]); }
+                }
+
+                var control = L.control({position: 'topright'});
+                control.onAdd = function() {
+                    var div = L.DomUtil.create('div', 'leaflet-bar leaflet-control');
+                    div.style.background = 'white';
+                    div.style.padding = '6px';
+                    div.style.width = '260px';
+                    div.style.fontSize = '12px';
+                    L.DomEvent.disableClickPropagation(div);
+                    L.DomEvent.disableScrollPropagation(div);
+
+                    var search = L.DomUtil.create('input', '', div);
+                    search.type = 'search';
+                    search.placeholder = '旅行記ID・地域で検索';
+                    search.style.width = '100%';
+                    function makeSelect(label, values) {
+                        var select = L.DomUtil.create('select', '', div);
+                        select.style.width = '100%';
+                        [''].concat(values).forEach(function(value) {
+                            var option = document.createElement('option');
+                            option.value = value;
+                            option.textContent = value || label;
+                            select.appendChild(option);
+                        });
+                        return select;
+                    }
+                    var regionSelect = makeSelect('すべての地域', {{ this.regions()|tojson }});
+                    var tagSelect = makeSelect('すべてのタグ', {{ this.tags()|tojson }});
+
+                    var buttons = L.DomUtil.create('div', '', div);
+                    var showButton = L.DomUtil.create('button', '', buttons);
+                    showButton.textContent = '全表示';
+                    var hideButton = L.DomUtil.create('button', '', buttons);
+                    hideButton.textContent = '全非表示';
+                    var count = L.DomUtil.create('span', '', buttons);
+                    count.style.marginLeft = '6px';
+
+                    var viewport = L.DomUtil.create('div', '', div);
+                    viewport.style.height = '{{ this.height }}px';
+                    viewport.style.overflowY = 'auto';
+                    viewport.style.position = 'relative';
+                    var spacer = L.DomUtil.create('div', '', viewport);
+                    var rows = L.DomUtil.create('div', '', viewport);
+                    rows.style.position = 'absolute';
+                    rows.style.left = rows.style.right = rows.style.top = '0';
+
+                    // 見えている範囲（と前後数行）の行だけを作る
+                    function renderRows() {
+                        var first = Math.max(0, Math.floor(viewport.scrollTop / rowHeight) - 5);
+                        var last = Math.min(filtered.length, first + Math.ceil(viewport.clientHeight / rowHeight) + 10);
+                        rows.style.top = (first * rowHeight) + 'px';
+                        rows.textContent = '';
+                        for (var i = first; i < last; i++) {
+                            var entry = filtered[i], row = L.DomUtil.create('div', '', rows);
+                            row.style.height = rowHeight + 'px';
+                            row.style.whiteSpace = 'nowrap';
+                            row.style.overflow = 'hidden';
+                            [['route', 'ルート'], ['move', '移動']].forEach(function(kind) {
+                                var checkbox = L.DomUtil.create('input', '', row);
+                                checkbox.type = 'checkbox';
+                                checkbox.title = kind[1];
+                                checkbox.checked = isOn(entry, kind[0]);
+                                checkbox.dataset.index = i;
+                                checkbox.dataset.kind = kind[0];
+                            });
+                            var name = L.DomUtil.create('span', '', row);
+                            name.textContent = entry.i + (entry.r ? ' ' + entry.r : '');
+                            name.style.cursor = entry.b ? 'pointer' : 'default';
+                            name.dataset.index = i;
+                        }
+                    }
+                    function applyFilter() {
+                        var query = search.value.trim().toLowerCase(), region = regionSelect.value, tag = tagSelect.value;
+                        filtered = entries.filter(function(entry) {
+                            return (!query || entry.i.toLowerCase().indexOf(query) === 0 || entry.r.toLowerCase().indexOf(query) === 0)
+                                && (!region || entry.r === region) && (!tag || entry.t.indexOf(tag) >= 0);
+                        });
+                        spacer.style.height = (filtered.length * rowHeight) + 'px';
+                        count.textContent = filtered.length + '件';
+                        viewport.scrollTop = 0;
+                        renderRows();
+                    }
+                    function setFiltered(on) {
+                        filtered.forEach(function(entry) { setOn(entry, 'route', on); setOn(entry, 'move', on); });
+                        renderRows();
+                    }
+
+                    viewport.addEventListener('scroll', renderRows);
+                    rows.addEventListener('change', function(e) {
+                        setOn(filtered[+e.target.dataset.index], e.target.dataset.kind, e.target.checked);
+                    });
+                    rows.addEventListener('click', function(e) {
+                        var entry = e.target.tagName === 'SPAN' && filtered[+e.target.dataset.index];
+                        if (entry && entry.b) { map.fitBounds(entry.b); }
+                    });
+                    search.addEventListener('input', applyFilter);
+                    regionSelect.addEventListener('change', applyFilter);
+                    tagSelect.addEventListener('change', applyFilter);
+                    showButton.onclick = function() { setFiltered(true); };
+                    hideButton.onclick = function() { setFiltered(false); };
+                    setTimeout(applyFilter, 0);  // viewport の高さが決まってから描画する
+                    return div;
+                };
+                entries.slice(0, {{ this.initial }}).forEach(function(entry) { setOn(entry, 'route', true); setOn(entry, 'move', true); });
+                control.addTo(map);
+            })();
+        {% endmacro %}
+    """)
+
+    default_js = [
+        (
+            "featuregroupsubgroupjs",
+            "https://unpkg.com/leaflet.featuregroup.subgroup@1.0.2/dist/leaflet.featuregroup.subgroup.js",
+        ),
+    ]
+
+    def __init__(self, cluster=None, initial=20, height=300):
+        super(TravelLayerPanel, self).__init__()
+        self._name = 'TravelLayerPanel'
+        self.cluster = cluster  # MarkerCluster を使うときは、作るレイヤーをそのサブグループにする
+        self.initial = initial  # 読み込み時に表示しておく旅行記の数
+        self.height = height
+        self._entries = []
+
+    def add_journal(self, file_num, shard_file, region_hint, tags, bounds):
+        self._entries.append({
+            "i": str(file_num), "f": shard_file, "r": region_hint or "", "t": sorted(tags), "b": bounds,
+        })
+
+    def regions(self):
+        return sorted({entry["r"] for entry in self._entries if entry["r"]})
+
+    def tags(self):
+        return sorted({tag for entry in self._entries for tag in entry["t"]})
+
+    def entries_json(self):
+        return json.dumps(self._entries, ensure_ascii=False, separators=(',', ':')).replace("</", "<\\/")
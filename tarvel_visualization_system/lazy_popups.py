@@ -0,0 +1,152 @@
+"""
+ポップアップの中身を HTML に埋め込まず、クリックされたときに旅行記ごとのサイドカーから読み込む
+
+マーカーは (旅行記番号, 通し番号) だけを持ち、ポップアップが開かれたときに
+<HTML名>_popups/<旅行記番号>.js を <script> で読み込んで（file:// でも動くように JSONP 形式）、
+ブラウザ側でポップアップの HTML を組み立てる。
+ポップアップのデータ（stop_entry / move_entry）は旅行記の本文を HTML エスケープ済みで持ち、
+"inline" の地図も同じデータから stop_popup_html / move_popup_html で HTML を作るので、どちらでも同じ表示になる。
+"""
+import html
+import json
+import os
+
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+HR = "<hr style='margin: 3px 0;'>"
+TAG_STYLE = "display:inline-block; background-color:#E0E0E0; color:#333; padding:2px 6px; margin:2px; border-radius:4px; font-size:12px;"
+GIF_STYLE = "max-width: 95%; height: auto; margin-top: 5px; border-radius: 4px;"
+
+
+def _escape(text):
+    return html.escape(str(text))
+
+
+def stop_entry(file_num, stop_data, per_tag_emotions, gifs):
+    """滞在地1件分のポップアップデータ（文字列はエスケープ済み）。gifs は [(タグ, アセットキー), ...]"""
+    return {
+        "t": "s", "f": _escape(file_num), "p": _escape(stop_data.get("place", "")),
+        "e": [[_escape(tag), score] for tag, score in per_tag_emotions.items()],
+        "g": [[_escape(tag), asset_key] for tag, asset_key in gifs],
+        "r": _escape(stop_data.get("reasoning") or ""), "x": _escape(stop_data.get("experience", "")),
+    }
+
+
+def move_entry(means, experience):
+    """移動1件分のポップアップデータ（文字列はエスケープ済み）"""
+    return {"t": "m", "m": _escape(means), "x": _escape(experience)}
+
+
+def stop_popup_html(entry):
+    """stop_entry のデータからポップアップの HTML を作る（画像の src は AssetTable がポップアップを開いたときに埋める）"""
+    popup_html = f"<b>{entry['p']}</b> (旅行記: {entry['f']})<br>"
+    if entry["e"]:
+        popup_html += HR + "<b>タグ別感情スコア:</b><br>"
+        popup_html += "".join(f"<span style='{TAG_STYLE}'>{tag} ({score:.2f})</span>" for tag, score in entry["e"])
+    if entry["g"]:
+        popup_html += HR + "<b>関連画像:</b><br>"
+        popup_html += "".join(f'<img data-asset="{asset_key}" alt="{tag}" style="{GIF_STYLE}">' for tag, asset_key in entry["g"])
+    if entry["r"]:
+        popup_html += HR + f"<b>推定理由:</b><br>{entry['r']}<br>"
+    popup_html += HR + f"<b>体験:</b><br>{entry['x']}"
+    return popup_html
+
+
+def move_popup_html(entry):
+    return f"<b>移動: {entry['m']}</b><br><hr>{entry['x']}"
+
+
+class LazyPopupLoader(MacroElement):
+    """地図に1つだけ追加する、サイドカーの読み込みとポップアップ組み立て用のスクリプト"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var travelPopups = {data: {}, pending: {}, base: {{ this.sidecar_url|tojson }}};
+            travelPopups.register = function(fileNum, entries) {
+                travelPopups.data[fileNum] = entries;
+                (travelPopups.pending[fileNum] || []).forEach(function(cb) { cb(); });
+                delete travelPopups.pending[fileNum];
+            };
+            travelPopups.load = function(fileNum, cb) {
+                if (travelPopups.data[fileNum]) { cb(); return; }
+                if (travelPopups.pending[fileNum]) { travelPopups.pending[fileNum].push(cb); return; }
+                travelPopups.pending[fileNum] = [cb];
+                var s = document.createElement('script');
+                s.src = travelPopups.base + encodeURIComponent(fileNum) + '.js';
+                document.head.appendChild(s);
+            };
+            // stop_popup_html / move_popup_html と同じ HTML を作る（文字列はサイドカーの時点でエスケープ済み）
+            travelPopups.build = function(entry) {
+                var hr = {{ this.hr|tojson }}, html;
+                if (entry.t === 'm') {
+                    return '<b>移動: ' + entry.m + '</b><br><hr>' + entry.x;
+                }
+                html = '<b>' + entry.p + '</b> (旅行記: ' + entry.f + ')<br>';
+                if (entry.e.length) {
+                    html += hr + '<b>タグ別感情スコア:</b><br>';
+                    entry.e.forEach(function(tagScore) {
+                        html += "<span style='" + {{ this.tag_style|tojson }} + "'>" + tagScore[0] + ' (' + Number(tagScore[1]).toFixed(2) + ')</span>';
+                    });
+                }
+                if (entry.g.length) {
+                    html += hr + '<b>関連画像:</b><br>';
+                    entry.g.forEach(function(gif) {
+                        html += '<img src="' + travel_assets[gif[1]] + '" alt="' + gif[0] + '" style="' + {{ this.gif_style|tojson }} + '">';
+                    });
+                }
+                if (entry.r) { html += hr + '<b>推定理由:</b><br>' + entry.r + '<br>'; }
+                html += hr + '<b>体験:</b><br>' + entry.x;
+                return html;
+            };
+            {{ this._parent.get_name() }}.on('popupopen', function(e) {
+                var id = e.popup._source && e.popup._source.travelPopupId;
+                if (!id) { return; }
+                travelPopups.load(id[0], function() { e.popup.setContent(travelPopups.build(travelPopups.data[id[0]][id[1]])); });
+            });
+        {% endmacro %}
+    """)
+
+    def __init__(self, output_html):
+        super(LazyPopupLoader, self).__init__()
+        self._name = 'LazyPopupLoader'
+        stem = os.path.splitext(os.path.basename(output_html))[0]
+        self.sidecar_dir = os.path.join(os.path.dirname(os.path.abspath(output_html)), f"{stem}_popups")
+        self.sidecar_url = f"{stem}_popups/"
+        self.hr, self.tag_style, self.gif_style = HR, TAG_STYLE, GIF_STYLE
+        self._entries = {}  # 旅行記番号 -> 書き出し前のポップアップデータ
+
+    def set_entries(self, file_num, entries):
+        """
+        旅行記1件分のポップアップデータ（stop_entry / move_entry を通し番号順に並べたリスト）を登録する。
+        マーカーの LazyPopup にはリスト内の位置を通し番号として渡す
+        """
+        self._entries[str(file_num)] = list(entries)
+
+    def flush(self, file_num):
+        """旅行記1件分のポップアップデータをサイドカーに書き出し、メモリから解放する"""
+        entries = self._entries.pop(str(file_num), None)
+        if entries is None:
+            return
+        os.makedirs(self.sidecar_dir, exist_ok=True)
+        with open(os.path.join(self.sidecar_dir, f"{file_num}.js"), "w", encoding="utf-8") as f:
+            f.write(f"travelPopups.register({json.dumps(str(file_num))}, {json.dumps(entries, ensure_ascii=False, separators=(',', ':'))});\n")
+
+
+class LazyPopup(MacroElement):
+    """マーカーに「読み込み中」のポップアップと ID だけを付ける（Marker の子要素として追加する）"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this._parent.get_name() }}.bindPopup('読み込み中…', {maxWidth: {{ this.max_width }}});
+            {{ this._parent.get_name() }}.travelPopupId = [{{ this.file_num|tojson }}, {{ this.index }}];
+        {% endmacro %}
+    """)
+
+    def __init__(self, file_num, index, max_width=350):
+        super(LazyPopup, self).__init__()
+        self._name = 'LazyPopup'
+        self.file_num = str(file_num)
+        self.index = index
+        self.max_width = max_width
@@ -0,0 +1,116 @@
+"""
+プロンプト単位の LLM 応答キャッシュ（SQLite）
+
+(model, temperature, messages, response_format) のハッシュをキーに応答本文を保存する。
+合計サイズが上限を超えたら、最後に使われた時刻が古いものから削除する（LRU）。
+travelogue.py / routeonly.py / based-on-tem-tool/travelautomation.py で同じファイルを共有する。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache.sqlite3")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def make_key(model, messages, temperature=None, response_format=None, **extra):
+    """
+    リクエスト内容からキャッシュキー（SHA-256）を作る。
+    max_tokens などその他の引数も応答を左右するのでキーに含める（None のものは除く）
+    """
+    request = {"model": model, "temperature": temperature, "messages": messages, "response_format": response_format}
+    extra = {name: value for name, value in extra.items() if value is not None}
+    if extra:
+        request["extra"] = extra  # 引数が無いときは以前と同じキーになるようにする
+    payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """SQLite に保存する、サイズ上限付きの LRU キャッシュ"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, content TEXT NOT NULL,"
+            " size INTEGER NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    def get(self, key):
+        """キャッシュされた応答本文を返す。なければ None"""
+        with self._lock:
+            row = self._conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.stats["hits"] += 1
+            return row[0]
+
+    def put(self, key, content, model=None):
+        size = len(content.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, size, now, now),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self.stats["writes"] += 1
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """上限の9割を下回るまで、最後に使われた時刻が古いものから削除する"""
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC")
+        victims = []
+        for key, size in rows:
+            if self._total_bytes <= target:
+                break
+            victims.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.stats["evictions"] += len(victims)
+
+    def report(self):
+        s = self.stats
+        total = s["hits"] + s["misses"]
+        rate = s["hits"] / total * 100 if total else 0.0
+        return (f"📦 LLMキャッシュ: ヒット {s['hits']} / ミス {s['misses']} (ヒット率 {rate:.1f}%) / "
+                f"保存 {s['writes']} / 削除 {s['evictions']} / {self._total_bytes / 1024 / 1024:.1f}MB")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def cached_completion(cache, create_fn, model, messages, temperature=None, response_format=None, **kwargs):
+    """キャッシュを引き、なければ create_fn(ChatCompletion.create 等) を呼んで応答本文を返す"""
+    key = make_key(model, messages, temperature, response_format, **kwargs)
+    if cache is not None:
+        content = cache.get(key)
+        if content is not None:
+            return content
+    request = dict(model=model, messages=messages, **kwargs)
+    if temperature is not None: request["temperature"] = temperature
+    if response_format is not None: request["response_format"] = response_format
+    content = create_fn(**request).choices[0].message.content
+    if cache is not None and content is not None:
+        cache.put(key, content, model)
+    return content
@@ -0,0 +1,217 @@
+"""
+OpenAI API 呼び出しを並列・レート制限付きで実行するエンジン
+
+- 同時実行数の上限までリクエストを並列に流す（旅行記・滞在地をまたいで共有）
+- モデルごとに RPM(リクエスト/分)・TPM(トークン/分) の予算を1分間のスライディングウィンドウで管理する
+- 429(RateLimitError) を受けたら全体で待機し、同時実行数を一時的に半分へ絞る（適応バックオフ）
+- LLMCache を渡すと、同じリクエストはAPIを呼ばずにキャッシュから返す
+
+ローカルのスタブサーバー(stub_llm_server.py)に向けて動作確認する場合は、
+環境変数 OPENAI_API_BASE=http://127.0.0.1:8800/v1 を設定してから実行する。
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_cache import make_key
+
+RETRYABLE_ERRORS = ("RateLimitError", "ServiceUnavailableError", "Timeout", "APIConnectionError", "TryAgain")
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """メッセージのトークン数を大まかに見積もる（日本語は1文字≒1トークンとして扱う）"""
+    chars = sum(len(m.get("content") or "") for m in messages)
+    return chars + (max_tokens or 512)
+
+
+def _is_rate_limit(error):
+    return type(error).__name__ == "RateLimitError" or getattr(error, "http_status", None) == 429
+
+
+def _retry_after(error):
+    """エラーのレスポンスヘッダーから Retry-After(秒) を取り出す"""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateBudget:
+    """1分間のスライディングウィンドウで RPM/TPM の予算を管理する"""
+
+    def __init__(self, rpm=None, tpm=None, window=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._entries = deque()  # [送信時刻, トークン数]
+        self._used_tokens = 0
+        self._cond = threading.Condition()
+
+    def _expire(self, now):
+        while self._entries and self._entries[0][0] + self.window <= now:
+            self._used_tokens -= self._entries.popleft()[1]
+
+    def _wait_time(self, now, tokens):
+        wait = 0.0
+        if self.rpm and len(self._entries) >= self.rpm:
+            wait = self._entries[0][0] + self.window - now
+        if self.tpm and self._used_tokens + tokens > self.tpm:
+            freed = 0
+            for sent_at, used in self._entries:
+                freed += used
+                if self._used_tokens - freed + tokens <= self.tpm:
+                    wait = max(wait, sent_at + self.window - now)
+                    break
+        return wait
+
+    def acquire(self, tokens):
+        """予算に空きができるまで待ち、消費を記録する。戻り値は settle() に渡す"""
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    entry = [now, tokens]
+                    self._entries.append(entry)
+                    self._used_tokens += tokens
+                    return entry
+                self._cond.wait(wait)
+
+    def settle(self, entry, actual_tokens):
+        """見積もりトークン数を実際の消費量(usage)で置き換える"""
+        if actual_tokens is None:
+            return
+        with self._cond:
+            if entry in self._entries:
+                self._used_tokens += actual_tokens - entry[1]
+            entry[1] = actual_tokens
+            self._cond.notify_all()
+
+
+class LLMEngine:
+    """レート制限を守りながら ChatCompletion を並列実行するエンジン"""
+
+    def __init__(self, max_concurrency=8, rate_limits=None, max_retries=6, create_fn=None, cache=None):
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self.rate_limits = rate_limits or {}
+        self.max_retries = max_retries
+        self._create_fn = create_fn
+        self._budgets = {}
+        self._cond = threading.Condition()
+        self._limit = max_concurrency  # 429 を受けると一時的に下がる
+        self._in_flight = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._backoff = 1.0
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def _create(self, **kwargs):
+        if self._create_fn is None:
+            import openai
+            self._create_fn = openai.ChatCompletion.create
+        return self._create_fn(**kwargs)
+
+    def _budget(self, model):
+        with self._cond:
+            if model not in self._budgets:
+                limits = self.rate_limits.get(model, self.rate_limits.get("default", {}))
+                self._budgets[model] = RateBudget(limits.get("rpm"), limits.get("tpm"))
+            return self._budgets[model]
+
+    def _enter(self):
+        with self._cond:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                elif self._in_flight >= self._limit:
+                    self._cond.wait()
+                else:
+                    self._in_flight += 1
+                    return
+
+    def _leave(self, outcome="ok", retry_after=None):
+        with self._cond:
+            self._in_flight -= 1
+            if outcome == "rate_limited":
+                self.stats["rate_limited"] += 1
+                self._limit = max(1, self._limit // 2)
+                self._successes = 0
+                delay = retry_after if retry_after else self._backoff * (1 + random.random())
+                self._backoff = min(self._backoff * 2, 60.0)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            elif outcome == "ok":
+                self._successes += 1
+                self._backoff = max(1.0, self._backoff / 2)
+                if self._limit < self.max_concurrency and self._successes >= self._limit:
+                    self._limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+    def complete(self, model, messages, temperature=None, response_format=None, max_tokens=None, **kwargs):
+        """レート制限・リトライを経て ChatCompletion を実行し、応答本文を返す"""
+        request = dict(model=model, messages=messages, **kwargs)
+        if temperature is not None: request["temperature"] = temperature
+        if response_format is not None: request["response_format"] = response_format
+        if max_tokens is not None: request["max_tokens"] = max_tokens
+
+        key = make_key(model, messages, temperature, response_format, max_tokens=max_tokens, **kwargs)
+        if self.cache is not None:
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
+        budget = self._budget(model)
+        estimated = estimate_tokens(messages, max_tokens)
+        for attempt in range(self.max_retries + 1):
+            entry = budget.acquire(estimated)
+            self._enter()
+            try:
+                response = self._create(**request)
+            except Exception as e:
+                if type(e).__name__ not in RETRYABLE_ERRORS and not _is_rate_limit(e):
+                    self._leave("error")
+                    raise
+                self._leave("rate_limited" if _is_rate_limit(e) else "error", _retry_after(e))
+                if attempt == self.max_retries:
+                    raise
+                with self._cond: self.stats["retries"] += 1
+                if not _is_rate_limit(e):
+                    time.sleep(min(2 ** attempt, 30) * (1 + random.random()) / 2)
+                continue
+            self._leave()
+            usage = getattr(response, "usage", None)
+            if usage:
+                budget.settle(entry, usage.total_tokens)
+                with self._cond:
+                    self.stats["prompt_tokens"] += usage.prompt_tokens or 0
+                    self.stats["completion_tokens"] += usage.completion_tokens or 0
+            with self._cond: self.stats["requests"] += 1
+            content = response.choices[0].message.content
+            if self.cache is not None and content is not None:
+                self.cache.put(key, content, model)
+            return content
+
+    def submit(self, fn, *args, **kwargs):
+        """エンジンのワーカースレッドで fn を実行する Future を返す"""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def map(self, fn, items):
+        """items の各要素に fn を並列適用し、入力順の結果リストを返す"""
+        return list(self._executor.map(fn, items))
+
+    def report(self):
+        s = self.stats
+        return (f"📊 LLM: {s['requests']}リクエスト / リトライ {s['retries']}回 / 429 {s['rate_limited']}回 / "
+                f"トークン {s['prompt_tokens']}+{s['completion_tokens']}")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
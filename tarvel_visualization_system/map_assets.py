@@ -0,0 +1,127 @@
+"""
+地図HTMLに埋め込むアイコン・GIF画像を1回だけ出力するための共有アセット表
+
+マーカーやポップアップは画像そのものではなくキー（ファイルパスから決まる "a1b2c3d4e5" のような文字列）
+だけを持ち、ブラウザ側で表 travel_assets からアイコンや <img> の src を引く。
+キーは実行をまたいで変わらないので、旅行記ごとに描画結果をキャッシュしても使い回せる。
+- mode="inline": 画像を Base64 で HTML に1回ずつ埋め込む
+- mode="files" : 画像を HTML と同じ階層の asset_dir にコピーし、相対パスで参照する
+"""
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from functools import lru_cache
+
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+@lru_cache(maxsize=None)
+def read_as_data_uri(file_path):
+    """画像ファイルを読み込み、data URI を返す（同じファイルは1回しか読まない）。無ければ None"""
+    try:
+        with open(file_path, "rb") as f:
+            encoded_string = base64.b64encode(f.read()).decode("utf-8")
+    except FileNotFoundError:
+        print(f"[WARNING] 画像ファイルが見つかりません: {file_path}")
+        return None
+    mime = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    return f"data:{mime};base64,{encoded_string}"
+
+
+@lru_cache(maxsize=None)
+def asset_exists(file_path):
+    return os.path.exists(file_path)
+
+
+class AssetTable(MacroElement):
+    """地図に1つだけ追加する、画像アセットとアイコンの共有表"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var travel_assets = {}, travel_icons = {};
+            {{ this.pending_script() }}
+            {{ this._parent.get_name() }}.on('popupopen', function(e) {
+                e.popup.getElement().querySelectorAll('img[data-asset]').forEach(function(img) {
+                    if (!img.getAttribute('src')) { img.src = travel_assets[img.dataset.asset]; }
+                });
+            });
+        {% endmacro %}
+    """)
+
+    def __init__(self, mode="inline", output_html=None, asset_dir="map_assets"):
+        super(AssetTable, self).__init__()
+        self._name = 'AssetTable'
+        self.mode = mode
+        self.output_dir = os.path.dirname(os.path.abspath(output_html)) if output_html else os.getcwd()
+        self.asset_dir = asset_dir
+        self._keys = {}  # ファイルパス -> キー
+        self._icons = {}  # アイコンキー -> (アセットキー, サイズ)
+        self._written = set()  # 出力済みのキー（地図を少しずつ書き出すときに使う）
+
+    def asset_key(self, file_path):
+        """画像を表に登録してキーを返す。ファイルが無ければ None"""
+        if file_path in self._keys:
+            return self._keys[file_path]
+        if not asset_exists(file_path):
+            return None
+        key = "a" + hashlib.sha1(file_path.encode("utf-8")).hexdigest()[:10]
+        self._keys[file_path] = key
+        return key
+
+    def icon_key(self, file_path, size):
+        """アイコン画像とサイズの組を登録してキーを返す。ファイルが無ければ None"""
+        asset_key = self.asset_key(file_path)
+        if asset_key is None:
+            return None
+        key = f"{asset_key}@{size[0]}x{size[1]}"
+        self._icons[key] = (asset_key, size)
+        return key
+
+    def img_tag(self, file_path, alt, style):
+        """src を後から埋める <img> タグ。ファイルが無ければ空文字"""
+        asset_key = self.asset_key(file_path)
+        if asset_key is None:
+            return ""
+        return f'<img data-asset="{asset_key}" alt="{alt}" style="{style}">'
+
+    def _url(self, file_path):
+        if self.mode == "inline":
+            return read_as_data_uri(file_path)
+        target_dir = os.path.join(self.output_dir, self.asset_dir)
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, os.path.basename(file_path))
+        if not os.path.exists(target) or os.path.getsize(target) != os.path.getsize(file_path):
+            shutil.copyfile(file_path, target)
+        return f"{self.asset_dir}/{os.path.basename(file_path)}"
+
+    def pending_script(self):
+        """まだ出力していない画像とアイコンを travel_assets / travel_icons に登録するスクリプト"""
+        lines = []
+        assets = {key: self._url(path) for path, key in self._keys.items() if key not in self._written}
+        if assets:
+            lines.append(f"Object.assign(travel_assets, {json.dumps(assets, ensure_ascii=False)});")
+        for key, (asset_key, size) in self._icons.items():
+            if key not in self._written:
+                lines.append(f"travel_icons[{json.dumps(key)}] = L.icon({{iconUrl: travel_assets[{json.dumps(asset_key)}], iconSize: [{size[0]}, {size[1]}]}});")
+        self._written.update(assets)
+        self._written.update(self._icons)
+        return "\n".join(lines)
+
+
+class SharedIcon(MacroElement):
+    """マーカーのアイコンを共有表 travel_icons から設定する（Marker の子要素として追加する）"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this._parent.get_name() }}.setIcon(travel_icons[{{ this.key|tojson }}]);
+        {% endmacro %}
+    """)
+
+    def __init__(self, key):
+        super(SharedIcon, self).__init__()
+        self._name = 'SharedIcon'
+        self.key = key
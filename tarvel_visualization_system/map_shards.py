@@ -0,0 +1,188 @@
+"""
+地図を「小さな索引HTML + シャード（旅行記ごと or 都道府県ごとの GeoJSON）」に分けて出力する
+
+索引HTMLにはレイヤーの枠（空の FeatureGroup）とシャードの範囲(bbox)だけを書き、
+軌跡・滞在地・移動手段の中身は <HTML名>_shards/<シャードID>.js に GeoJSON として書き出す。
+ブラウザはレイヤーがオンで、かつ表示範囲がシャードの範囲と重なったときに初めてシャードを読み込む。
+file:// で開いても読み込めるように、シャードは travelShards.register(...) を呼ぶ JSONP 形式にする。
+inline=True のときはファイルに分けず、同じ register(...) 呼び出しを索引HTMLに埋め込む
+（layer_panel.py のようにレイヤーを後から作るだけで、HTMLは1つにしたい場合）。
+
+滞在地・移動手段の Point の properties は FastMarkers の行と同じ
+（icon: アイコンキー, tooltip, popup: HTML 文字列 or 遅延読み込み用の [旅行記番号, 通し番号]）。
+"""
+import json
+import math
+import os
+import re
+
+from branca.element import MacroElement
+from jinja2 import Template
+
+from fast_markers import ADD_LAYERS_JS
+
+
+def shard_file_name(shard_id):
+    """シャードIDをファイル名に使える形にする（日本語はそのまま残す）"""
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", str(shard_id)) or "_"
+
+
+class ShardLoader(MacroElement):
+    """地図に1つだけ追加する、シャードの書き出しと読み込み・描画用のスクリプト"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this.add_layers_js }}
+            var travelShards = {data: {}, pending: {}, base: {{ this.shard_url|tojson }}, mode: {{ this.marker_mode|tojson }}};
+            travelShards.register = function(file, collection) {
+                travelShards.data[file] = collection;
+                (travelShards.pending[file] || []).forEach(function(cb) { cb(collection); });
+                delete travelShards.pending[file];
+            };
+            travelShards.load = function(file, cb) {
+                if (travelShards.data[file]) { cb(travelShards.data[file]); return; }
+                if (travelShards.pending[file]) { travelShards.pending[file].push(cb); return; }
+                travelShards.pending[file] = [cb];
+                var s = document.createElement('script');
+                s.src = travelShards.base + encodeURIComponent(file) + '.js';
+                document.head.appendChild(s);
+            };
+            travelShards.populate = function(group, collection, layerName, journal) {
+                var layers = [];
+                collection.features.forEach(function(f) {
+                    var p = f.properties, c = f.geometry.coordinates, mk;
+                    if (p.layer !== layerName || (journal !== undefined && p.journal !== journal)) { return; }
+                    if (f.geometry.type === 'MultiLineString') {
+                        layers.push(L.polyline(c.map(function(line) { return line.map(function(xy) { return [xy[1], xy[0]]; }); }),
+                            {color: p.color, weight: 5, opacity: 0.7}));
+                        return;
+                    }
+                    if (travelShards.mode === 'canvas') {
+                        travelShards.renderer = travelShards.renderer || L.canvas({padding: 0.5});
+                        mk = L.circleMarker([c[1], c[0]], {renderer: travelShards.renderer, radius: p.layer === 'move' ? 3 : 5,
+                            color: p.color, weight: 1, fillOpacity: 0.8});
+                    } else {
+                        mk = p.icon ? L.marker([c[1], c[0]], {icon: travel_icons[p.icon]}) : L.marker([c[1], c[0]]);
+                    }
+                    mk.bindTooltip(p.tooltip);
+                    if (typeof p.popup === 'string') {
+                        mk.bindPopup(p.popup, {maxWidth: 350});
+                    } else {
+                        mk.bindPopup('読み込み中…', {maxWidth: 350});
+                        mk.travelPopupId = p.popup;
+                    }
+                    layers.push(mk);
+                });
+                travelAddLayers(group, layers);
+            };
+            {{ this.pending_inline_script() }}
+        {% endmacro %}
+    """)
+
+    def __init__(self, output_html, marker_mode="markers", inline=False):
+        super(ShardLoader, self).__init__()
+        self._name = 'ShardLoader'
+        stem = os.path.splitext(os.path.basename(output_html))[0]
+        self.shard_dir = os.path.join(os.path.dirname(os.path.abspath(output_html)), f"{stem}_shards")
+        self.shard_url = f"{stem}_shards/"
+        self.marker_mode = marker_mode
+        self.inline = inline
+        self.add_layers_js = ADD_LAYERS_JS
+        self._inline = {}  # inline=True のとき、ファイル名 -> 書き出し済みの GeoJSON 文字列
+        self._features = {}  # シャードID -> 書き出し前の Feature のリスト
+        self._bounds = {}  # シャードID -> [[南, 西], [北, 東]]
+
+    def add_journal(self, shard_id, file_num, color, route_paths, stop_rows, move_rows):
+        """
+        旅行記1件分の軌跡と、FastMarkers と同じ形式の行をシャードに追加し、
+        その旅行記の範囲 [[南, 西], [北, 東]]（点が無ければ None）を返す
+        """
+        features = self._features.setdefault(shard_id, [])
+        journal = str(file_num)
+        if route_paths:
+            features.append({
+                "type": "Feature", "properties": {"layer": "route", "journal": journal, "color": color},
+                "geometry": {"type": "MultiLineString", "coordinates": [[[lon, lat] for lat, lon in path] for path in route_paths]},
+            })
+        for layer, rows, row_color in (("route", stop_rows, color), ("move", move_rows, "black")):
+            for lat, lon, icon, tooltip, popup in rows:
+                features.append({
+                    "type": "Feature",
+                    "properties": {"layer": layer, "journal": journal, "color": row_color, "icon": icon, "tooltip": tooltip, "popup": popup},
+                    "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                })
+        points = [(lat, lon) for path in route_paths for lat, lon in path] + [(row[0], row[1]) for row in stop_rows + move_rows]
+        if not points:
+            return None
+        lats, lons = [p[0] for p in points], [p[1] for p in points]
+        journal_bounds = [[min(lats), min(lons)], [max(lats), max(lons)]]
+        bounds = self._bounds.setdefault(shard_id, [[math.inf, math.inf], [-math.inf, -math.inf]])
+        bounds[0] = [min(bounds[0][0], journal_bounds[0][0]), min(bounds[0][1], journal_bounds[0][1])]
+        bounds[1] = [max(bounds[1][0], journal_bounds[1][0]), max(bounds[1][1], journal_bounds[1][1])]
+        return journal_bounds
+
+    def bounds(self, shard_id):
+        """シャードの範囲。点が無ければ None"""
+        return self._bounds.get(shard_id)
+
+    def flush(self, shard_id):
+        """シャード1つ分を書き出し、メモリから解放する"""
+        features = self._features.pop(shard_id, None)
+        if features is None:
+            return
+        file = shard_file_name(shard_id)
+        collection = {"type": "FeatureCollection", "features": features}
+        if self.inline:
+            # HTMLの <script> 内に埋め込むので "</script>" で途切れないようにする
+            self._inline[file] = json.dumps(collection, ensure_ascii=False, separators=(',', ':')).replace("</", "<\\/")
+            return
+        os.makedirs(self.shard_dir, exist_ok=True)
+        with open(os.path.join(self.shard_dir, f"{file}.js"), "w", encoding="utf-8") as f:
+            f.write(f"travelShards.register({json.dumps(file)}, {json.dumps(collection, ensure_ascii=False, separators=(',', ':'))});\n")
+
+    def flush_all(self):
+        for shard_id in list(self._features):
+            self.flush(shard_id)
+
+    def pending_inline_script(self):
+        """inline=True で書き出し済みのシャードを登録するスクリプト（返したものはメモリから解放する）"""
+        script = "\n".join(f"travelShards.register({json.dumps(file)}, {collection});" for file, collection in self._inline.items())
+        self._inline.clear()
+        return script
+
+
+class ShardLayer(MacroElement):
+    """
+    空のレイヤーに、オンでかつ表示範囲と重なったときだけシャードの中身を読み込ませる
+    （FeatureGroup / FeatureGroupSubGroup の子要素として追加する）
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var group = {{ this._parent.get_name() }}, map = {{ this._parent._parent.get_name() }};
+                var bounds = {{ this.loader.bounds(this.shard_id)|tojson }}, loaded = false;
+                if (!bounds) { return; }
+                bounds = L.latLngBounds(bounds);
+                function check() {
+                    if (loaded || !map.hasLayer(group) || !map.getBounds().intersects(bounds)) { return; }
+                    loaded = true;
+                    map.off('moveend', check);
+                    travelShards.load({{ this.file|tojson }}, function(collection) {
+                        travelShards.populate(group, collection, {{ this.layer|tojson }});
+                    });
+                }
+                map.on('moveend', check);
+                group.on('add', check);
+                check();
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, loader, shard_id, layer):
+        super(ShardLayer, self).__init__()
+        self._name = 'ShardLayer'
+        self.loader = loader
+        self.shard_id = shard_id
+        self.file = shard_file_name(shard_id)
+        self.layer = layer
@@ -0,0 +1,101 @@
+"""
+地図HTMLの書き出し
+
+通常は要素をすべて地図に追加してから m.save() で1回で書き出すので、旅行記が数千件あると
+folium のオブジェクトツリーと、それを描画したHTML全体が同時にメモリに載る。
+stream=True のときは地図の骨組み（タイル・共有画像表・ローダー類）を先にファイルへ書き出し、
+旅行記ごとのレイヤーはできた時点で <script> として追記して地図から外す。
+メモリに残るのは旅行記1件分のレイヤーと、レイヤーコントロールに登録するための変数名だけになる。
+レイヤーコントロールやヒートマップなど全体を参照する要素は finish() で最後に書き出す。
+"""
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+class StreamedOverlays(MacroElement):
+    """書き出し済みで地図から外したレイヤーを、JS変数名でレイヤーコントロールに登録する"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {%- for name, label in this.overlays %}
+            {{ this.layer_control.get_name() }}.addOverlay({{ name }}, {{ label|tojson }});
+            {%- endfor %}
+        {% endmacro %}
+    """)
+
+    def __init__(self, layer_control, overlays):
+        super(StreamedOverlays, self).__init__()
+        self._name = 'StreamedOverlays'
+        self.layer_control = layer_control
+        self.overlays = overlays  # [(JS変数名, 表示名), ...]
+
+
+class MapWriter:
+    """
+    start() → 旅行記ごとに add_layers() → finish() の順に呼ぶ。
+    pending には、各 <script> の先頭に書き出すスクリプトを返す関数を渡す
+    （AssetTable.pending_script など。そこまでに登録された画像だけを追記する）。
+    """
+
+    def __init__(self, m, output_html, stream=False, pending=()):
+        self.m = m
+        self.output_html = output_html
+        self.stream = stream
+        self.pending = list(pending)
+        self.overlays = []  # 書き出し済みのレイヤーの (JS変数名, 表示名)
+        self._file = None
+        self._written = set()  # 書き出し済みの地図の子要素
+        self._header_written = set()  # 書き出し済みの <head> の要素（JS/CSSの読み込み）
+
+    def start(self):
+        """地図の骨組みを書き出す（stream=False なら何もしない）"""
+        if not self.stream:
+            return
+        figure = self.m.get_root()
+        html = figure.render()
+        self._file = open(self.output_html, "w", encoding="utf-8")
+        self._file.write(html[:html.rindex("</html>")])
+        self._written = set(self.m._children)
+        self._header_written = set(figure.header._children)
+        figure.script._children.clear()
+
+    def add_layers(self, *layers):
+        """旅行記1件分のレイヤーを地図に追加する（stream=True ならすぐに書き出して地図から外す）"""
+        for layer in layers:
+            self.m.add_child(layer)
+        if not self.stream:
+            return
+        self._write(layers)
+        for layer in layers:
+            del self.m._children[layer.get_name()]
+            self.overlays.append((layer.get_name(), layer.layer_name))
+
+    def finish(self, *elements, layer_control=None):
+        """残りの要素を追加して書き出しを終える"""
+        for element in elements:
+            self.m.add_child(element)
+        if not self.stream:
+            self.m.save(self.output_html)
+            return
+        if layer_control and self.overlays:
+            self.m.add_child(StreamedOverlays(layer_control, self.overlays))
+        self._write([child for name, child in self.m._children.items() if name not in self._written])
+        self._file.write("</html>\n")
+        self._file.close()
+        self._file = None
+
+    def _write(self, elements):
+        figure = self.m.get_root()
+        for element in elements:
+            element.render()
+        scripts = [script() for script in self.pending]
+        scripts += [child.render() for child in figure.script._children.values()]
+        figure.script._children.clear()
+        # 途中で初めて使われたプラグインの JS/CSS は、使う <script> の直前に読み込む
+        for name, child in figure.header._children.items():
+            if name not in self._header_written:
+                self._file.write(child.render() + "\n")
+                self._header_written.add(name)
+        scripts = [script for script in scripts if script.strip()]
+        if scripts:
+            self._file.write("<script>\n" + "\n".join(scripts) + "\n</script>\n")
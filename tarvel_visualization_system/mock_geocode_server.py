@@ -0,0 +1,90 @@
+"""
+Nominatim / 国土地理院(GSI) のジオコーディングAPIを模擬するローカルサーバー（動作確認用）
+
+    python mock_geocode_server.py --port 8801 --latency 0.1 0.4
+    NOMINATIM_URL=http://127.0.0.1:8801/search GSI_URL=http://127.0.0.1:8801/address-search/AddressSearch python travelogue.py
+
+Nominatim に1秒1リクエストを超えて問い合わせた回数を「レート違反」として数える。
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_coords(query):
+    """地名から決定的に日本国内のそれらしい座標を作る"""
+    digest = hashlib.md5(query.encode("utf-8")).digest()
+    return 31.0 + digest[0] / 255 * 12.0, 130.0 + digest[1] / 255 * 12.0
+
+
+class MockState:
+    def __init__(self, latency, not_found_rate):
+        self.latency = latency
+        self.not_found_rate = not_found_rate
+        self.lock = threading.Lock()
+        self.last_nominatim = 0.0
+        self.counts = {"nominatim": 0, "gsi": 0, "nominatim_rate_violations": 0}
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive を有効にする
+
+        def _send(self, payload):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query).get("q", [""])[0]
+            not_found = random.random() < state.not_found_rate
+            lat, lon = fake_coords(query)
+            if url.path.endswith("/search"):
+                with state.lock:
+                    now = time.monotonic()
+                    if now - state.last_nominatim < 1.0:
+                        state.counts["nominatim_rate_violations"] += 1
+                    state.last_nominatim = now
+                    state.counts["nominatim"] += 1
+                time.sleep(random.uniform(*state.latency))
+                self._send([] if not_found else [{"lat": str(lat), "lon": str(lon), "display_name": query}])
+            else:
+                with state.lock: state.counts["gsi"] += 1
+                time.sleep(random.uniform(*state.latency))
+                self._send([] if not_found else [{"geometry": {"coordinates": [lon, lat], "type": "Point"},
+                                                  "type": "Feature", "properties": {"title": query}}])
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ジオコーディングAPIのモックサーバー")
+    parser.add_argument("--port", type=int, default=8801)
+    parser.add_argument("--latency", type=float, nargs=2, default=(0.1, 0.4), metavar=("MIN", "MAX"))
+    parser.add_argument("--not-found-rate", type=float, default=0.2, help="空の結果を返す確率")
+    args = parser.parse_args()
+
+    state = MockState(tuple(args.latency), args.not_found_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(state))
+    print(f"🧪 ジオコーディングのモックサーバーを起動しました: http://127.0.0.1:{args.port} (Ctrl+Cで終了)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"📊 問い合わせ数: {state.counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+openai の読み込みとAPIキーの確認を、APIを実際に呼ぶときまで遅らせる
+
+openai の import は重く（それだけで0.5秒ほどかかる）、APIキーも必要になる。
+travelogue.py / routeonly.py は ChatCompletion.create の代わりに chat_completion を使うので、
+キャッシュから地図を作り直すだけの実行や、応答がすべてキャッシュにある実行では
+openai を読み込まず、APIキーが無くても動く。
+"""
+import os
+import sys
+import threading
+
+_lock = threading.Lock()
+
+
+class MissingAPIKeyError(ValueError):
+    """APIを呼ぶ必要があるのにAPIキーが設定されていない"""
+
+
+def load_openai():
+    """.env を読み込んでAPIキーを確認し、キーを設定した openai モジュールを返す"""
+    with _lock:
+        import openai
+        if not openai.api_key:
+            from dotenv import load_dotenv
+            load_dotenv()
+            api_key = os.getenv('OPENAI_API_KEY')
+            if not api_key:
+                raise MissingAPIKeyError("OpenAIのAPIキーが設定されていません。.envファイルを確認してください。")
+            openai.api_key = api_key
+        return openai
+
+
+def chat_completion(**kwargs):
+    """openai.ChatCompletion.create と同じ（初めて呼ばれたときに openai を読み込む）"""
+    return load_openai().ChatCompletion.create(**kwargs)
+
+
+def authentication_errors():
+    """
+    except 節に書く認証エラーの型のタプル。
+    openai をまだ読み込んでいなければ、APIキーが無いときのエラーだけになる
+    """
+    openai = sys.modules.get("openai")
+    if openai is None:
+        return (MissingAPIKeyError,)
+    return (MissingAPIKeyError, openai.error.AuthenticationError)
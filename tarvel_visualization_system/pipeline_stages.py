@@ -0,0 +1,102 @@
+"""
+旅行記処理のステージごとのチェックポイント
+
+処理を 抽出(extract) → ジオコーディング(geocode) → タグ付け(tag) → 描画(render) に分け、
+ステージごとの出力を pipeline_cache/<ステージ>/<旅行記番号>.json に保存する。
+キーはそのステージの入力と設定、それにプロンプトを含む関数のソースコードのハッシュなので、
+- タグ付けのプロンプトや ACTION_TAGS を変えたときは tag だけをやり直す
+- ジオコーダーを変えたときは geocode だけをやり直す（LLMの結果はそのまま）
+- 描画の設定だけを変えたときはAPIを一切呼ばない（render は render_fragments.py の描画キャッシュ）
+ようになる。ステージは --stages で選んで単独でも実行できる。
+"""
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import os
+
+from cache_files import write_json_atomic
+
+STAGES = ["extract", "geocode", "tag", "render"]
+
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint(*functions):
+    """関数のソースコード（プロンプトを含む）のハッシュ。書き換えるとそのステージのキーが変わる"""
+    source = "\n".join(inspect.getsource(function) for function in functions)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def stage_key(*parts):
+    """入力と設定から、チェックポイントのキー（SHA-256）を作る"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def parse_stages(text):
+    """"extract,geocode" のようなカンマ区切りをステージのリストにする"""
+    stages = [stage.strip() for stage in text.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"不明なステージです: {', '.join(unknown)}（{', '.join(STAGES)} から選んでください）")
+    return stages
+
+
+class StageCheckpoints:
+    def __init__(self, directory="pipeline_cache"):
+        self.directory = directory
+        self.stats = {stage: {"hits": 0, "runs": 0} for stage in STAGES}
+
+    def _path(self, stage, file_num):
+        return os.path.join(self.directory, stage, f"{file_num}.json")
+
+    def exists(self, stage, file_num):
+        """キーに関係なく、そのステージのチェックポイントがあれば True"""
+        return os.path.exists(self._path(stage, file_num))
+
+    def _read(self, stage, file_num):
+        try:
+            with open(self._path(stage, file_num), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def get(self, stage, file_num, key):
+        """キーが一致するチェックポイントの中身を返す。無い・古い・壊れているときは None"""
+        cached = self._read(stage, file_num)
+        if cached and cached.get("key") == key:
+            self.stats[stage]["hits"] += 1
+            return cached["data"]
+        return None
+
+    def latest(self, stage, file_num):
+        """キーに関係なく、最後に保存したチェックポイントの中身を返す（入力が無くなりキーを作れないとき用）"""
+        cached = self._read(stage, file_num)
+        if cached:
+            self.stats[stage]["hits"] += 1
+            return cached["data"]
+        return None
+
+    def put(self, stage, file_num, key, data, seeded=False):
+        """ステージを実行した結果を保存する（seeded=True は以前の完成データからの登録で、実行数に数えない）"""
+        if not seeded:
+            self.stats[stage]["runs"] += 1
+        write_json_atomic(self._path(stage, file_num), {"key": key, "data": data}, ensure_ascii=False, separators=(',', ':'))
+
+    def take_stats(self):
+        """ここまでの集計を返してゼロに戻す（ワーカープロセスから親に渡す用）"""
+        stats, self.stats = self.stats, {stage: {"hits": 0, "runs": 0} for stage in STAGES}
+        return stats
+
+    def merge_stats(self, stats):
+        for stage, s in stats.items():
+            self.stats[stage]["hits"] += s["hits"]
+            self.stats[stage]["runs"] += s["runs"]
+
+    def report(self):
+        lines = ["🧱 ステージのチェックポイント:"]
+        for stage, s in self.stats.items():
+            if s["hits"] or s["runs"]:
+                lines.append(f"   {stage}: 再利用 {s['hits']}件 / 実行 {s['runs']}件")
+        return "\n".join(lines)
@@ -0,0 +1,58 @@
+"""
+ジオコーディング前に、バッチ全体の滞在地を (地名, region_hint) で名寄せする
+
+「京都駅」「京都 駅」「ｷｮｳﾄ駅」のような表記揺れや、「駅」「駅前」・「IC」「インター」のような
+同じ種別の接尾辞の違いを同じキーにまとめ、ユニークなキーごとに1回だけジオコーディングできるようにする。
+"""
+import re
+from collections import Counter, defaultdict
+
+from geocode_cache import normalize_place_name
+from gazetteer import normalize_prefecture
+
+# 接尾辞 → 種別。取り除いた接尾辞の種別もキーに入れ、同じ種別の表記揺れだけをまとめる
+# （「京都」と「京都駅」、「多賀」と「多賀SA」のように、種別が違えば座標も違うのでまとめない）
+PLACE_SUFFIXES = {
+    "バスターミナル": "bus", "バス停": "bus", "停留所": "bus",
+    "駅前": "station", "駅": "station",
+    "インターチェンジ": "interchange", "インター": "interchange",
+    "サービスエリア": "service_area", "パーキングエリア": "parking_area",
+}
+_SUFFIX_ORDER = sorted(PLACE_SUFFIXES, key=len, reverse=True)  # 長いものから順に判定する
+# 英字の略称（ＩＣ・ＳＡ・ＰＡ）は、空白か日本語の直後にある独立した語のときだけ取り除く
+# （"ibusa" や "spa" のような英字の地名の語尾は残す）
+LATIN_SUFFIX = re.compile(r"(?:(?<=[^a-z0-9\s])|\s+)(ic|sa|pa)$")
+LATIN_KINDS = {"ic": "interchange", "sa": "service_area", "pa": "parking_area"}
+
+
+def place_dedup_key(name, region_hint):
+    """名寄せ用のキー (正規化地名, 種別, 正規化都道府県) を返す。種別は取り除いた接尾辞の種類（無ければ ""）"""
+    name = normalize_place_name(name)
+    kind = ""
+    for suffix in _SUFFIX_ORDER:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            name, kind = name[: -len(suffix)], PLACE_SUFFIXES[suffix]
+            break
+    else:
+        match = LATIN_SUFFIX.search(name)
+        if match:
+            name, kind = name[: match.start()], LATIN_KINDS[match.group(1)]
+    return re.sub(r"\s+", "", name), kind, normalize_prefecture(region_hint or "")
+
+
+def group_stops(journals):
+    """
+    旅行記のリストから、キーごとに (滞在イベント, region_hint) をまとめた辞書を返す。
+    journals の各要素は "events" と "region_hint" を持つ。
+    """
+    groups = defaultdict(list)
+    for journal in journals:
+        for event in journal.get("events", []):
+            if event.get("type") == "stop" and event.get("place"):
+                groups[place_dedup_key(event["place"], journal.get("region_hint"))].append((event, journal.get("region_hint")))
+    return groups
+
+
+def representative(members):
+    """グループ内で最も多く使われている (地名, region_hint) を問い合わせに使う"""
+    return Counter((event["place"], region_hint) for event, region_hint in members).most_common(1)[0][0]
@@ -0,0 +1,89 @@
+"""
+都道府県の境界ポリゴン（GeoJSON）による点の包含判定
+
+GPTが推定した座標が region_hint の都道府県内にあるかをネットワークなしで確かめる。
+ポリゴンの辺を緯度方向の帯(band)ごとに振り分けておき、判定する点の帯の辺だけで
+レイキャスティング（偶奇規則）を行うので、1回の判定はマイクロ秒単位で終わる。
+
+GeoJSON は都道府県ごとの Polygon / MultiPolygon の FeatureCollection を想定する
+（都道府県名のプロパティは nam_ja / name / N03_001 のいずれか）。
+国土数値情報の行政区域データ(N03)からは build_prefecture_boundaries.py で作る。
+"""
+import json
+import math
+import os
+
+from gazetteer import normalize_prefecture
+
+NAME_PROPERTIES = ("nam_ja", "name", "N03_001")
+
+
+class PrefectureIndex:
+    def __init__(self, band=0.02):
+        self.band = band
+        self._prefectures = {}  # 正規化名 -> {"bbox": [min_lon, min_lat, max_lon, max_lat], "bands": {帯番号: [辺, ...]}}
+
+    @classmethod
+    def load(cls, path, band=0.02):
+        index = cls(band)
+        with open(path, "r", encoding="utf-8") as f:
+            collection = json.load(f)
+        for feature in collection.get("features", []):
+            properties = feature.get("properties") or {}
+            name = next((properties[key] for key in NAME_PROPERTIES if properties.get(key)), None)
+            geometry = feature.get("geometry") or {}
+            if not name:
+                continue
+            if geometry.get("type") == "Polygon":
+                polygons = [geometry["coordinates"]]
+            elif geometry.get("type") == "MultiPolygon":
+                polygons = geometry["coordinates"]
+            else:
+                continue
+            for rings in polygons:
+                index.add_polygon(name, rings)
+        print(f"🗾 都道府県の境界を読み込みました: {path} ({len(index._prefectures)}件)")
+        return index
+
+    def add_polygon(self, prefecture, rings):
+        """rings は GeoJSON と同じ [[経度, 緯度], ...] のリング（外周と穴）のリスト"""
+        entry = self._prefectures.setdefault(normalize_prefecture(prefecture), {
+            "bbox": [math.inf, math.inf, -math.inf, -math.inf], "bands": {},
+        })
+        bbox, bands = entry["bbox"], entry["bands"]
+        for ring in rings:
+            for p1, p2 in zip(ring, ring[1:] + ring[:1]):
+                (x1, y1), (x2, y2) = p1[:2], p2[:2]
+                bbox[0], bbox[1] = min(bbox[0], x1), min(bbox[1], y1)
+                bbox[2], bbox[3] = max(bbox[2], x1), max(bbox[3], y1)
+                if y1 == y2:
+                    continue  # 水平な辺は交差判定に関係しない
+                edge = (x1, y1, x2, y2)
+                for b in range(math.floor(min(y1, y2) / self.band), math.floor(max(y1, y2) / self.band) + 1):
+                    bands.setdefault(b, []).append(edge)
+
+    def knows(self, prefecture):
+        return normalize_prefecture(prefecture or "") in self._prefectures
+
+    def contains(self, prefecture, lat, lon):
+        """(lat, lon) が都道府県内なら True。境界データの無い都道府県なら None"""
+        entry = self._prefectures.get(normalize_prefecture(prefecture or ""))
+        if entry is None:
+            return None
+        min_lon, min_lat, max_lon, max_lat = entry["bbox"]
+        if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+            return False
+        inside = False
+        for x1, y1, x2, y2 in entry["bands"].get(math.floor(lat / self.band), ()):
+            if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+
+def load_prefecture_index(path):
+    """ファイルがあれば PrefectureIndex を、なければ None を返す"""
+    if not path or not os.path.exists(path):
+        print(f"[WARNING] 都道府県の境界データが見つからないため、GPT推定座標の事前検証は使いません: {path}\n"
+              f"          国土数値情報の行政区域データ(N03)から python build_prefecture_boundaries.py <N03のGeoJSON> で作成してください。")
+        return None
+    return PrefectureIndex.load(path)
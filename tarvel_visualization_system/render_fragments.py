@@ -0,0 +1,86 @@
+"""
+旅行記ごとの描画結果（フラグメント）のキャッシュ
+
+地図の作り直しでは、旅行記ごとに「マーカーの行・軌跡・ポップアップデータ・ヒートマップ用の点・
+使った画像」をフラグメントとして render_cache/<旅行記番号>.json に保存しておく。
+キーは旅行記のキャッシュJSONと描画設定のハッシュなので、旅行記を1件追加しただけなら
+その1件だけを描画し直し、残りはフラグメントをつなぎ合わせるだけで済む。
+"""
+import hashlib
+import json
+import os
+
+from cache_files import write_json_atomic
+
+FRAGMENT_VERSION = 2  # フラグメントの形式を変えたら上げる（2: ポップアップ・ツールチップの文字列をエスケープ）
+
+
+def fragment_key(travel, render_config):
+    """旅行記データと描画設定から、フラグメントのキー（SHA-256）を作る"""
+    payload = json.dumps([FRAGMENT_VERSION, travel, render_config], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FragmentCache:
+    def __init__(self, directory="render_cache"):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, file_num):
+        return os.path.join(self.directory, f"{file_num}.json")
+
+    def get(self, file_num, key):
+        """キーが一致するフラグメントを返す。無い・古い・壊れているときは None"""
+        try:
+            with open(self._path(file_num), "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            cached = None
+        if cached and cached.get("key") == key:
+            self.hits += 1
+            return cached["fragment"]
+        self.misses += 1
+        return None
+
+    def put(self, file_num, key, fragment):
+        write_json_atomic(self._path(file_num), {"key": key, "fragment": fragment}, ensure_ascii=False, separators=(',', ':'))
+
+    def report(self):
+        print(f"🧩 描画キャッシュ: 再利用 {self.hits}件 / 描画し直し {self.misses}件")
+
+
+class AssetRecorder:
+    """
+    AssetTable と同じ呼び方で画像を登録しつつ、フラグメントが使った画像を記録する。
+    キャッシュから読んだフラグメントは replay() で同じ画像を表に登録し直す。
+    """
+
+    def __init__(self, assets):
+        self.assets = assets
+        self.used = []  # [[ファイルパス, [幅, 高さ] or None], ...]
+
+    def _use(self, file_path, size):
+        entry = [file_path, list(size) if size else None]
+        if entry not in self.used:
+            self.used.append(entry)
+
+    def asset_key(self, file_path):
+        self._use(file_path, None)
+        return self.assets.asset_key(file_path)
+
+    def icon_key(self, file_path, size):
+        self._use(file_path, size)
+        return self.assets.icon_key(file_path, size)
+
+    def img_tag(self, file_path, alt, style):
+        self._use(file_path, None)
+        return self.assets.img_tag(file_path, alt, style)
+
+    @staticmethod
+    def replay(assets, used):
+        for file_path, size in used:
+            if size:
+                assets.icon_key(file_path, tuple(size))
+            else:
+                assets.asset_key(file_path)
@@ -0,0 +1,53 @@
+"""
+results_cache/ の完成データだけから、タグ別感情分析付きの地図を作り直す
+
+    python render_map.py 00018-10363 --output map.html
+    python render_map.py "*"              # results_cache/ にある旅行記すべて
+
+描画は travelogue.py の map_emotion_and_routes と描画設定（RENDER_MODE, MAP_OUTPUT_MODE など）をそのまま使う。
+APIは一切呼ばないので、openai・geopy は読み込まず、APIキー（.env）も要らない
+（requests は folium と travelogue.py のジオコーディング部分が読み込むが、通信はしない）。
+描画の設定だけを変えて地図を繰り返し作り直すときに使う（キャッシュに無い旅行記は travelogue.py で処理する）。
+"""
+import argparse
+import json
+
+import travelogue
+from batch_cli import parse_shard, resolve_ids, select_shard, read_id_file_interactively
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="キャッシュ済みの旅行記から地図だけを生成する（APIは呼ばない）")
+    parser.add_argument("ids", nargs="*",
+                        help="旅行記ID・範囲(00018-10363)・glob(results_cache/ の <ID>.json と照合)・IDを書いた.txt（省略するとファイルのパスを聞く）")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="i/N",
+                        help="IDを N 個に分けた i 番目(1始まり)だけを描画する")
+    parser.add_argument("--output", default=None, help="地図HTMLの出力先（既定: 描画したIDか日時から決める）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        file_nums = resolve_ids(args.ids, travelogue.CACHE_DIR, suffix=".json") if args.ids else read_id_file_interactively()
+    except Exception as e: print(f"[ERROR] 入力ファイルの読み込みに失敗: {e}"); return
+    file_nums = select_shard(file_nums, args.shard)
+
+    travels_data = []
+    for file_num in file_nums:
+        try:
+            travels_data.append(travelogue.load_cached_journal(file_num))
+        except FileNotFoundError:
+            print(f"[WARNING] [{file_num}] の完成データがありません（travelogue.py で処理してください）。")
+        except json.JSONDecodeError:
+            print(f"[WARNING] [{file_num}] の完成データを読み込めません。")
+    print(f"INFO: {len(file_nums)}件中 {len(travels_data)}件 の完成データを読み込みました。")
+
+    if travels_data:
+        travelogue.map_emotion_and_routes(travels_data, args.output or travelogue.default_output_filename(travels_data))
+    else:
+        print("\n地図を生成するための有効なデータがありませんでした。")
+
+
+if __name__ == '__main__':
+    main()
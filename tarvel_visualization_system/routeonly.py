@@ -1,10 +1,6 @@
-import openai
 import os
-from dotenv import load_dotenv
 import json
 import folium
-from folium.plugins import HeatMap
-from geopy.geocoders import Nominatim
 from collections import defaultdict
 import time
 import requests
@@ -13,21 +9,24 @@ from datetime import datetime
 import base64
 from branca.element import MacroElement
 from jinja2 import Template
-
-# .envファイルから環境変数を読み込む
-load_dotenv()
-API_KEY = os.getenv('OPENAI_API_KEY')
-if not API_KEY:
-    raise ValueError("OpenAIのAPIキーが設定されていません。.envファイルを確認してください。")
-openai.api_key = API_KEY
+from llm_cache import LLMCache, cached_completion
+from geocode_cache import GeocodeCache, MISS
+from routes import polyline_paths
+from batch_cli import parse_args, resolve_ids, select_shard, RunManifest, read_id_file_interactively
+from cache_files import write_json_atomic
+from openai_setup import chat_completion, authentication_errors
+from travel_events import EventStore, places_to_events, to_events, trace_points
 
 # ========== 設定 ==========
 directory = "../../2022-地球の歩き方旅行記データセット/data_arukikata/data/domestic/with_schedules/"
 base_name = "visited_places_map_emotion_"
 extension = ".html"
 CACHE_DIR = "results_cache_0707" ### ★★★ 機能追加: キャッシュ用ディレクトリ ★★★
+TRAVELOGUE_CACHE_DIR = "results_cache"  ### ★★★ 機能追加: travelogue.py の完成データ（ここにある旅行記はAPIを呼ばずに軌跡を描く） ★★★
+RUN_MANIFEST_PATH = os.path.join(CACHE_DIR, "manifest.jsonl")  ### ★★★ 機能追加: 旅行記ごとの処理結果の記録（--manifest で変更、--shard 指定時は shard ごとに別ファイル） ★★★
 COLORS = ['blue', 'red', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen', 'cadetblue', 'lightgray']
 WAIT_TIME = 1
+ROUTE_SIMPLIFY_TOLERANCE = 0  ### ★★★ 機能追加: 軌跡をDouglas–Peucker法で間引くときの許容誤差(度、0なら間引かない) ★★★
 MODEL = "gpt-4o"
 prefix = '```json'
 suffix = '```'
@@ -124,42 +123,40 @@ TAG_TO_GIF = {
 }
 # ========================================================
 
-geolocator = Nominatim(user_agent="travel-map-final")
+geolocator = None  ### ★★★ 機能追加: geopy は最初に問い合わせるときに読み込む（キャッシュだけで済む実行では使わない） ★★★
+### ★★★ 機能追加: travelogue.py と共有するキャッシュ（SQLite）は、最初に使うときに開く（完成データだけで済む実行では開かない） ★★★
+geocode_cache = None  # ジオコーディングキャッシュ
+llm_cache = None  # プロンプト単位の応答キャッシュ
+event_store = EventStore([CACHE_DIR, TRAVELOGUE_CACHE_DIR])  ### ★★★ 機能追加: 自分のキャッシュ → travelogue.py の完成データの順に探す ★★★
 
 # (既存の map_emotion_and_routes 関数と LayerToggleButtons クラスは削除してください)
 
 ### ★★★ 軌跡のみの地図を生成する新しい関数 ★★★
 def map_traces_only(travels_data, output_html):
-    """キャッシュデータから旅行記ごとの軌跡（線）のみを描画した地図を生成する"""
+    """キャッシュデータから旅行記ごとの軌跡（線）のみを描画した地図を生成する（events 形式・places 形式のどちらでもよい）"""
     if not travels_data:
         print("[ERROR] 地図に描画するデータがありません。")
         return
+    travels_data = [to_events(travel) for travel in travels_data]
+    traces = [trace_points(travel) for travel in travels_data]
 
-    # 地図の中心を最初の旅行記の開始地点に設定
-    try:
-        first_travel = travels_data[0]['places'][0]
-        start_coords = (first_travel['latitude'], first_travel['longitude'])
-        m = folium.Map(location=start_coords, zoom_start=10)
-    except (IndexError, KeyError):
-        # データがない場合は東京駅を中心にする
-        m = folium.Map(location=[35.6812, 139.7671], zoom_start=10)
+    # 地図の中心を最初の旅行記の開始地点に設定（データがない場合は東京駅を中心にする）
+    start_coords = next((locations[0] for locations in traces if locations), (35.6812, 139.7671))
+    m = folium.Map(location=start_coords, zoom_start=10)
 
     # 各旅行記の軌跡を地図に追加
-    for travel in travels_data:
+    for travel, locations in zip(travels_data, traces):
         file_num = travel["file_num"]
-        places = travel["places"]
         color = travel["color"]
 
-        # 軌跡を描画するための座標リスト
-        locations = [(p['latitude'], p['longitude']) for p in places if p.get('latitude') and p.get('longitude')]
-
         # 軌跡を格納するフィーチャーグループを作成（レイヤーコントロール用）
         trace_group = folium.FeatureGroup(name=f"旅行記ルート: {file_num}", show=True)
 
-        # 訪問地が2箇所以上ある場合のみ線を描画
-        if len(locations) > 1:
+        # 訪問地が2箇所以上ある場合のみ線を描画（travelogue.py と同じく1本の MultiPolyline にする）
+        paths = polyline_paths(locations, tolerance=ROUTE_SIMPLIFY_TOLERANCE)
+        if paths:
             folium.PolyLine(
-                locations,
+                paths,
                 color=color,
                 weight=5,
                 opacity=0.8
@@ -184,8 +181,19 @@ def get_image_as_base64(file_path):
     except FileNotFoundError:
         print(f"[WARNING] 画像ファイルが見つかりません: {file_path}")
         return None
+def start_geocode_cache():
+    global geocode_cache
+    if geocode_cache is None: geocode_cache = GeocodeCache()
+
+def start_llm_cache():
+    global llm_cache
+    if llm_cache is None: llm_cache = LLMCache()
+
 def geocode_gsi(name):
-    """国土地理院APIを使って地名の緯度経度を取得する"""
+    """国土地理院APIを使って地名の緯度経度を取得する（キャッシュにあれば問い合わせない）"""
+    start_geocode_cache()
+    cached = geocode_cache.get(name, "", "gsi")
+    if cached is not MISS: return cached
     try:
         query = urllib.parse.quote(name)
         url = f"https://msearch.gsi.go.jp/address-search/AddressSearch?q={query}"
@@ -193,21 +201,31 @@ def geocode_gsi(name):
         response = requests.get(url, timeout=10)
         response.raise_for_status()
         data = response.json()
+        coords = None
         if data and isinstance(data, list):
-            coords = data[0]['geometry']['coordinates']
-            lon, lat = coords[0], coords[1]
-            return lat, lon
+            lon, lat = data[0]['geometry']['coordinates'][:2]
+            coords = (lat, lon)
+        geocode_cache.put(name, "", "gsi", coords)
+        return coords
     except: return None
 
 def geocode_place(name, region_hint):
-    """Geopyを使って地名の緯度経度を取得する"""
+    """Geopyを使って地名の緯度経度を取得する（キャッシュにあれば問い合わせもsleepもしない）"""
+    global geolocator
+    start_geocode_cache()
+    cached = geocode_cache.get(name, region_hint, "nominatim")
+    if cached is not MISS: return cached
     try:
+        if geolocator is None:
+            from geopy.geocoders import Nominatim
+            geolocator = Nominatim(user_agent="travel-map-final")
         query = f"{name}, {region_hint}"
         print(f"🗺️ Geocoding (Geopy): '{query}'...")
         location = geolocator.geocode(query, timeout=10)
         time.sleep(WAIT_TIME)
-        if location:
-            return location.latitude, location.longitude
+        coords = (location.latitude, location.longitude) if location else None
+        geocode_cache.put(name, region_hint, "nominatim", coords)
+        return coords
     except: return None
 
 def extract_places(texts, region_hint):
@@ -225,8 +243,8 @@ def extract_places(texts, region_hint):
     ]
     テキスト: {texts}
     """
-    response = openai.ChatCompletion.create(model=MODEL, messages=[{"role": "system", "content": f"あなたは旅行記から訪問地を正確に抽出する優秀な旅行ガイドです。日本の「{region_hint}」に関する地理に詳しいです。"}, {"role": "user", "content": prompt}], temperature=0.5)
-    textforarukikata = response.choices[0].message.content.strip()
+    start_llm_cache()
+    textforarukikata = cached_completion(llm_cache, chat_completion, model=MODEL, messages=[{"role": "system", "content": f"あなたは旅行記から訪問地を正確に抽出する優秀な旅行ガイドです。日本の「{region_hint}」に関する地理に詳しいです。"}, {"role": "user", "content": prompt}], temperature=0.5).strip()
     if prefix in textforarukikata: textforarukikata = textforarukikata.split(prefix, 1)[1]
     if suffix in textforarukikata: textforarukikata = textforarukikata.rsplit(suffix, 1)[0]
     try:
@@ -242,9 +260,9 @@ def extract_places(texts, region_hint):
 def get_visit_hint(visited_places_text):
     if not visited_places_text.strip(): return "日本"
     messages = [{"role": "system", "content": "都道府県名を答えるときは，県名のみを答えてください．"}, {"role": "user", "content": f"以下の旅行記データから筆者が訪れたと考えられる都道府県を1つだけ答えてください．ただし，特定の語句に拘らずに旅行記全体から総合的に判断してください．\n\n{visited_places_text}"}]
+    start_llm_cache()
     try:
-        response = openai.ChatCompletion.create(model='gpt-3.5-turbo', messages=messages, temperature=0.2)
-        return response.choices[0].message.content.strip()
+        return cached_completion(llm_cache, chat_completion, model='gpt-3.5-turbo', messages=messages, temperature=0.2).strip()
     except: return "日本"
     
 ### ★★★ 機能変更 (1/2): exceptブロックを旧バージョン形式に修正 ★★★
@@ -282,8 +300,10 @@ def analyze_experience(text, move_tags_list, action_tags_list):
     ---
     テキスト: 「{text}」
     """
+    start_llm_cache()
     try:
-        response = openai.ChatCompletion.create(
+        content = cached_completion(
+            llm_cache, chat_completion,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": "あなたはテキストを多角的に分析し、指定されたJSON形式で感情スコアと複数種類のタグを正確に出力する専門家です。"},
@@ -292,7 +312,7 @@ def analyze_experience(text, move_tags_list, action_tags_list):
             temperature=0.1,
             response_format={"type": "json_object"}
         )
-        result = json.loads(response.choices[0].message.content)
+        result = json.loads(content)
         
         score = result.get("emotion_score", 0.5)
         move_tags = result.get("move_tags", [])
@@ -302,7 +322,7 @@ def analyze_experience(text, move_tags_list, action_tags_list):
         return {"emotion_score": score, "tags": all_tags}
     
     # 旧バージョン(v0.x)のopenaiライブラリ用のエラーハンドリング
-    except openai.error.AuthenticationError as e:
+    except authentication_errors() as e:
         print(f"[FATAL ERROR] OpenAI認証エラー: {e}")
         raise # エラーを再発生させ、mainのtry-exceptで捕捉する
     except Exception as e:
@@ -311,93 +331,120 @@ def analyze_experience(text, move_tags_list, action_tags_list):
 
 
 
+def process_journal(i, file_num):
+    """
+    旅行記1件を処理して (共通形式の旅行記データ, 読み込んだキャッシュのディレクトリ or None) を返す。処理できなければ None
+    """
+    cache_path = os.path.join(CACHE_DIR, f"{file_num}.json")
+    found = event_store.find(file_num)
+    if found:
+        source, travel_result_data = found
+        print(f"\n✅ [{file_num}] のキャッシュが見つかりました（{source}）。読み込みます。")
+        return travel_result_data, source
+
+    print(f"\n{'='*20} [{file_num}] の処理を開始 {'='*20}")
+    path_journal = f'{directory}{file_num}.tra.json'
+    
+    if not os.path.exists(path_journal): print(f"[WARNING] ファイルが見つかりません: {path_journal}"); return None
+    try:
+        with open(path_journal, "r", encoding="utf-8") as f: travel_data = json.load(f)
+    except: print(f"[ERROR] JSON読み込み失敗"); return None
+    texts = [];
+    for entry in travel_data: texts.extend(entry['text'])
+    full_text = " ".join(texts)
+    if not full_text.strip(): print(f"[WARNING] 旅行記 {file_num} にはテキストデータがありません。"); return None
+    
+    region_hint = get_visit_hint(full_text)
+    extracted_places = extract_places(full_text, region_hint)
+    if not extracted_places: print(f"[WARNING] 旅行記 {file_num} から訪問地を抽出できませんでした。"); return None
+
+    places_with_coords = []
+    for place_data in extracted_places:
+        place_name = place_data['place']
+        coords = geocode_place(place_name, region_hint)
+        if not coords:
+            coords = (place_data['latitude'], place_data['longitude'])
+            if coords[0] == 0.0 and coords[1] == 0.0: coords = None
+        if not coords:
+            coords = geocode_gsi(place_name)
+        if coords:
+            place_data['latitude'] = coords[0]
+            place_data['longitude'] = coords[1]
+            places_with_coords.append(place_data)
+        else:
+            print(f"[!] 全てのジオコーディングに失敗しました: {place_name}")
+
+    grouped_experiences = defaultdict(list)
+    for p in places_with_coords: grouped_experiences[p['place']].append(p['experience'])
+    
+    place_analysis_results = {}
+    for place, experiences in grouped_experiences.items():
+        analysis_result = analyze_experience(" ".join(experiences), MOVE_TAGS, ACTION_TAGS)
+        place_analysis_results[place] = analysis_result
+
+    for p in places_with_coords:
+        analysis = place_analysis_results.get(p['place'], {"emotion_score": 0.5, "tags": []})
+        p['emotion_score'] = analysis['emotion_score']
+        p['tags'] = analysis['tags']
+    
+    final_travel_data = {
+        "file_num": file_num, "events": places_to_events(places_with_coords),
+        "color": COLORS[i % len(COLORS)], "region_hint": region_hint 
+    }
+
+    write_json_atomic(cache_path, final_travel_data, ensure_ascii=False, indent=4)
+    print(f"✅ [{file_num}] の結果をキャッシュに保存しました。")
+    
+    print(f"📌 処理完了 ({file_num}): {len(places_with_coords)}件の訪問地を地図に追加します。")
+    return final_travel_data, None
+
+
 ### ★★★ 機能変更 (2/2): exceptブロックを旧バージョン形式に修正 ★★★
-def main():
+def main(argv=None):
     """メイン処理"""
     if not os.path.exists(CACHE_DIR):
         os.makedirs(CACHE_DIR)
         print(f"INFO: キャッシュディレクトリを作成しました: {CACHE_DIR}")
 
-    input_file_path = input('ファイル番号が記載された.txtファイルのパスを入力してください: ')
+    ### ★★★ 機能追加: ID・範囲・glob と --shard i/N を引数で受け取り、旅行記ごとの結果を実行マニフェストに記録する ★★★
+    args = parse_args(argv, description="旅行記から軌跡のみの地図を生成する", default_manifest=RUN_MANIFEST_PATH)
     try:
-        with open(input_file_path, 'r', encoding='utf-8') as f: content = f.read()
-        file_nums_raw = content.strip().split(',')
-        file_nums = [num.strip() for num in file_nums_raw if num.strip()] 
-        if not file_nums: print("[ERROR] 入力ファイルに有効なファイル番号が含まれていません。"); return
-        print(f"INFO: ファイルから {len(file_nums)} 件のファイル番号を読み込みました。")
-    except FileNotFoundError: print(f"[ERROR] 入力ファイルが見つかりません: {input_file_path}"); return
+        all_file_nums = resolve_ids(args.ids, directory) if args.ids else read_id_file_interactively()
+        # 色は shard で分ける前の並び順で決める（どの台で処理しても同じ色になる）
+        color_index = {file_num: i for i, file_num in enumerate(all_file_nums)}
+        file_nums = select_shard(all_file_nums, args.shard)
+        if not file_nums: print("[ERROR] 処理する旅行記IDがありません。"); return
+        print(f"INFO: {len(file_nums)} 件のファイル番号を読み込みました。")
+    except FileNotFoundError as e: print(f"[ERROR] 入力ファイルが見つかりません: {e.filename}"); return
     except Exception as e: print(f"[ERROR] ファイルの読み込み中にエラーが発生しました: {e}"); return
+    manifest = RunManifest(args.manifest)
+    completed = manifest.completed()
 
     all_travels_data = []
+    file_num = None
     try:
-        for i, file_num in enumerate(file_nums):
-            cache_path = os.path.join(CACHE_DIR, f"{file_num}.json")
-            if os.path.exists(cache_path):
-                print(f"\n✅ [{file_num}] のキャッシュが見つかりました。読み込みます。")
-                with open(cache_path, 'r', encoding='utf-8') as f:
-                    travel_result_data = json.load(f)
-                all_travels_data.append(travel_result_data)
+        for file_num in file_nums:
+            # マニフェストで完了済みの旅行記は、キャッシュの有無を調べずにそのまま読み込む
+            if file_num in completed:
+                found = event_store.find(file_num)
+                if found:
+                    all_travels_data.append(found[1])
+                    continue
+            elif manifest.status(file_num) == "skipped" and not args.retry_skipped:
                 continue
 
-            print(f"\n{'='*20} [{file_num}] の処理を開始 {'='*20}")
-            path_journal = f'{directory}{file_num}.tra.json'
-            
-            if not os.path.exists(path_journal): print(f"[WARNING] ファイルが見つかりません: {path_journal}"); continue
-            try:
-                with open(path_journal, "r", encoding="utf-8") as f: travel_data = json.load(f)
-            except: print(f"[ERROR] JSON読み込み失敗"); continue
-            texts = [];
-            for entry in travel_data: texts.extend(entry['text'])
-            full_text = " ".join(texts)
-            if not full_text.strip(): print(f"[WARNING] 旅行記 {file_num} にはテキストデータがありません。"); continue
-            
-            region_hint = get_visit_hint(full_text)
-            extracted_places = extract_places(full_text, region_hint)
-            if not extracted_places: print(f"[WARNING] 旅行記 {file_num} から訪問地を抽出できませんでした。"); continue
-
-            places_with_coords = []
-            for place_data in extracted_places:
-                place_name = place_data['place']
-                coords = geocode_place(place_name, region_hint)
-                if not coords:
-                    coords = (place_data['latitude'], place_data['longitude'])
-                    if coords[0] == 0.0 and coords[1] == 0.0: coords = None
-                if not coords:
-                    coords = geocode_gsi(place_name)
-                if coords:
-                    place_data['latitude'] = coords[0]
-                    place_data['longitude'] = coords[1]
-                    places_with_coords.append(place_data)
-                else:
-                    print(f"[!] 全てのジオコーディングに失敗しました: {place_name}")
-
-            grouped_experiences = defaultdict(list)
-            for p in places_with_coords: grouped_experiences[p['place']].append(p['experience'])
-            
-            place_analysis_results = {}
-            for place, experiences in grouped_experiences.items():
-                analysis_result = analyze_experience(" ".join(experiences), MOVE_TAGS, ACTION_TAGS)
-                place_analysis_results[place] = analysis_result
-
-            for p in places_with_coords:
-                analysis = place_analysis_results.get(p['place'], {"emotion_score": 0.5, "tags": []})
-                p['emotion_score'] = analysis['emotion_score']
-                p['tags'] = analysis['tags']
-            
-            final_travel_data = {
-                "file_num": file_num, "places": places_with_coords,
-                "color": COLORS[i % len(COLORS)], "region_hint": region_hint 
-            }
-            all_travels_data.append(final_travel_data)
-
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(final_travel_data, f, ensure_ascii=False, indent=4)
-            print(f"✅ [{file_num}] の結果をキャッシュに保存しました。")
-            
-            print(f"📌 処理完了 ({file_num}): {len(places_with_coords)}件の訪問地を地図に追加します。")
+            with manifest.timed(file_num):
+                result = process_journal(color_index[file_num], file_num)
+            if result is None:
+                manifest.record(file_num, "skipped")
+                continue
+            travel_result_data, source = result
+            all_travels_data.append(travel_result_data)
+            if source: manifest.record(file_num, "done", cached=True, source=source)
+            else: manifest.record(file_num, "done")
 
     # 旧バージョン(v0.x)のopenaiライブラリ用のエラーハンドリング
-    except openai.error.AuthenticationError as e:
+    except authentication_errors() as e:
         print("\n" + "="*50)
         print(f"[FATAL ERROR] OpenAIの認証に失敗しました: {e}")
         print("APIキーが間違っているか、クレジットが不足している可能性があります。")
@@ -406,11 +453,18 @@ def main():
     except Exception as e:
         print(f"\n[FATAL ERROR] 予期せぬエラーにより処理を中断します: {e}")
         print("現在までの結果で地図を生成します...")
+        if file_num: manifest.record(file_num, "failed", error=str(e))
 
+    if llm_cache is not None: print(llm_cache.report())
+    if geocode_cache is not None: print(geocode_cache.report())
+    print(manifest.report())
     base_name = "trace_only_map_"
 
+    if args.no_map: return
     if all_travels_data:
-        if len(all_travels_data) >= 4:
+        if args.output:
+            output_filename = args.output
+        elif len(all_travels_data) >= 4:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             output_filename = f"{base_name}{timestamp}{extension}"
         else:
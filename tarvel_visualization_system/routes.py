@@ -0,0 +1,123 @@
+"""
+旅行記のイベント列から、地図に描く「滞在地 → 移動 → 滞在地」の区間を組み立てる
+
+イベント列を1回だけ走査して、座標のある滞在地と、その間の移動イベントを対応付ける。
+区間の距離は全旅行記分をまとめて NumPy のハバーサイン公式で一度に計算し、
+MAX_DISTANCE_KM を超える区間（ジオコーディングの誤りの可能性が高い）を除外する。
+
+描画は旅行記1件につき1本の MultiPolyline にまとめ、除外した区間の所でだけ線を切る。
+必要なら Douglas–Peucker 法で頂点を間引く。
+"""
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """2点間の大円距離(km)。引数は配列でもスカラーでもよい"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def simplify_path(points, tolerance):
+    """
+    Douglas–Peucker 法で折れ線の頂点を間引く。tolerance は緯度経度（度）での許容誤差で、
+    0 以下なら何もしない。points は (頂点数, 2) の配列で、間引いた配列を返す。
+    """
+    points = np.asarray(points, dtype=float)
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        inner = points[first + 1:last]
+        direction = end - start
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            offsets = np.hypot(inner[:, 0] - start[0], inner[:, 1] - start[1])
+        else:
+            offsets = np.abs(direction[0] * (inner[:, 1] - start[1]) - direction[1] * (inner[:, 0] - start[0])) / length
+        farthest = int(np.argmax(offsets))
+        if offsets[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.extend([(first, index), (index, last)])
+    return points[keep]
+
+
+def polyline_paths(coords, keep=None, tolerance=0):
+    """
+    滞在地の座標列を、keep が False の区間で切った折れ線のリストにする（MultiPolyline の座標）。
+    keep は区間数（len(coords) - 1）の長さの真偽値配列で、None なら全区間をつなぐ。
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) < 2:
+        return []
+    if keep is None:
+        keep = np.ones(len(coords) - 1, dtype=bool)
+    # 除外した区間の直後の滞在地ごとに分割し、頂点が1つしかない断片は捨てる
+    breaks = np.flatnonzero(~np.asarray(keep, dtype=bool)) + 1
+    return [simplify_path(run, tolerance).tolist() for run in np.split(coords, breaks) if len(run) > 1]
+
+
+def pair_stops_and_moves(events):
+    """
+    座標のある滞在地のリストと、隣り合う滞在地の間の移動イベント（無ければ None）のリストを返す。
+    moves[k] は stops[k] → stops[k+1] の区間に対応する（間に複数あれば最初のもの）。
+    """
+    stops, moves, pending_move = [], [], None
+    for event in events:
+        event_type = event.get("type")
+        if event_type == "stop" and "latitude" in event:
+            if stops:
+                moves.append(pending_move)
+            stops.append(event)
+            pending_move = None
+        elif event_type == "move" and stops and pending_move is None:
+            pending_move = event
+    return stops, moves
+
+
+class RouteSegments:
+    """旅行記1件分の区間。coords は (滞在地数, 2) の [緯度, 経度]、distances_km と keep は区間数の長さ"""
+
+    def __init__(self, stops, moves, coords, distances_km, keep):
+        self.stops = stops
+        self.moves = moves
+        self.coords = coords
+        self.distances_km = distances_km
+        self.keep = keep
+
+    def __len__(self):
+        return len(self.moves)
+
+    def kept(self):
+        """描画する区間の (区間番号, 始点, 終点, 移動イベント) を順に返す"""
+        for k in np.flatnonzero(self.keep):
+            yield k, tuple(self.coords[k]), tuple(self.coords[k + 1]), self.moves[k]
+
+    def paths(self, tolerance=0):
+        """描画する区間をつないだ折れ線のリスト（旅行記1件で1本の MultiPolyline にする）"""
+        return polyline_paths(self.coords, self.keep, tolerance)
+
+
+def build_route_segments(events_list, max_distance_km):
+    """旅行記ごとのイベント列のリストから、旅行記ごとの RouteSegments のリストを返す"""
+    pairs = [pair_stops_and_moves(events) for events in events_list]
+    coords = np.array([(stop["latitude"], stop["longitude"]) for stops, _ in pairs for stop in stops], dtype=float).reshape(-1, 2)
+    # 隣り合う滞在地の距離を全旅行記まとめて計算する（旅行記の境目をまたぐ値は使わない）
+    distances = haversine_km(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1]) if len(coords) > 1 else np.empty(0)
+    segments, offset = [], 0
+    for stops, moves in pairs:
+        journal_distances = distances[offset:offset + len(moves)]
+        segments.append(RouteSegments(
+            stops, moves, coords[offset:offset + len(stops)], journal_distances, journal_distances <= max_distance_km,
+        ))
+        offset += len(stops)
+    return segments
@@ -0,0 +1,125 @@
+"""
+OpenAI ChatCompletion API のローカルスタブサーバー（動作確認・負荷試験用）
+
+応答までの遅延と、RPM 超過時の 429 応答を模擬する。
+    python stub_llm_server.py --port 8800 --latency 0.5 1.5 --rpm 60
+    OPENAI_API_BASE=http://127.0.0.1:8800/v1 python travelogue.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_EVENTS = [
+    {"type": "stop", "place": "京都駅", "latitude": 34.9858, "longitude": 135.7588,
+     "experience": "京都駅に到着し、駅ビルで昼食をとった。", "reasoning": "テキストの出発点。"},
+    {"type": "move", "means": "バス", "experience": "市バスで清水寺へ向かった。"},
+    {"type": "stop", "place": "清水寺", "latitude": 34.9949, "longitude": 135.7850,
+     "experience": "清水の舞台から紅葉を眺めた。", "reasoning": "地名から推定。"},
+]
+
+
+class StubState:
+    def __init__(self, latency, rpm, error_rate, window=60):
+        self.latency = latency
+        self.rpm = rpm
+        self.error_rate = error_rate
+        self.window = window  # RPM を数える時間幅(秒)。テストでは短くする
+        self.lock = threading.Lock()
+        self.sent = deque()
+        self.counts = {"ok": 0, "429": 0, "500": 0}
+
+    def admit(self):
+        """RPM の範囲内なら True。超過時は Retry-After 秒数を返す"""
+        with self.lock:
+            now = time.monotonic()
+            while self.sent and self.sent[0] + self.window <= now:
+                self.sent.popleft()
+            if self.rpm and len(self.sent) >= self.rpm:
+                self.counts["429"] += 1
+                return max(1, int(self.sent[0] + self.window - now))
+            self.sent.append(now)
+            return True
+
+
+def build_content(body):
+    """リクエストの内容に応じてそれらしい応答本文を返す"""
+    system = body["messages"][0]["content"]
+    user = body["messages"][-1]["content"]
+    if "都道府県" in system:
+        return "京都府"
+    if "滞在（stop）" in system:
+        return "```json\n" + json.dumps(SAMPLE_EVENTS, ensure_ascii=False) + "\n```"
+    if '"results"' in user:
+        # 一括分析: 番号付きテキストの件数分だけ結果を返す
+        ids = [int(part.split("]", 1)[0]) for part in user.split("[id:")[1:]]
+        return json.dumps({"results": [{"id": i, "emotions": {"景色鑑賞": 0.8}} for i in ids]}, ensure_ascii=False)
+    if body.get("response_format", {}).get("type") == "json_object":
+        return json.dumps({"名所観光": round(random.random(), 2)}, ensure_ascii=False)
+    return "スタブ応答"
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, payload, headers=None):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            admitted = state.admit()
+            if admitted is not True:
+                self._send(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests"}},
+                           {"Retry-After": str(admitted)})
+                return
+            time.sleep(random.uniform(*state.latency))
+            if random.random() < state.error_rate:
+                with state.lock: state.counts["500"] += 1
+                self._send(500, {"error": {"message": "stub server error", "type": "server_error"}})
+                return
+            content = build_content(body)
+            prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", []))
+            with state.lock: state.counts["ok"] += 1
+            self._send(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                          "total_tokens": prompt_tokens + len(content)},
+            })
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI API スタブサーバー")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=float, nargs=2, default=(0.5, 1.5), metavar=("MIN", "MAX"))
+    parser.add_argument("--rpm", type=int, default=60, help="これを超えると429を返す (0で無制限)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500を返す確率")
+    args = parser.parse_args()
+
+    state = StubState(tuple(args.latency), args.rpm, args.error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(state))
+    print(f"🧪 スタブサーバーを起動しました: http://127.0.0.1:{args.port}/v1 (Ctrl+Cで終了)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"📊 応答数: {state.counts}")
+
+
+if __name__ == "__main__":
+    main()
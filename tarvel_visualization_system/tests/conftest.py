@@ -0,0 +1,5 @@
+"""tarvel_visualization_system/ のモジュールはフラットに import するので、親ディレクトリをパスに入れる"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,91 @@
+"""旅行記IDの指定の展開と shard への分割（batch_cli.py）のテスト"""
+import argparse
+import json
+
+import pytest
+
+from batch_cli import RunManifest, parse_shard, resolve_ids, select_shard
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    for file_num in ["00010", "00011", "00012", "00020"]:
+        (tmp_path / f"{file_num}.tra.json").write_text("[]", encoding="utf-8")
+    return str(tmp_path)
+
+
+def test_ids_ranges_globs_and_txt_files_keep_order_without_duplicates(dataset, tmp_path):
+    id_file = tmp_path / "ids.txt"
+    id_file.write_text("00099, 00008,\n", encoding="utf-8")
+    ids = resolve_ids(["00008-00010", "0001?", str(id_file), "00020"], dataset)
+    assert ids == ["00008", "00009", "00010", "00011", "00012", "00099", "00020"]
+
+
+def test_range_is_zero_padded_to_the_start_width(dataset):
+    assert resolve_ids(["0098-0101"], dataset) == ["0098", "0099", "0100", "0101"]
+
+
+def test_glob_uses_the_given_suffix(dataset, tmp_path):
+    cache_dir = tmp_path / "results_cache"
+    cache_dir.mkdir()
+    (cache_dir / "00013.json").write_text("{}", encoding="utf-8")
+    (cache_dir / "manifest.jsonl").write_text("", encoding="utf-8")
+    assert resolve_ids(["0001*"], str(cache_dir), suffix=".json") == ["00013"]
+    assert resolve_ids(["*"], str(cache_dir), suffix=".json") == ["00013"]
+    assert resolve_ids(["0003*"], dataset) == []
+
+
+def test_glob_against_a_missing_directory_matches_nothing(tmp_path):
+    assert resolve_ids(["0001*", "00001"], str(tmp_path / "missing")) == ["00001"]
+
+
+def test_shards_partition_the_ids_in_order():
+    ids = [f"{n:05d}" for n in range(200)]
+    shards = [select_shard(ids, (i, 4)) for i in range(1, 5)]
+    assert sorted(sum(shards, [])) == ids
+    assert all(shard == sorted(shard) and shard for shard in shards)
+    assert select_shard(ids, (2, 4)) == shards[1]
+    assert select_shard(ids, None) == ids
+
+
+def test_parse_shard():
+    assert parse_shard("2/4") == (2, 4)
+    for text in ["0/4", "5/4", "2", "a/b"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(text)
+
+
+def test_manifest_reads_shard_files_and_later_records_win(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    RunManifest(str(tmp_path / "manifest_shard1of2.jsonl")).record("00001", "done", pipeline="a")
+    manifest = RunManifest(path)
+    manifest.record("00002", "failed", error="boom")
+    manifest.record("00002", "done", pipeline="b")
+
+    reloaded = RunManifest(path)
+    assert reloaded.completed() == {"00001", "00002"}
+    assert reloaded.completed(pipeline="b") == {"00002"}
+    assert reloaded.recorded("00002") is None and manifest.recorded("00002") == "done"
+
+
+def test_missing_txt_file_is_an_error_not_an_id(dataset, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        resolve_ids(["00008", str(tmp_path / "missing.txt")], dataset)
+
+
+def test_manifest_keeps_the_newest_record_across_base_and_shard_files(tmp_path):
+    def write(path, *entries):
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+    # 本体は shard ファイルより後に読むが、shard 側のほうが新しい結果を持っている
+    write(tmp_path / "manifest_shard1of2.jsonl",
+          {"file_num": "00001", "status": "done", "at": "2024-05-02T10:00:00"},
+          {"file_num": "00002", "status": "failed", "at": "2024-05-01T09:00:00"})
+    write(tmp_path / "manifest.jsonl",
+          {"file_num": "00001", "status": "failed", "at": "2024-05-01T09:00:00"},
+          {"file_num": "00002", "status": "done", "at": "2024-05-02T10:00:00"})
+
+    manifest = RunManifest(str(tmp_path / "manifest.jsonl"))
+    assert manifest.status("00001") == "done"
+    assert manifest.status("00002") == "done"
@@ -0,0 +1,25 @@
+"""EmotionGrid の集計のテスト"""
+import numpy as np
+
+from emotion_grid import EmotionGrid
+
+LEVELS = [(0, 1.0), (10, 0.1)]
+
+
+def test_add_points_accepts_lists_arrays_and_generators():
+    points = [[35.01, 135.71, 0.2], [35.02, 135.72, 0.6], [34.5, 135.5, 1.0]]
+    grids = [EmotionGrid(levels=LEVELS) for _ in range(3)]
+    grids[0].add_points("景色鑑賞", points)
+    grids[1].add_points("景色鑑賞", np.array(points))
+    grids[2].add_points("景色鑑賞", (p for p in points))
+    for grid in grids:
+        (_, _, centers, means, counts), _ = grid.aggregate("景色鑑賞")
+        assert sorted(counts.tolist()) == [1, 2]
+        assert sorted(np.round(means, 6).tolist()) == [0.4, 1.0]
+
+
+def test_empty_points_are_ignored():
+    grid = EmotionGrid(levels=LEVELS)
+    grid.add_points("景色鑑賞", [])
+    grid.add_points("景色鑑賞", iter(()))
+    assert grid.tags() == []
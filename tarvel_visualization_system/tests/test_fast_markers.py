@@ -0,0 +1,67 @@
+"""FastMarkers の行データの埋め込みのテスト"""
+import json
+import shutil
+import subprocess
+
+import folium
+import pytest
+
+from fast_markers import ADD_LAYERS_JS, FastMarkers
+from map_shards import ShardLoader
+
+
+def test_rows_json_cannot_close_the_script_tag():
+    rows = [[35.0, 135.7, None, "京都駅</script><script>alert(1)</script>", "<b>体験:</b> </script>"]]
+    text = FastMarkers(rows).rows_json()
+    assert "</" not in text
+    assert json.loads(text) == rows
+
+
+# leaflet.featuregroup.subgroup と同じ振る舞いのサブグループ（addLayers は無く、表示中なら addLayer ごとに親へ追加する）
+FAKE_LEAFLET_JS = """
+var window = {}, calls = [];
+var cluster = {
+    addLayer: function(layer) { calls.push('addLayer'); },
+    addLayers: function(layers) { calls.push('addLayers:' + layers.length); },
+};
+function SubGroup(map) { this._map = map; this._layers = {}; }
+SubGroup.prototype.getParentGroup = function() { return cluster; };
+SubGroup.prototype.addLayer = function(layer) {
+    this._layers[layer.id] = layer;
+    if (this._map) { cluster.addLayer(layer); }
+    return this;
+};
+"""
+
+
+def run_add_layers(shown):
+    node = shutil.which("node")
+    if node is None:
+        pytest.skip("node が無い")
+    script = FAKE_LEAFLET_JS + ADD_LAYERS_JS + f"""
+    var group = new SubGroup({'{}' if shown else 'null'});
+    window.travelAddLayers(group, [{{id: 1}}, {{id: 2}}, {{id: 3}}]);
+    console.log(JSON.stringify({{calls: calls, registered: Object.keys(group._layers).length, shown: !!group._map}}));
+    """
+    result = subprocess.run([node, "-e", script], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def test_subgroup_markers_go_to_the_parent_cluster_in_one_batch():
+    assert run_add_layers(shown=True) == {"calls": ["addLayers:3"], "registered": 3, "shown": True}
+
+
+def test_hidden_subgroup_only_registers_markers():
+    # 非表示のサブグループは、表示したときに自分で親へまとめて追加する
+    assert run_add_layers(shown=False) == {"calls": [], "registered": 3, "shown": False}
+
+
+def test_fast_markers_and_shards_use_the_shared_helper(tmp_path):
+    m = folium.Map()
+    group = folium.FeatureGroup().add_to(m)
+    group.add_child(FastMarkers([[35.0, 135.7, None, "京都", "<b>京都</b>"]]))
+    m.add_child(ShardLoader(str(tmp_path / "map.html")))
+    html = m.get_root().render()
+    assert "window.travelAddLayers = window.travelAddLayers ||" in html
+    assert "travelAddLayers(group, markers);" in html
+    assert "travelAddLayers(group, layers);" in html
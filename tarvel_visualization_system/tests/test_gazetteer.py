@@ -0,0 +1,88 @@
+"""オフラインの地名辞書（gazetteer.py）のテスト"""
+import pytest
+
+import travelogue
+from gazetteer import load_gazetteer, normalize_prefecture
+from geocode_scheduler import GeocodeScheduler
+
+TSV = """name\tlatitude\tlongitude\tprefecture\tkind\taliases
+京都駅\t34.985849\t135.758767\t京都府\tstation\t京都
+京都\t35.011636\t135.768029\t京都府\tmunicipality\t
+府中\t35.668933\t139.477612\t東京都\tmunicipality\t
+府中\t34.568233\t133.236767\t広島県\tmunicipality\t
+草津温泉\t36.622\t138.596\t群馬県\tonsen\t草津
+草津\t35.013\t135.960\t滋賀県\tmunicipality\t
+壊れた行\tx\t135.0\t京都府\t\t
+"""
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    path = tmp_path / "gazetteer.tsv"
+    path.write_text(TSV, encoding="utf-8")
+    return load_gazetteer(str(path))
+
+
+def test_normalize_prefecture():
+    assert normalize_prefecture("京都府") == normalize_prefecture("京都") == "京都"
+    assert normalize_prefecture("東京都") == "東京"
+    assert normalize_prefecture("北海道") == "北海道"
+    assert normalize_prefecture("群馬県") == "群馬"
+
+
+def test_exact_hit_uses_the_normalized_name(gazetteer):
+    assert gazetteer.lookup("京都駅", "京都府") == (34.985849, 135.758767)
+    assert gazetteer.lookup(" 京都駅 ", "京都") == (34.985849, 135.758767)
+    assert gazetteer.lookup("壊れた行", "京都府") is None
+
+
+def test_region_hint_filters_by_prefecture(gazetteer):
+    assert gazetteer.lookup("府中", "東京都") == (35.668933, 139.477612)
+    assert gazetteer.lookup("府中", "広島") == (34.568233, 133.236767)
+    assert gazetteer.lookup("府中", "大阪府") is None
+    assert gazetteer.lookup("府中", "日本") is None  # 候補が1つに定まらない
+
+
+def test_ambiguous_name_prefers_kind_priority(gazetteer):
+    # 「京都」は京都駅の別名(station)と市(municipality)の両方にある
+    assert gazetteer.lookup("京都", "京都府") == (34.985849, 135.758767)
+    # 「草津」は群馬の温泉の別名と滋賀の市。都道府県で絞ってから種別を比べる
+    assert gazetteer.lookup("草津", "滋賀県") == (35.013, 135.960)
+    assert gazetteer.lookup("草津", "群馬県") == (36.622, 138.596)
+
+
+def test_missing_file_disables_the_gazetteer(tmp_path):
+    assert load_gazetteer(str(tmp_path / "missing.tsv")) is None
+
+
+class FakeProvider:
+    def __init__(self, name, coords):
+        self.name = name
+        self.coords = coords
+        self.bucket = None
+        self.queries = []
+
+    def lookup(self, name, region_hint=None):
+        self.queries.append(name)
+        return self.coords
+
+
+def test_miss_falls_through_to_the_network_providers(gazetteer, monkeypatch):
+    nominatim = FakeProvider("nominatim", (35.0394, 135.7292))
+    gsi = FakeProvider("gsi", None)
+    scheduler = GeocodeScheduler([gazetteer, nominatim, gsi], max_workers=2)
+    monkeypatch.setattr(travelogue, "geocoder", scheduler)
+    monkeypatch.setattr(travelogue, "prefecture_index", None)
+    monkeypatch.setattr(travelogue, "GEOCODE_HEDGED", True)
+    monkeypatch.setattr(travelogue, "GEOCODE_HEDGE_DELAY", 0)
+
+    hit = {"type": "stop", "place": "京都駅"}
+    miss = {"type": "stop", "place": "金閣寺"}
+    travelogue.geocode_place_group([(hit, "京都府")])
+    travelogue.geocode_place_group([(miss, "京都府")])
+    scheduler.shutdown()
+
+    assert (hit["latitude"], hit["longitude"]) == (34.985849, 135.758767)
+    assert (miss["latitude"], miss["longitude"]) == (35.0394, 135.7292)
+    assert nominatim.queries == ["金閣寺"]
+
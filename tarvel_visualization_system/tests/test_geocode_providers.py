@@ -0,0 +1,114 @@
+"""TokenBucket と NominatimProvider のテスト（時計とHTTPセッションを差し替えて動かす）"""
+import threading
+
+import pytest
+
+import travelogue
+from geocode_scheduler import GSIProvider, NominatimProvider, TokenBucket
+
+
+class FakeClock:
+    """sleep() で時刻が進むだけの時計"""
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+def test_bucket_allows_one_request_per_second():
+    clock = FakeClock()
+    bucket = TokenBucket(1.0, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == [1.0, 1.0]
+    assert clock.now == 102.0
+
+    clock.now += 0.4  # 前回から0.4秒たってから問い合わせる
+    bucket.acquire()
+    assert clock.sleeps[-1] == 0.6
+
+
+def test_bucket_refills_up_to_capacity_only():
+    clock = FakeClock()
+    bucket = TokenBucket(2.0, capacity=2, clock=clock, sleep=clock.sleep)
+    clock.now += 60  # 長く空いてもトークンは capacity までしか貯まらない
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [0.5]
+
+
+def test_share_divides_the_rate_across_processes(monkeypatch):
+    monkeypatch.setattr(travelogue, "gazetteer", None)
+    monkeypatch.setattr(travelogue, "geocode_cache", None)
+    geocoder = travelogue.build_geocoder(share=4)
+    geocoder.shutdown()
+    assert geocoder.providers["nominatim"].bucket.rate == pytest.approx(1 / travelogue.WAIT_TIME / 4)
+    assert geocoder.providers["gsi"].bucket.rate == pytest.approx(travelogue.GSI_RATE / 4)
+
+
+class FakeResponse:
+    def __init__(self, payload, status=200):
+        self.payload = payload
+        self.status = status
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise RuntimeError(f"HTTP {self.status}")
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append((url, params, timeout))
+        return self.responses.pop(0)
+
+
+def test_nominatim_provider_queries_with_the_region_hint():
+    provider = NominatimProvider("http://stub/search", user_agent="test-agent", timeout=3)
+    assert provider.session.headers["User-Agent"] == "test-agent"
+    provider.session = FakeSession(FakeResponse([{"lat": "34.9858", "lon": "135.7588"}]), FakeResponse([]))
+
+    assert provider.lookup("京都駅", "京都府") == (34.9858, 135.7588)
+    assert provider.lookup("どこにもない場所", "") is None
+    assert provider.session.requests == [
+        ("http://stub/search", {"q": "京都駅, 京都府", "format": "json", "limit": 1}, 3),
+        ("http://stub/search", {"q": "どこにもない場所", "format": "json", "limit": 1}, 3),
+    ]
+
+
+def test_provider_http_errors_are_raised():
+    provider = NominatimProvider("http://stub/search")
+    provider.session = FakeSession(FakeResponse({"error": "rate limited"}, status=429))
+    with pytest.raises(RuntimeError):
+        provider.lookup("京都駅", "京都府")
+
+
+def test_gsi_provider_returns_lat_lon_order():
+    provider = GSIProvider("http://stub/gsi")
+    provider.session = FakeSession(FakeResponse([{"geometry": {"coordinates": [135.7588, 34.9858]}}]))
+    assert provider.lookup("京都駅") == (34.9858, 135.7588)
+
+
+def test_acquire_gives_up_when_cancelled():
+    clock = FakeClock()
+    bucket = TokenBucket(1.0, clock=clock, sleep=clock.sleep)
+    cancel = threading.Event()
+    assert bucket.acquire(cancel) is True
+    cancel.set()
+    assert bucket.acquire(cancel) is False
+    assert clock.sleeps == []
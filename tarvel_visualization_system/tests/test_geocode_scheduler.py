@@ -0,0 +1,72 @@
+"""GeocodeScheduler.geocode_hedged のテスト（ネットワークを使わない偽のプロバイダーで動かす）"""
+import time
+
+from geocode_scheduler import GeocodeScheduler, TokenBucket
+
+
+class FakeProvider:
+    def __init__(self, name, coords, latency, rate=None):
+        self.name = name
+        self.coords = coords
+        self.latency = latency
+        self.bucket = TokenBucket(rate) if rate else None
+        self.calls = 0
+
+    def lookup(self, name, region_hint=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.coords
+
+
+def test_hedge_delay_starts_after_the_primary_gets_its_token():
+    # Nominatim 相当: 1回/秒のバケットを直前の問い合わせで使い切っている（次の送信まで約1秒待つ）
+    primary = FakeProvider("nominatim", (35.0, 135.7), latency=0.05, rate=1.0)
+    secondary = FakeProvider("gsi", (35.1, 135.8), latency=0.0)
+    primary.bucket.acquire()
+    scheduler = GeocodeScheduler([primary, secondary], max_workers=2)
+
+    start = time.monotonic()
+    coords = scheduler.geocode_hedged("京都駅", "京都府", ["nominatim", "gsi"], delay=0.3)
+    elapsed = time.monotonic() - start
+    scheduler.shutdown()
+
+    assert coords == (35.0, 135.7)
+    assert secondary.calls == 0
+    assert scheduler.stats["nominatim"]["won"] == 1
+    assert elapsed >= 0.8  # バケットの順番待ちをした
+
+
+def test_hedge_fires_when_the_primary_is_slow_in_flight():
+    primary = FakeProvider("nominatim", (35.0, 135.7), latency=0.5)
+    secondary = FakeProvider("gsi", (35.1, 135.8), latency=0.0)
+    scheduler = GeocodeScheduler([primary, secondary], max_workers=2)
+    coords = scheduler.geocode_hedged("京都駅", "京都府", ["nominatim", "gsi"], delay=0.1)
+    scheduler.shutdown()
+    assert coords == (35.1, 135.8)
+    assert scheduler.stats["gsi"]["won"] == 1
+
+
+def test_unacceptable_primary_result_falls_through_to_the_next_provider():
+    primary = FakeProvider("nominatim", (48.8, 2.3), latency=0.0)  # 日本の外
+    secondary = FakeProvider("gsi", (35.1, 135.8), latency=0.0)
+    scheduler = GeocodeScheduler([primary, secondary], max_workers=2)
+    assert scheduler.geocode_hedged("京都駅", "京都府", ["nominatim", "gsi"], delay=0.1) == (35.1, 135.8)
+    scheduler.shutdown()
+
+
+def test_cancelled_loser_does_not_take_a_token():
+    fast = FakeProvider("gsi", (35.1, 135.8), latency=0.0)
+    limited = FakeProvider("nominatim", (35.0, 135.7), latency=0.0, rate=1.0)
+    limited.bucket.acquire()  # 次のトークンは約1秒後
+    drained = time.monotonic()
+    scheduler = GeocodeScheduler([fast, limited], max_workers=2)
+
+    assert scheduler.geocode_hedged("京都駅", "京都府", ["gsi", "nominatim"], delay=0) == (35.1, 135.8)
+    scheduler.shutdown()  # 負けた問い合わせはトークンを待たずに終わる
+    assert time.monotonic() - drained < 0.5
+    assert limited.calls == 0
+    assert scheduler.stats["nominatim"]["cancelled"] == 1
+
+    # 次の問い合わせは、取り消した問い合わせの分を待たずに約1秒後のトークンを使える
+    limited.bucket.acquire()
+    assert time.monotonic() - drained < 1.5
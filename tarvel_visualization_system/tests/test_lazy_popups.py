@@ -0,0 +1,60 @@
+"""ポップアップのデータ（lazy_popups.py）と、inline / lazy のポップアップが同じ表示になることのテスト"""
+import pytest
+
+import travelogue
+from lazy_popups import move_entry, move_popup_html, stop_entry, stop_popup_html
+from routes import build_route_segments
+
+RAW = "<script>alert('x')</script> & \"森\""
+ESCAPED = "&lt;script&gt;alert(&#x27;x&#x27;)&lt;/script&gt; &amp; &quot;森&quot;"
+
+
+class FakeAssets:
+    def asset_key(self, file_path):
+        return f"a:{file_path}"
+
+    def icon_key(self, file_path, size):
+        return f"i:{file_path}"
+
+
+def test_entries_hold_escaped_text():
+    entry = stop_entry(7, {"place": RAW, "reasoning": RAW, "experience": RAW}, {RAW: 0.5}, [(RAW, "k1")])
+    assert entry["p"] == entry["r"] == entry["x"] == ESCAPED
+    assert entry["e"] == [[ESCAPED, 0.5]]
+    assert entry["g"] == [[ESCAPED, "k1"]]
+    assert move_entry(RAW, RAW) == {"t": "m", "m": ESCAPED, "x": ESCAPED}
+
+
+def test_popup_html_has_no_raw_markup():
+    entry = stop_entry(7, {"place": RAW, "reasoning": RAW, "experience": RAW}, {RAW: 0.5}, [(RAW, "k1")])
+    popup = stop_popup_html(entry)
+    assert "<script>" not in popup
+    assert f"<b>{ESCAPED}</b> (旅行記: 7)" in popup
+    assert f'<img data-asset="k1" alt="{ESCAPED}"' in popup
+    assert "<script>" not in move_popup_html(move_entry(RAW, RAW))
+
+
+@pytest.mark.parametrize("mode", ["inline", "lazy"])
+def test_render_journal_escapes_in_both_modes(monkeypatch, mode):
+    monkeypatch.setattr(travelogue, "POPUP_MODE", mode)
+    gif_tag = next(iter(travelogue.TAG_TO_GIF))
+    events = [
+        {"type": "stop", "place": RAW, "latitude": 35.0, "longitude": 135.7, "experience": RAW, "per_tag_emotions": {gif_tag: 0.8}},
+        {"type": "move", "means": RAW, "experience": RAW},
+        {"type": "stop", "place": "京都駅", "latitude": 35.01, "longitude": 135.71, "experience": "到着"},
+    ]
+    travel = {"file_num": 3, "events": events}
+    segments = build_route_segments([events], travelogue.MAX_DISTANCE_KM)[0]
+    fragment = travelogue.render_journal(travel, segments, FakeAssets())
+
+    stop_row, move_row = fragment["stop_rows"][0], fragment["move_rows"][0]
+    assert stop_row[3] == f"{ESCAPED} (3)"
+    assert move_row[3] == f"移動: {ESCAPED}"
+    if mode == "lazy":
+        popups = [stop_popup_html(fragment["popups"][stop_row[4][1]]), move_popup_html(fragment["popups"][move_row[4][1]])]
+    else:
+        popups = [stop_row[4], move_row[4]]
+    # どちらのモードでも、同じエスケープ済みのデータから同じ HTML になる
+    assert popups[0] == stop_popup_html(stop_entry(3, events[0], {gif_tag: 0.8}, [(gif_tag, f"a:{travelogue.TAG_TO_GIF[gif_tag]}")]))
+    assert popups[1] == move_popup_html(move_entry(RAW, RAW))
+    assert all("<script>" not in popup for popup in popups)
@@ -0,0 +1,73 @@
+"""LLMEngine をスタブサーバー（stub_llm_server.py）に向けて動かすテスト"""
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import openai
+import pytest
+
+from llm_cache import LLMCache, make_key
+from llm_engine import LLMEngine
+from stub_llm_server import StubState, make_handler
+
+
+@pytest.fixture
+def stub_server():
+    """RPM=1・ウィンドウ1秒のスタブ（2件目は Retry-After: 1 つきの429になる）"""
+    state = StubState(latency=(0, 0), rpm=1, error_rate=0.0, window=1)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield state, f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+
+
+def make_engine(api_base, **kwargs):
+    def create(**request):
+        return openai.ChatCompletion.create(api_base=api_base, api_key="test", request_timeout=5, **request)
+    return LLMEngine(max_concurrency=2, create_fn=create, **kwargs)
+
+
+def test_rate_limit_waits_for_retry_after(stub_server):
+    state, api_base = stub_server
+    engine = make_engine(api_base)
+    messages = [{"role": "system", "content": "test"}, {"role": "user", "content": "こんにちは"}]
+
+    assert engine.complete(model="gpt-4o", messages=messages) == "スタブ応答"
+    start = time.monotonic()
+    assert engine.complete(model="gpt-4o", messages=messages) == "スタブ応答"
+    elapsed = time.monotonic() - start
+    engine.shutdown()
+
+    assert state.counts["429"] >= 1
+    assert engine.stats["rate_limited"] >= 1
+    assert engine.stats["retries"] >= 1
+    assert engine.stats["requests"] == 2
+    assert elapsed >= 0.9  # Retry-After: 1 を待ってから再送している
+
+
+def test_cache_key_includes_max_tokens_and_extra_arguments():
+    messages = [{"role": "user", "content": "x"}]
+    base = make_key("gpt-4o", messages, 0.2)
+    assert make_key("gpt-4o", messages, 0.2, max_tokens=None) == base
+    assert make_key("gpt-4o", messages, 0.2, max_tokens=16) != base
+    assert make_key("gpt-4o", messages, 0.2, max_tokens=16) != make_key("gpt-4o", messages, 0.2, max_tokens=1024)
+    assert make_key("gpt-4o", messages, 0.2, top_p=0.5, n=1) == make_key("gpt-4o", messages, 0.2, n=1, top_p=0.5)
+
+
+def test_truncated_answer_is_not_served_for_a_larger_budget(tmp_path):
+    calls = []
+
+    def create(**request):
+        calls.append(request)
+        content = "短" if request.get("max_tokens") == 1 else "長い応答"
+        message = type("Message", (), {"content": content})
+        return type("Response", (), {"choices": [type("Choice", (), {"message": message})], "usage": None})
+
+    engine = LLMEngine(create_fn=create, cache=LLMCache(str(tmp_path / "llm.sqlite3")))
+    messages = [{"role": "user", "content": "x"}]
+    assert engine.complete(model="gpt-4o", messages=messages, max_tokens=1) == "短"
+    assert engine.complete(model="gpt-4o", messages=messages, max_tokens=1000) == "長い応答"
+    assert engine.complete(model="gpt-4o", messages=messages, max_tokens=1000) == "長い応答"
+    engine.shutdown()
+    assert len(calls) == 2
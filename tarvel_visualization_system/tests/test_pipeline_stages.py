@@ -0,0 +1,56 @@
+"""ステージのチェックポイント（pipeline_stages.py）のテスト"""
+import argparse
+
+import pytest
+
+from pipeline_stages import StageCheckpoints, parse_stages, stage_key
+
+
+def test_stage_key_depends_on_every_part_but_not_on_dict_order():
+    key = stage_key("tag", ["京都駅"], {"model": "gpt-4o", "batch": True})
+    assert key == stage_key("tag", ["京都駅"], {"batch": True, "model": "gpt-4o"})
+    assert key != stage_key("tag", ["京都駅"], {"model": "gpt-4o", "batch": False})
+    assert key != stage_key("geocode", ["京都駅"], {"model": "gpt-4o", "batch": True})
+    assert len(key) == 64
+
+
+def test_checkpoint_is_reused_only_with_the_same_key(tmp_path):
+    checkpoints = StageCheckpoints(str(tmp_path))
+    assert checkpoints.get("tag", "00001", "k1") is None
+    checkpoints.put("tag", "00001", "k1", [{"景色鑑賞": 0.8}])
+
+    assert checkpoints.exists("tag", "00001")
+    assert checkpoints.get("tag", "00001", "k1") == [{"景色鑑賞": 0.8}]
+    assert checkpoints.get("tag", "00001", "k2") is None
+    assert checkpoints.latest("tag", "00001") == [{"景色鑑賞": 0.8}]
+    assert checkpoints.latest("geocode", "00001") is None
+
+
+def test_broken_checkpoint_is_treated_as_missing(tmp_path):
+    checkpoints = StageCheckpoints(str(tmp_path))
+    (tmp_path / "extract").mkdir()
+    (tmp_path / "extract" / "00001.json").write_text('{"key": "k1", "da', encoding="utf-8")
+    assert checkpoints.get("extract", "00001", "k1") is None
+    assert checkpoints.latest("extract", "00001") is None
+
+
+def test_stats_count_runs_but_not_seeded_puts(tmp_path):
+    checkpoints = StageCheckpoints(str(tmp_path))
+    checkpoints.put("extract", "00001", "k", {}, seeded=True)
+    checkpoints.put("extract", "00002", "k", {})
+    checkpoints.get("extract", "00001", "k")
+
+    stats = checkpoints.take_stats()
+    assert stats["extract"] == {"hits": 1, "runs": 1}
+    assert checkpoints.stats["extract"] == {"hits": 0, "runs": 0}
+
+    checkpoints.merge_stats(stats)
+    checkpoints.merge_stats(stats)
+    assert checkpoints.stats["extract"] == {"hits": 2, "runs": 2}
+    assert "extract: 再利用 2件 / 実行 2件" in checkpoints.report()
+
+
+def test_parse_stages():
+    assert parse_stages(" extract, tag ,") == ["extract", "tag"]
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_stages("extract,emotion")
@@ -0,0 +1,55 @@
+"""place_dedup の名寄せキーのテスト"""
+from place_dedup import group_stops, place_dedup_key, representative
+
+
+def key(name, region="京都府"):
+    """(正規化地名, 種別)"""
+    return place_dedup_key(name, region)[:2]
+
+
+def test_spacing_width_and_same_kind_suffixes_are_merged():
+    assert key("京都駅") == key("京都 駅") == key("京都駅前") == ("京都", "station")
+    assert key("ｷｮｳﾄ駅") == key("キョウト駅")
+    assert key("京都駅バスターミナル") == key("京都駅バス停")
+    assert place_dedup_key("京都駅", "京都府") == place_dedup_key("京都駅", "京都")
+
+
+def test_places_of_different_kinds_are_not_merged():
+    assert key("京都") != key("京都駅")
+    assert key("京都駅") != key("京都バス停")
+    assert key("多賀") != key("多賀SA") != key("多賀PA")
+    assert place_dedup_key("府中駅", "東京都") != place_dedup_key("府中駅", "広島県")
+
+
+def test_interchange_abbreviations_are_stripped_as_separate_words():
+    assert key("京都東IC") == key("京都東ＩＣ") == key("京都東インター") == key("京都東インターチェンジ") == ("京都東", "interchange")
+    assert key("Kyoto-Higashi IC") == ("kyoto-higashi", "interchange")
+    assert key("多賀SA") == key("多賀サービスエリア") and key("草津PA") == key("草津パーキングエリア")
+
+
+def test_latin_names_ending_in_the_same_letters_are_not_truncated():
+    assert key("Ibusa") == ("ibusa", "")
+    assert key("Kyoto Spa") == ("kyotospa", "")
+    assert key("Nipa") == ("nipa", "")
+    assert key("Pacific") == ("pacific", "")
+    assert len({key("Ibusa"), key("Ibu"), key("Ishic"), key("Ish")}) == 4
+
+
+def test_bare_suffix_and_busta_are_kept():
+    assert key("駅") == ("駅", "")
+    assert key("IC") == ("ic", "")
+    assert key("バスタ新宿") == ("バスタ新宿", "")
+    assert key("アバスタ") == ("アバスタ", "")
+
+
+def test_group_stops_uses_the_most_common_spelling():
+    journals = [
+        {"region_hint": "京都府", "events": [{"type": "stop", "place": "京都駅"}, {"type": "move", "means": "バス"}]},
+        {"region_hint": "京都", "events": [{"type": "stop", "place": "京都 駅"}, {"type": "stop", "place": "京都駅"}]},
+        {"region_hint": "京都府", "events": [{"type": "stop", "place": "京都"}, {"type": "stop", "place": "Ibusa"}]},
+    ]
+    groups = group_stops(journals)
+    assert len(groups) == 3
+    members = groups[place_dedup_key("京都駅", "京都府")]
+    assert len(members) == 3
+    assert representative(members) == ("京都駅", "京都府")
@@ -0,0 +1,111 @@
+"""都道府県の境界による点の包含判定（prefecture_index.py / build_prefecture_boundaries.py）のテスト"""
+import json
+
+import pytest
+
+import build_prefecture_boundaries
+from prefecture_index import PrefectureIndex, load_prefecture_index
+
+
+def square(min_lon, min_lat, max_lon, max_lat):
+    return [[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]
+
+
+def feature(name, geometry_type, coordinates, key="nam_ja"):
+    return {"type": "Feature", "properties": {key: name}, "geometry": {"type": geometry_type, "coordinates": coordinates}}
+
+
+@pytest.fixture
+def index(tmp_path):
+    collection = {"type": "FeatureCollection", "features": [
+        # 穴のある府（穴は別の府県の飛び地のつもり）
+        feature("京都府", "Polygon", [square(135.0, 34.0, 136.0, 35.0), square(135.4, 34.4, 135.6, 34.6)]),
+        # 島ごとのポリゴンを持つ県
+        feature("沖縄県", "MultiPolygon", [
+            [square(127.6, 26.0, 128.3, 26.9)],  # 沖縄本島
+            [square(125.2, 24.7, 125.5, 24.9)],  # 宮古島
+            [square(124.0, 24.3, 124.3, 24.5)],  # 石垣島
+        ], key="N03_001"),
+        # 菱形: 頂点が緯度の帯の境目(0.02度の倍数)に乗る
+        feature("長崎県", "Polygon", [[[129.9, 32.7], [130.0, 32.8], [129.9, 32.9], [129.8, 32.8], [129.9, 32.7]]], key="name"),
+    ]}
+    path = tmp_path / "prefectures.geojson"
+    path.write_text(json.dumps(collection, ensure_ascii=False), encoding="utf-8")
+    return load_prefecture_index(str(path))
+
+
+def test_point_inside_and_outside(index):
+    assert index.contains("京都府", 34.2, 135.2) is True
+    assert index.contains("京都", 34.9, 135.9) is True  # 「府」の有無はそろえる
+    assert index.contains("京都府", 35.5, 135.5) is False  # 外接矩形の外
+    assert index.contains("沖縄県", 34.2, 135.2) is False  # 別の県の中
+
+
+def test_unknown_prefecture_is_none(index):
+    assert index.contains("北海道", 43.06, 141.35) is None
+    assert index.contains("日本", 34.2, 135.2) is None
+    assert not index.knows("北海道") and index.knows("沖縄")
+
+
+def test_hole_is_outside(index):
+    assert index.contains("京都府", 34.5, 135.5) is False
+    assert index.contains("京都府", 34.5, 135.35) is True
+    assert index.contains("京都府", 34.5, 135.65) is True
+
+
+def test_every_island_of_a_multipolygon_counts(index):
+    assert index.contains("沖縄県", 26.2, 127.7) is True
+    assert index.contains("沖縄県", 24.8, 125.3) is True
+    assert index.contains("沖縄県", 24.4, 124.1) is True
+    assert index.contains("沖縄県", 25.5, 126.0) is False  # 島と島の間の海
+
+
+@pytest.mark.parametrize("lat", [32.72, 32.74, 32.76, 32.78, 32.8, 32.82, 32.84, 32.86, 32.88])
+def test_points_on_band_edges(index, lat):
+    # 帯の境目ちょうどの緯度でも、その緯度の辺を取りこぼさない
+    half_width = 0.1 - abs(lat - 32.8)
+    assert index.contains("長崎県", lat, 129.9) is True
+    assert index.contains("長崎県", lat, 129.9 + half_width * 0.9) is True
+    assert index.contains("長崎県", lat, 129.9 + half_width * 1.1) is False
+    assert index.contains("長崎県", lat, 129.9 - half_width * 1.1) is False
+
+
+def test_band_width_does_not_change_the_answer():
+    points = [(34.5 + dy, 135.5 + dx) for dy in (-0.3, -0.1, 0.0, 0.1, 0.3) for dx in (-0.3, -0.1, 0.0, 0.1, 0.3)]
+    answers = []
+    for band in (0.01, 0.02, 0.3, 5.0):
+        index = PrefectureIndex(band)
+        index.add_polygon("京都府", [square(135.0, 34.0, 136.0, 35.0), square(135.4, 34.4, 135.6, 34.6)])
+        answers.append([index.contains("京都府", lat, lon) for lat, lon in points])
+    assert all(answer == answers[0] for answer in answers)
+
+
+def test_missing_file_disables_the_check(tmp_path):
+    assert load_prefecture_index(str(tmp_path / "missing.geojson")) is None
+
+
+def test_built_n03_boundaries_merge_municipalities_and_keep_islands(tmp_path):
+    # N03 と同じ形: 市区町村ごとの Feature に都道府県名 N03_001 がある
+    n03 = {"type": "FeatureCollection", "features": [
+        feature("長崎県", "Polygon", [square(129.8, 32.7, 129.9, 32.8)], key="N03_001"),
+        feature("長崎県", "Polygon", [square(129.9, 32.7, 130.0, 32.8)], key="N03_001"),  # 隣の市（辺を共有）
+        feature("長崎県", "MultiPolygon", [[square(129.0, 34.1, 129.4, 34.7)], [square(129.1, 33.0, 129.1001, 33.0001)]],
+                key="N03_001"),  # 対馬と、間引くと消える小島
+        feature("佐賀県", "Polygon", [square(130.0, 33.0, 130.4, 33.4)], key="N03_001"),
+    ]}
+    source = tmp_path / "N03.geojson"
+    output = tmp_path / "data" / "prefectures.geojson"
+    source.write_text(json.dumps(n03, ensure_ascii=False), encoding="utf-8")
+    build_prefecture_boundaries.main([str(source), "--tolerance", "0.002", "--output", str(output)])
+
+    collection = json.loads(output.read_text(encoding="utf-8"))
+    assert "国土数値情報" in collection["source"]
+    polygons = {f["properties"]["N03_001"]: f["geometry"]["coordinates"] for f in collection["features"]}
+    assert sorted(polygons) == ["佐賀県", "長崎県"]
+    assert len(polygons["長崎県"]) == 3  # 2つの市と対馬。小島は間引きで消える
+    index = load_prefecture_index(str(output))
+    assert index.contains("長崎県", 32.75, 129.85) is True
+    assert index.contains("長崎県", 32.75, 129.95) is True
+    assert index.contains("長崎県", 34.4, 129.2) is True  # 対馬
+    assert index.contains("長崎県", 33.2, 130.2) is False
+    assert index.contains("佐賀県", 33.2, 130.2) is True
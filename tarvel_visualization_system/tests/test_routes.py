@@ -0,0 +1,68 @@
+"""滞在地 → 移動 → 滞在地 の区間の組み立て（routes.py）のテスト"""
+import numpy as np
+import pytest
+
+from routes import build_route_segments, haversine_km, pair_stops_and_moves, polyline_paths, simplify_path
+
+TOKYO = (35.6812, 139.7671)
+OSAKA = (34.7025, 135.4959)
+KYOTO = (34.9858, 135.7588)
+
+
+def stop(place, coords=None):
+    event = {"type": "stop", "place": place}
+    if coords:
+        event["latitude"], event["longitude"] = coords
+    return event
+
+
+def move(means):
+    return {"type": "move", "means": means}
+
+
+def test_haversine_accepts_scalars_and_arrays():
+    assert haversine_km(*TOKYO, *OSAKA) == pytest.approx(403, abs=5)
+    assert haversine_km(*KYOTO, *KYOTO) == 0
+    distances = haversine_km([TOKYO[0], OSAKA[0]], [TOKYO[1], OSAKA[1]], [OSAKA[0], KYOTO[0]], [OSAKA[1], KYOTO[1]])
+    assert distances.shape == (2,)
+    assert distances[1] == pytest.approx(haversine_km(*OSAKA, *KYOTO))
+
+
+def test_moves_pair_with_the_next_stop_that_has_coordinates():
+    events = [move("徒歩"), stop("東京駅", TOKYO), move("新幹線"), move("タクシー"), stop("不明な店"),
+              stop("京都駅", KYOTO), stop("大阪駅", OSAKA)]
+    stops, moves = pair_stops_and_moves(events)
+    assert [s["place"] for s in stops] == ["東京駅", "京都駅", "大阪駅"]
+    assert moves == [{"type": "move", "means": "新幹線"}, None]
+
+
+def test_segments_do_not_cross_journals_and_drop_long_jumps():
+    journals = [
+        [stop("東京駅", TOKYO), move("新幹線"), stop("京都駅", KYOTO), stop("大阪駅", OSAKA)],
+        [stop("大阪駅", OSAKA)],
+        [stop("京都駅", KYOTO), move("電車"), stop("大阪駅", OSAKA)],
+    ]
+    first, single, last = build_route_segments(journals, max_distance_km=100)
+
+    assert len(first) == 2 and first.keep.tolist() == [False, True]
+    assert [k for k, *_ in first.kept()] == [1]
+    assert len(single) == 0 and single.paths() == []
+    assert len(last) == 1
+    assert last.distances_km[0] == pytest.approx(haversine_km(*KYOTO, *OSAKA))
+    [(k, start, end, means)] = last.kept()
+    assert (start, end, means["means"]) == (KYOTO, OSAKA, "電車")
+
+
+def test_polyline_is_split_only_at_dropped_segments():
+    coords = [TOKYO, KYOTO, OSAKA, KYOTO]
+    assert polyline_paths(coords) == [[list(c) for c in coords]]
+    assert polyline_paths(coords, keep=[False, True, True]) == [[list(KYOTO), list(OSAKA), list(KYOTO)]]
+    assert polyline_paths(coords, keep=[True, False, True]) == [[list(TOKYO), list(KYOTO)], [list(OSAKA), list(KYOTO)]]
+    assert polyline_paths(coords, keep=[False, False, False]) == []
+    assert polyline_paths([TOKYO]) == []
+
+
+def test_simplify_path_keeps_endpoints_and_corners():
+    line = np.array([[0, 0], [0.5, 0.0001], [1, 0], [1, 1]], dtype=float)
+    assert simplify_path(line, 0.01).tolist() == [[0, 0], [1, 0], [1, 1]]
+    assert simplify_path(line, 0).tolist() == line.tolist()
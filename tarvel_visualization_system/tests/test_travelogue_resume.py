@@ -0,0 +1,62 @@
+"""設定を変えて再実行したときに、以前の完成データを失わないことのテスト（travelogue.py）"""
+import json
+
+import pytest
+
+import travelogue
+from batch_cli import RunManifest
+from pipeline_stages import StageCheckpoints
+
+PREVIOUS = {
+    "file_num": "00001", "color": "red", "region_hint": "京都府",
+    "events": [
+        {"type": "stop", "place": "京都駅", "latitude": 34.9858, "longitude": 135.7588,
+         "experience": "京都駅に到着した。", "per_tag_emotions": {"景色鑑賞": 0.7}},
+        {"type": "move", "means": "バス", "experience": "市バスで移動した。"},
+        {"type": "stop", "place": "清水寺", "latitude": 34.9949, "longitude": 135.7850,
+         "experience": "紅葉を眺めた。", "per_tag_emotions": {"景色鑑賞": 0.9}},
+    ],
+}
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """元の旅行記ファイルが無く、results_cache に完成データだけがある状態"""
+    cache_dir = tmp_path / "results_cache"
+    cache_dir.mkdir()
+    (cache_dir / "00001.json").write_text(json.dumps(PREVIOUS, ensure_ascii=False), encoding="utf-8")
+    (tmp_path / "data").mkdir()
+    monkeypatch.setattr(travelogue, "directory", f"{tmp_path / 'data'}/")
+    monkeypatch.setattr(travelogue, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(travelogue, "checkpoints", StageCheckpoints(str(tmp_path / "pipeline_cache")))
+    rendered = []
+    monkeypatch.setattr(travelogue, "map_emotion_and_routes", lambda travels, output: rendered.append(travels))
+    manifest_path = str(tmp_path / "manifest.jsonl")
+    RunManifest(manifest_path).record("00001", "done", pipeline="以前の設定のハッシュ")
+    return manifest_path, rendered
+
+
+def test_done_journal_without_raw_file_is_still_rendered(workspace):
+    manifest_path, rendered = workspace
+    travelogue.main(["00001", "--manifest", manifest_path, "--processes", "0", "--output", "unused.html"])
+
+    assert len(rendered) == 1
+    [travel] = rendered[0]
+    assert [e.get("per_tag_emotions") for e in travel["events"] if e["type"] == "stop"] == [{"景色鑑賞": 0.7}, {"景色鑑賞": 0.9}]
+    assert RunManifest(manifest_path).status("00001") == "done"
+
+
+def test_done_is_not_downgraded_to_skipped(workspace, monkeypatch):
+    manifest_path, rendered = workspace
+    monkeypatch.setattr(travelogue, "extract_journal", lambda *args, **kwargs: None)
+    travelogue.main(["00001", "--manifest", manifest_path, "--processes", "0", "--output", "unused.html"])
+
+    assert RunManifest(manifest_path).status("00001") == "done"
+    assert [travel["file_num"] for travel in rendered[0]] == ["00001"]
+
+
+def test_endpoint_urls_do_not_change_the_pipeline_fingerprint(monkeypatch):
+    fingerprint = travelogue.pipeline_fingerprint()
+    monkeypatch.setenv("NOMINATIM_URL", "http://127.0.0.1:8801/search")
+    monkeypatch.setenv("GSI_URL", "http://127.0.0.1:8801/address-search/AddressSearch")
+    assert travelogue.pipeline_fingerprint() == fingerprint
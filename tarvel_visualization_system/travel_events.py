@@ -0,0 +1,65 @@
+"""
+旅行記の完成データの共通形式（イベント列）と、2種類のキャッシュの読み込み
+
+travelogue.py の results_cache/ は events（滞在 stop と移動 move のイベント列）の形、
+routeonly.py の以前の results_cache_0707/ は places（座標の取れた訪問地のリスト）の形で保存されている。
+どちらも travelogue.py と同じ次の形（共通形式）に変換して扱う。
+
+    {"file_num": 旅行記番号, "color": 軌跡の色, "region_hint": 都道府県,
+     "events": [
+         {"type": "stop", "place": 地名, "latitude": 緯度, "longitude": 経度, "experience": 体験, ...},
+         {"type": "move", "means": 移動手段, "experience": 体験},
+         ...
+     ]}
+
+- 座標の取れなかった滞在地には latitude / longitude が無い
+- stop のその他のキー（per_tag_emotions, emotion_score, tags, reasoning など）は元のまま残す
+- places の訪問地は、順にそのまま stop イベントにする（move イベントは無い）
+
+EventStore は複数のキャッシュディレクトリを順に探すので、routeonly.py は travelogue.py で処理済みの
+旅行記を、APIを呼ばずに軌跡の地図に使える。
+"""
+import json
+import os
+
+
+def places_to_events(places):
+    """places 形式の訪問地のリストを stop イベントのリストにする"""
+    return [{"type": "stop", **place} for place in places]
+
+
+def to_events(data):
+    """events 形式・places 形式のどちらの完成データも、共通形式にする（元のデータは書き換えない）"""
+    if "events" in data:
+        return data
+    travel = {key: value for key, value in data.items() if key != "places"}
+    travel["events"] = places_to_events(data.get("places", []))
+    return travel
+
+
+def trace_points(travel):
+    """軌跡の頂点（座標のある滞在地の (緯度, 経度) を旅程の順に並べたもの）"""
+    return [(e["latitude"], e["longitude"]) for e in travel.get("events", [])
+            if e.get("type") == "stop" and e.get("latitude") is not None and e.get("longitude") is not None]
+
+
+class EventStore:
+    """<ディレクトリ>/<旅行記番号>.json を directories の順に探し、共通形式で返す"""
+
+    def __init__(self, directories):
+        self.directories = list(dict.fromkeys(directories))
+
+    def find(self, file_num):
+        """(見つかったディレクトリ, 共通形式の完成データ)。どこにも無ければ None"""
+        for directory in self.directories:
+            path = os.path.join(directory, f"{file_num}.json")
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                continue
+            except json.JSONDecodeError:
+                print(f"[WARNING] 完成データを読み込めません: {path}")
+                continue
+            return directory, to_events(data)
+        return None
@@ -1,36 +1,85 @@
-import openai
 import os
-from dotenv import load_dotenv
 import json
+import time
+import hashlib
+import multiprocessing
+import threading
 import folium
-from folium.plugins import HeatMap
-from geopy.geocoders import Nominatim
-from geopy.distance import distance ### ★★★ 機能追加 ★★★
 from collections import defaultdict
-import time
-import requests
-import urllib.parse
 from datetime import datetime
-import base64
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from branca.element import MacroElement
 from jinja2 import Template
-
-# .envファイルから環境変数を読み込む
-load_dotenv()
-API_KEY = os.getenv('OPENAI_API_KEY')
-if not API_KEY:
-    raise ValueError("OpenAIのAPIキーが設定されていません。.envファイルを確認してください。")
-openai.api_key = API_KEY
+from llm_engine import LLMEngine
+from llm_cache import LLMCache, DEFAULT_CACHE_PATH
+from geocode_cache import GeocodeCache
+from geocode_scheduler import GeocodeScheduler, NominatimProvider, GSIProvider, NOMINATIM_URL, GSI_URL
+from gazetteer import load_gazetteer
+from place_dedup import group_stops, representative
+from prefecture_index import load_prefecture_index
+from map_assets import AssetTable, SharedIcon, read_as_data_uri
+from lazy_popups import LazyPopupLoader, LazyPopup, stop_entry, move_entry, stop_popup_html, move_popup_html
+from fast_markers import FastMarkers, choose_render_mode
+from routes import build_route_segments
+from emotion_grid import EmotionGrid, DEFAULT_GRID_LEVELS
+from map_shards import ShardLoader, ShardLayer, shard_file_name
+from layer_panel import TravelLayerPanel
+from render_fragments import FragmentCache, AssetRecorder, fragment_key
+from map_stream import MapWriter
+from batch_cli import parse_args, resolve_ids, select_shard, RunManifest, read_id_file_interactively
+from cache_files import write_json_atomic
+from pipeline_stages import StageCheckpoints, code_fingerprint, stage_key
+from openai_setup import chat_completion, authentication_errors
 
 # ========== 設定 ==========
 directory = "../../2022-地球の歩き方旅行記データセット/data_arukikata/data/domestic/with_schedules/"
 base_name = "visited_places_map_emotion_"
 extension = ".html"
 CACHE_DIR = "results_cache" ### ★★★ 機能追加: キャッシュ用ディレクトリ ★★★
+PIPELINE_CACHE_DIR = "pipeline_cache"  ### ★★★ 機能追加: 抽出・ジオコーディング・タグ付けのステージごとのチェックポイント ★★★
+RUN_MANIFEST_PATH = os.path.join(CACHE_DIR, "manifest.jsonl")  ### ★★★ 機能追加: 旅行記ごとの処理結果の記録（--manifest で変更、--shard 指定時は shard ごとに別ファイル） ★★★
 MAX_DISTANCE_KM = 100  ### ★★★ 機能追加: 線を描画する最大距離(km) ★★★
+ROUTE_SIMPLIFY_TOLERANCE = 0  ### ★★★ 機能追加: 軌跡をDouglas–Peucker法で間引くときの許容誤差(度、0なら間引かない) ★★★
+RENDER_CACHE_DIR = "render_cache"  ### ★★★ 機能追加: 旅行記ごとの描画結果のキャッシュ（Noneなら毎回すべて描画し直す） ★★★
+RENDER_BATCH_SIZE = 200  ### ★★★ 機能追加: 描画し直す旅行記の区間距離をまとめて計算する件数 ★★★
+STREAM_RENDER = "auto"  ### ★★★ 機能追加: "always"=地図の骨組みを先に書き出し、旅行記ごとのレイヤーを順に追記する / "never"=全体を組み立ててから保存 / "auto"=件数で切り替え ★★★
+STREAM_RENDER_THRESHOLD = 500  ### ★★★ 機能追加: "auto"のとき、旅行記がこの件数を超えたら"always"にする ★★★
+POPUP_MODE = "inline"  ### ★★★ 機能追加: "lazy"=ポップアップの中身を旅行記ごとのサイドカー(<HTML名>_popups/)からクリック時に読み込む ★★★
+ASSET_MODE = "inline"  ### ★★★ 機能追加: アイコン・GIFを "inline"=HTMLに1回だけ埋め込む / "files"=map_assets/に書き出して参照 ★★★
+RENDER_MODE = "auto"  ### ★★★ 機能追加: "markers"=従来のマーカー / "cluster"=クラスタリング / "canvas"=canvasの円マーカー / "auto"=件数で切り替え ★★★
+RENDER_MARKER_THRESHOLD = 3000  ### ★★★ 機能追加: "auto"のとき、滞在地がこの件数を超えたら"cluster"にする ★★★
+ICON_MIN_ZOOM = 14  ### ★★★ 機能追加: "cluster"/"canvas"でタグのアイコンを表示し始めるズームレベル ★★★
+MAP_OUTPUT_MODE = "single"  ### ★★★ 機能追加: "single"=1つのHTML / "sharded"=索引HTML + <HTML名>_shards/ に分割し、表示時に読み込む ★★★
+LAYER_CONTROL_MODE = "auto"  ### ★★★ 機能追加: "leaflet"=従来のレイヤーコントロール / "panel"=検索・絞り込みつきの仮想スクロールパネル / "auto"=件数で切り替え ★★★
+LAYER_PANEL_THRESHOLD = 50  ### ★★★ 機能追加: "auto"のとき、旅行記がこの件数を超えたら"panel"にする ★★★
+LAYER_PANEL_INITIAL = 20  ### ★★★ 機能追加: "panel"で読み込み時に表示しておく旅行記の数 ★★★
+SHARD_BY = "journal"  ### ★★★ 機能追加: "sharded"のときのシャードの単位 "journal"=旅行記ごと / "prefecture"=region_hintの都道府県ごと ★★★
+HEATMAP_MODE = "grid"  ### ★★★ 機能追加: "grid"=セルごとの平均スコアを前計算して描画 / "points"=従来どおり全点をHeatMapに渡す ★★★
+HEATMAP_GRID_LEVELS = DEFAULT_GRID_LEVELS  ### ★★★ 機能追加: (使い始めるズームレベル, セルの大きさ[度]) のリスト ★★★
+HEATMAP_EXPORT_PATH = None  ### ★★★ 機能追加: セル集計の書き出し先（.csv か .parquet、Noneなら書き出さない） ★★★
 COLORS = ['blue', 'red', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen', 'cadetblue', 'lightgray']
-WAIT_TIME = 1
+WAIT_TIME = 1  # Nominatimへの問い合わせ間隔(秒)。トークンバケットのレートとして使う
+GSI_RATE = 5  ### ★★★ 機能追加: 国土地理院APIへの問い合わせレート(回/秒) ★★★
+GEOCODE_WORKERS = 8  ### ★★★ 機能追加: 同時に捌くジオコーディング問い合わせ数 ★★★
+GEOCODE_HEDGED = True  ### ★★★ 機能追加: NominatimとGSIを競争させ、先に返った妥当な結果を使う ★★★
+GEOCODE_PRECEDENCE = ["nominatim", "gsi"]  # 問い合わせる順番（同時に返ったときの優先順位）
+GEOCODE_HEDGE_DELAY = None  # 2番手を投げるまでの秒数（0で同時、Noneで1番手のp95遅延）
+GPT_COORDS_POLICY = "trust_in_region"  ### ★★★ 機能追加: "trust_in_region"=GPT推定座標がregion_hintの都道府県内ならそのまま採用 / "fallback"=従来どおり予備扱い ★★★
+PREFECTURE_GEOJSON_PATH = "data/prefectures.geojson"  # 都道府県の境界ポリゴン（build_prefecture_boundaries.py で作る。無ければ "fallback" と同じ動作）
+GAZETTEER_PATH = "gazetteer.tsv"  ### ★★★ 機能追加: オフライン地名辞書（TSV、無ければネットワークのみ） ★★★
 MODEL = "gpt-4o"
+JOURNAL_WORKERS = 4  ### ★★★ 機能追加: 同時に処理する旅行記の数 ★★★
+JOURNAL_PROCESSES = 0  ### ★★★ 機能追加: 旅行記を1件ずつ丸ごと処理するワーカープロセスの数（0ならスレッドでバッチ処理、--processes で変更） ★★★
+JOURNAL_BATCH_SIZE = 200  ### ★★★ 機能追加: 地名を名寄せしてまとめてジオコーディングする旅行記の数 ★★★
+LLM_MAX_CONCURRENCY = 8  ### ★★★ 機能追加: 同時に投げるAPIリクエストの上限 ★★★
+LLM_RATE_LIMITS = {  ### ★★★ 機能追加: モデルごとのRPM/TPM予算（契約しているTierに合わせて変更） ★★★
+    "gpt-4o": {"rpm": 500, "tpm": 30000},
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 200000},
+}
+LLM_CACHE_PATH = DEFAULT_CACHE_PATH  ### ★★★ 機能追加: プロンプト単位の応答キャッシュ（routeonly.py等と共有） ★★★
+LLM_CACHE_MAX_BYTES = 512 * 1024 * 1024
+EMOTION_BATCH_MODE = True  ### ★★★ 機能追加: 1旅行記分の滞在地をまとめて感情分析する ★★★
+EMOTION_BATCH_TOKEN_BUDGET = 6000  # 1リクエストにまとめる体験テキストの上限（おおよそのトークン数）
 prefix = '```json'
 suffix = '```'
 
@@ -126,11 +175,65 @@ TAG_TO_GIF = {
 }
 # ========================================================
 
-geolocator = Nominatim(user_agent="travel-map-final")
+### ★★★ 機能追加: プロバイダーごとのトークンバケットで並列に問い合わせる（URLは環境変数でモックに差し替え可能） ★★★
+def build_geocoder(share=1):
+    """share 個のプロセスで分け合うときは、各プロセスのレートを 1/share にする"""
+    providers = [
+        NominatimProvider(os.getenv("NOMINATIM_URL", NOMINATIM_URL), user_agent="travel-map-final", rate=1 / WAIT_TIME / share),
+        GSIProvider(os.getenv("GSI_URL", GSI_URL), rate=GSI_RATE / share),
+    ]
+    if gazetteer: providers.insert(0, gazetteer)
+    return GeocodeScheduler(providers, cache=geocode_cache, max_workers=GEOCODE_WORKERS)
+
+def build_llm_engine(share=1):
+    """share 個のプロセスで分け合うときは、同時実行数と RPM/TPM の予算を 1/share にする"""
+    rate_limits = {model: {name: limit / share for name, limit in limits.items()} for model, limits in LLM_RATE_LIMITS.items()}
+    return LLMEngine(max_concurrency=max(1, LLM_MAX_CONCURRENCY // share), rate_limits=rate_limits, cache=llm_cache,
+                     create_fn=chat_completion)
+
+### ★★★ 機能追加: ジオコーダーとLLMエンジンは、そのステージを初めて実行するときに作る（地図の生成だけならAPIキーもネットワークも使わない） ★★★
+geocode_cache = gazetteer = geocoder = prefecture_index = None  # start_geocoder() が作る
+llm_cache = llm_engine = None  # start_llm_engine() が作る
+api_share = 1  # ワーカープロセスでは processes（APIのレート予算を等分する）
+_start_lock = threading.Lock()
+checkpoints = StageCheckpoints(PIPELINE_CACHE_DIR)
+
+def start_geocoder():
+    global geocode_cache, gazetteer, geocoder, prefecture_index
+    with _start_lock:
+        if geocoder is not None: return
+        geocode_cache = GeocodeCache()  # 旅行記・実行をまたいで共有するジオコーディングキャッシュ
+        gazetteer = load_gazetteer(GAZETTEER_PATH)
+        prefecture_index = load_prefecture_index(PREFECTURE_GEOJSON_PATH) if GPT_COORDS_POLICY == "trust_in_region" else None
+        geocoder = build_geocoder(api_share)
+
+def start_llm_engine():
+    global llm_cache, llm_engine
+    with _start_lock:
+        if llm_engine is not None: return
+        llm_cache = LLMCache(LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES)
+        llm_engine = build_llm_engine(api_share)
 
 class LayerToggleButtons(MacroElement):
     _template = Template("""
         {% macro script(this, kwargs) %}
+            // ★★★ 機能追加: 「旅行記ルート」「移動手段」のレイヤーを直接参照し、まとめて追加・削除する ★★★
+            var travelToggleLayers = [{{ this.layers|join(", ") }}];
+            var travelLayerControl = {{ this.layer_control.get_name() }};
+            function setTravelLayers(map, visible) {
+                // レイヤーを1つ追加・削除するたびにレイヤーコントロールが作り直されないよう、
+                // クリック処理中の扱いにしておき、最後に1回だけ再描画する
+                travelLayerControl._handlingClick = true;
+                try {
+                    travelToggleLayers.forEach(function(layer) {
+                        if (visible && !map.hasLayer(layer)) { map.addLayer(layer); }
+                        else if (!visible && map.hasLayer(layer)) { map.removeLayer(layer); }
+                    });
+                } finally {
+                    travelLayerControl._handlingClick = false;
+                    travelLayerControl._update();
+                }
+            }
             var toggleControl = L.Control.extend({
                 onAdd: function(map) {
                     var container = L.DomUtil.create('div', 'leaflet-bar leaflet-control');
@@ -149,20 +252,7 @@ class LayerToggleButtons(MacroElement):
                     
                     showButton.onclick = function(e) {
                         e.stopPropagation();
-                        document.querySelectorAll('.leaflet-control-layers-overlays label').forEach(function(labelDiv) {
-                            const span = labelDiv.querySelector('span');
-                            const checkbox = labelDiv.querySelector('input[type="checkbox"]');
-                            if (span && checkbox) {
-                                const labelText = span.textContent.trim();
-                                // ★★★ 修正箇所 ★★★
-                                // 「旅行記ルート」または「移動手段」で始まるレイヤーを対象にする
-                                if (labelText.startsWith('旅行記ルート') || labelText.startsWith('移動手段')) {
-                                    if (!checkbox.checked) {
-                                        checkbox.click();
-                                    }
-                                }
-                            }
-                        });
+                        setTravelLayers(map, true);
                     };
 
                     // --- 全非表示ボタン ---
@@ -176,20 +266,7 @@ class LayerToggleButtons(MacroElement):
 
                     hideButton.onclick = function(e) {
                         e.stopPropagation();
-                        document.querySelectorAll('.leaflet-control-layers-overlays label').forEach(function(labelDiv) {
-                            const span = labelDiv.querySelector('span');
-                            const checkbox = labelDiv.querySelector('input[type="checkbox"]');
-                            if (span && checkbox) {
-                                const labelText = span.textContent.trim();
-                                // ★★★ 修正箇所 ★★★
-                                // 「旅行記ルート」または「移動手段」で始まるレイヤーを対象にする
-                                if (labelText.startsWith('旅行記ルート') || labelText.startsWith('移動手段')) {
-                                    if (checkbox.checked) {
-                                        checkbox.click();
-                                    }
-                                }
-                            }
-                        });
+                        setTravelLayers(map, false);
                     };
                     
                     return container;
@@ -200,47 +277,88 @@ class LayerToggleButtons(MacroElement):
         {% endmacro %}
     """)
 
-    def __init__(self):
+    def __init__(self, layer_control, layers):
         super(LayerToggleButtons, self).__init__()
         self._name = 'LayerToggleButtons'
+        self.layer_control = layer_control
+        self.layers = layers  # 全表示・全非表示の対象（旅行記ルート・移動手段のレイヤーのJS変数名）
 
 # --- 座標取得・テキスト抽出・分析関数群 ---
 def get_image_as_base64(file_path):
-    """画像ファイルを読み込み、HTML埋め込み用のBase64文字列を返す"""
-    try:
-        with open(file_path, "rb") as f:
-            encoded_string = base64.b64encode(f.read()).decode("utf-8")
-        # ファイル拡張子に応じてMIMEタイプを決定 (ここではgifに固定)
-        return f"data:image/gif;base64,{encoded_string}"
-    except FileNotFoundError:
-        print(f"[WARNING] 画像ファイルが見つかりません: {file_path}")
-        return None
+    """画像ファイルを読み込み、HTML埋め込み用のBase64文字列を返す（同じファイルは1回しか読まない）"""
+    return read_as_data_uri(file_path)
 
 def geocode_gsi(name):
-    """国土地理院APIを使って地名の緯度経度を取得する"""
-    try:
-        query = urllib.parse.quote(name)
-        url = f"https://msearch.gsi.go.jp/address-search/AddressSearch?q={query}"
-        print(f"🗺️ Geocoding (GSI): '{name}'...")
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if data and isinstance(data, list):
-            coords = data[0]['geometry']['coordinates']
-            lon, lat = coords[0], coords[1]
-            return lat, lon
-    except: return None
+    """国土地理院APIを使って地名の緯度経度を取得する（キャッシュにあれば問い合わせない）"""
+    return geocoder.geocode("gsi", name)
 
 def geocode_place(name, region_hint):
-    """Geopyを使って地名の緯度経度を取得する"""
+    """Nominatimを使って地名の緯度経度を取得する（キャッシュにあれば問い合わせもレート待ちもしない）"""
+    return geocoder.geocode("nominatim", name, region_hint)
+
+def gpt_coords(stop_event):
+    """GPTが推定した座標を (緯度, 経度) で返す。無い・(0, 0)・数値でない場合は None"""
     try:
-        query = f"{name}, {region_hint}"
-        print(f"🗺️ Geocoding (Geopy): '{query}'...")
-        location = geolocator.geocode(query, timeout=10)
-        time.sleep(WAIT_TIME)
-        if location:
-            return location.latitude, location.longitude
-    except: return None
+        coords = (float(stop_event.get('latitude', 0.0)), float(stop_event.get('longitude', 0.0)))
+    except (TypeError, ValueError):
+        return None
+    return None if coords == (0.0, 0.0) else coords
+
+def is_trusted_gpt_coords(stop_event, region_hint):
+    """GPT推定座標が region_hint の都道府県の境界内にあれば True"""
+    if prefecture_index is None: return False
+    coords = gpt_coords(stop_event)
+    return bool(coords) and prefecture_index.contains(region_hint, coords[0], coords[1]) is True
+
+def geocode_place_group(members):
+    """
+    名寄せした滞在地グループの座標を決め、各滞在イベントに書き込む。
+    地名辞書 → Nominatim → 各イベントのGPT推定座標 → 国土地理院 の順に試す。
+    GEOCODE_HEDGED のときは Nominatim と国土地理院を競争させ、どちらも駄目ならGPT推定座標を使う。
+    GPT_COORDS_POLICY が "trust_in_region" なら、都道府県内に収まるGPT推定座標はそのまま採用する。
+    """
+    ### ★★★ 機能追加: 都道府県内に収まるGPT推定座標はネットワークに問い合わせずに採用 ★★★
+    untrusted = []
+    for stop_event, hint in members:
+        if is_trusted_gpt_coords(stop_event, hint):
+            stop_event['latitude'], stop_event['longitude'] = gpt_coords(stop_event)
+        else:
+            untrusted.append((stop_event, hint))
+    if not untrusted: return
+    members = untrusted
+
+    place_name, region_hint = representative(members)
+    coords = None
+    if geocoder.has_provider("gazetteer"):
+        coords = geocoder.geocode("gazetteer", place_name, region_hint)
+    gsi_coords, gsi_done = None, False
+    if not coords and GEOCODE_HEDGED:
+        coords = geocoder.geocode_hedged(place_name, region_hint, GEOCODE_PRECEDENCE, delay=GEOCODE_HEDGE_DELAY)
+        gsi_done = True  # 国土地理院は競争の中で問い合わせ済み
+    if not coords and not GEOCODE_HEDGED:
+        coords = geocode_place(place_name, region_hint)
+    for stop_event, _ in members:
+        event_coords = coords
+        if not event_coords:
+            event_coords = gpt_coords(stop_event)
+        if not event_coords:
+            if not gsi_done:
+                gsi_coords, gsi_done = geocode_gsi(place_name), True
+            event_coords = gsi_coords
+
+        if event_coords:
+            stop_event['latitude'] = event_coords[0]
+            stop_event['longitude'] = event_coords[1]
+        else:
+            print(f"[!] ジオコーディング失敗: {stop_event['place']}")
+            if 'latitude' in stop_event: del stop_event['latitude']
+
+def geocode_unique_places(journals):
+    """バッチ内の全旅行記の滞在地を名寄せし、ユニークな地名ごとに1回だけジオコーディングする"""
+    groups = group_stops(journals)
+    total = sum(len(members) for members in groups.values())
+    print(f"\n🔑 滞在地 {total}件 → ユニークな地名 {len(groups)}件をジオコーディングします。")
+    geocoder.map(geocode_place_group, list(groups.values()))
 
 def extract_events(texts, region_hint):
     """GPTを使って旅行記から「滞在」と「移動」のイベントを時系列で抽出する"""
@@ -295,9 +413,7 @@ def extract_events(texts, region_hint):
     **分析対象テキスト（日本の「{region_hint}」周辺）:**
     {texts}
     """
-    # (openai.ChatCompletion.createの呼び出し部分は変更なし)
-    response = openai.ChatCompletion.create(model=MODEL, messages=[{"role": "system", "content": f"あなたは旅行記を時系列で分析し、滞在（stop）と移動（move）のイベントを正確に抽出する専門家です。"}, {"role": "user", "content": prompt}], temperature=0.5)
-    textforarukikata = response.choices[0].message.content.strip()
+    textforarukikata = llm_engine.complete(model=MODEL, messages=[{"role": "system", "content": f"あなたは旅行記を時系列で分析し、滞在（stop）と移動（move）のイベントを正確に抽出する専門家です。"}, {"role": "user", "content": prompt}], temperature=0.5).strip()
     if prefix in textforarukikata: textforarukikata = textforarukikata.split(prefix, 1)[1]
     if suffix in textforarukikata: textforarukikata = textforarukikata.rsplit(suffix, 1)[0]
     try:
@@ -313,8 +429,7 @@ def get_visit_hint(visited_places_text):
     if not visited_places_text.strip(): return "日本"
     messages = [{"role": "system", "content": "都道府県名を答えるときは，県名のみを答えてください．"}, {"role": "user", "content": f"以下の旅行記データから筆者が訪れたと考えられる都道府県を1つだけ答えてください．ただし，特定の語句に拘らずに旅行記全体から総合的に判断してください．\n\n{visited_places_text}"}]
     try:
-        response = openai.ChatCompletion.create(model='gpt-3.5-turbo', messages=messages, temperature=0.2)
-        return response.choices[0].message.content.strip()
+        return llm_engine.complete(model='gpt-3.5-turbo', messages=messages, temperature=0.2).strip()
     except: return "日本"
     
 def analyze_stop_emotions_by_tag(text, action_tags_list):
@@ -347,7 +462,7 @@ def analyze_stop_emotions_by_tag(text, action_tags_list):
     テキスト: 「{text}」
     """
     try:
-        response = openai.ChatCompletion.create(
+        content = llm_engine.complete(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": "あなたはテキストを多角的に分析し、関連する行動タグとそのタグに対応する個別の感情スコアをJSONオブジェクトとして正確に出力する専門家です。"},
@@ -357,238 +472,674 @@ def analyze_stop_emotions_by_tag(text, action_tags_list):
             response_format={"type": "json_object"}
         )
         # resultは {"タグ1": スコア1, "タグ2": スコア2, ...} という形式
-        result = json.loads(response.choices[0].message.content)
+        result = json.loads(content)
         
         print(f"✅ Per-tag analysis successful. Result: {result}")
         return result
         
-    except openai.error.AuthenticationError as e:
+    except authentication_errors() as e:
         print(f"[FATAL ERROR] OpenAI認証エラー: {e}")
         raise
     except Exception as e:
         print(f"[ERROR] タグ別感情分析中にエラーが発生しました: {e}")
         return {}
 
-def map_emotion_and_routes(travels_data, output_html):
-    """訪問地、移動手段、およびタグ別感情ヒートマップをレイヤー化して地図を生成する"""
-    if not travels_data: print("[ERROR] 地図に描画するデータがありません。"); return
+def _is_valid_emotions(result, action_tags_list):
+    """タグ別感情スコアの形式（{タグ: 0.0〜1.0}）を満たしているか確認する"""
+    if not isinstance(result, dict): return False
+    for tag, score in result.items():
+        if tag not in action_tags_list: return False
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0.0 <= score <= 1.0: return False
+    return True
+
+def _chunk_by_token_budget(indexed_texts, budget):
+    """(番号, テキスト)のリストを、合計文字数がbudgetを超えないチャンクに分割する"""
+    chunks, current, size = [], [], 0
+    for index, text in indexed_texts:
+        if current and size + len(text) > budget:
+            chunks.append(current); current, size = [], 0
+        current.append((index, text)); size += len(text)
+    if current: chunks.append(current)
+    return chunks
+
+def _analyze_emotion_chunk(chunk, action_tags_list):
+    """複数の体験テキストを1回のAPIコールで分析し、{番号: 結果} を返す（検証に通ったものだけ）"""
+    print(f"⚡️ Analyzing (Per-Tag Emotions, batch) for {len(chunk)} stops...")
+    numbered_texts = "\n".join(f"[id:{index}] 「{text}」" for index, text in chunk)
+    prompt = f"""
+    以下は、旅行中の複数の「滞在」場所での経験を、番号（id）付きで列挙したものです。
+    各テキストについて、以下のステップを同時に実行してください。
+
+    1.  **タグ抽出**: 提示された「行動」タグリストの中から、テキスト内容に最も関連性の高いタグをすべて選択してください。
+    2.  **タグ別感情分析**: ステップ1で選択した各タグについて、そのタグに関連するテキスト部分の感情を個別に分析し、0.0（非常にネガティブ）から1.0（非常にポジティブ）のスコアを算出してください。
+
+    出力は必ず、キー "results" に各テキストの結果を並べたJSONオブジェクトで返してください。
+    各結果は "id"（入力の番号）と "emotions"（キーが「タグ名」、値が「感情スコア」のオブジェクト）を持ちます。
+    関連性の高いタグが一つもなければ、"emotions" は空のオブジェクト `{{}}` としてください。
+
+    例:
+    {{
+        "results": [
+            {{"id": 0, "emotions": {{"食事(飲酒なし・不明)": 0.85, "景色鑑賞": 1.0}}}},
+            {{"id": 1, "emotions": {{}}}}
+        ]
+    }}
+    ---
+    「行動」タグリスト: {action_tags_list}
+    ---
+    テキスト:
+    {numbered_texts}
+    """
     try:
-        first_stop = next((p for t in travels_data for p in t['events'] if p.get('type') == 'stop' and 'latitude' in p), None)
-        start_coords = (first_stop['latitude'], first_stop['longitude']) if first_stop else (35.6812, 139.7671)
-        m = folium.Map(location=start_coords, zoom_start=10)
-    except (IndexError, KeyError):
-        m = folium.Map(location=[35.6812, 139.7671], zoom_start=10)
-    
-    heatmap_data_by_tag = defaultdict(list)
+        content = llm_engine.complete(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "あなたはテキストを多角的に分析し、関連する行動タグとそのタグに対応する個別の感情スコアをJSONオブジェクトとして正確に出力する専門家です。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.1,
+            response_format={"type": "json_object"}
+        )
+        results = json.loads(content).get("results", [])
+    except authentication_errors() as e:
+        print(f"[FATAL ERROR] OpenAI認証エラー: {e}")
+        raise
+    except Exception as e:
+        print(f"[ERROR] タグ別感情分析（一括）中にエラーが発生しました: {e}")
+        return {}
 
-    for travel in travels_data:
-        file_num, color, events = travel["file_num"], travel["color"], travel.get("events", [])
-        
-        route_group = folium.FeatureGroup(name=f"旅行記ルート: {file_num}", show=True)
-        move_group = folium.FeatureGroup(name=f"移動手段: {file_num}", show=True)
+    expected = {index for index, _ in chunk}
+    valid = {}
+    for item in results if isinstance(results, list) else []:
+        if not isinstance(item, dict): continue
+        index = item.get("id")
+        if index in expected and index not in valid and _is_valid_emotions(item.get("emotions"), action_tags_list):
+            valid[index] = item["emotions"]
+    return valid
+
+def analyze_stops_emotions_batch(texts, action_tags_list):
+    """
+    1旅行記分の体験テキストをトークン予算ごとのチャンクにまとめて分析し、入力順の結果リストを返す。
+    一括分析の結果が欠けている・形式が不正なテキストは、1件ずつの分析にフォールバックする。
+    """
+    results = [{} for _ in texts]
+    indexed_texts = [(i, t) for i, t in enumerate(texts) if t and t.strip()]
+    chunks = _chunk_by_token_budget(indexed_texts, EMOTION_BATCH_TOKEN_BUDGET)
+    answered = {}
+    for chunk_result in llm_engine.map(lambda c: _analyze_emotion_chunk(c, action_tags_list), chunks):
+        answered.update(chunk_result)
 
-        stop_events = [e for e in events if e.get('type') == 'stop' and 'latitude' in e]
+    failed = [(i, t) for i, t in indexed_texts if i not in answered]
+    if failed:
+        print(f"[INFO] 一括分析で結果が得られなかった {len(failed)} 件を個別に分析します。")
+        answered.update(zip([i for i, _ in failed], llm_engine.map(lambda it: analyze_stop_emotions_by_tag(it[1], action_tags_list), failed)))
+    for index, emotions in answered.items():
+        results[index] = emotions
+    return results
+
+def render_journal(travel, segments, assets):
+    """
+    旅行記1件分の描画結果（フラグメント）を作る。
+    マーカーは [緯度, 経度, アイコンキー, ツールチップ, ポップアップ] の行で持ち、地図の描画方式
+    （markers/cluster/canvas、single/sharded）には依存しない。JSONにできる値だけを使う。
+    """
+    file_num = travel["file_num"]
+    fragment = {"stop_rows": [], "move_rows": [], "route_paths": [], "tags": [], "heat": {}, "popups": []}
+    journal_tags = set()
+
+    for stop_data in segments.stops:
+        coords = (stop_data['latitude'], stop_data['longitude'])
+        per_tag_emotions = stop_data.get('per_tag_emotions', {})
+
+        ### ★★★ ここが修正箇所です ★★★
+        # per_tag_emotions 辞書のキー（＝タグ名）からタグのリストを作成
+        tags = list(per_tag_emotions.keys())
         
-        for stop_data in stop_events:
-            coords = (stop_data['latitude'], stop_data['longitude'])
-            per_tag_emotions = stop_data.get('per_tag_emotions', {})
+        # --- アイコンを決定するロジック ---
+        icon_key = None
+        place_tags_set = set(tags)
+        for tag in TAG_PRIORITY:
+            if tag in place_tags_set and tag in TAG_TO_IMAGE:
+                icon_key = assets.icon_key(TAG_TO_IMAGE[tag], (35, 35))
+                if icon_key: break
+        if icon_key is None:
+            icon_key = assets.icon_key(DEFAULT_ICON_IMAGE, (30, 30))
+        
+        # --- ポップアップの組み立て（"lazy" ではサイドカー用のデータと通し番号。どちらも同じエスケープ済みのデータから作る） ---
+        gifs = [(tag, assets.asset_key(TAG_TO_GIF[tag])) for tag in tags if tag in TAG_TO_GIF]
+        entry = stop_entry(file_num, stop_data, per_tag_emotions, [g for g in gifs if g[1]])
+        if POPUP_MODE == "lazy":
+            fragment["popups"].append(entry)
+            popup = [str(file_num), len(fragment["popups"]) - 1]
+        else:
+            popup = stop_popup_html(entry)
 
-            ### ★★★ ここが修正箇所です ★★★
-            # per_tag_emotions 辞書のキー（＝タグ名）からタグのリストを作成
-            tags = list(per_tag_emotions.keys())
-            
-            # --- アイコンを決定するロジック ---
-            icon_to_use = None
-            place_tags_set = set(tags)
-            for tag in TAG_PRIORITY:
-                if tag in place_tags_set and tag in TAG_TO_IMAGE:
-                    image_path = TAG_TO_IMAGE[tag]
-                    if os.path.exists(image_path):
-                        icon_to_use = folium.features.CustomIcon(image_path, icon_size=(35, 35))
-                        break
-            if icon_to_use is None:
-                if os.path.exists(DEFAULT_ICON_IMAGE):
-                    icon_to_use = folium.features.CustomIcon(DEFAULT_ICON_IMAGE, icon_size=(30, 30))
-                else:
-                    icon_to_use = folium.Icon(color="gray", icon="question-sign")
-            
-            # --- ポップアップHTMLの組み立て ---
-            popup_html = f"<b>{stop_data['place']}</b> (旅行記: {file_num})<br>"
-            if per_tag_emotions:
-                popup_html += f"<hr style='margin: 3px 0;'>"
-                popup_html += "<b>タグ別感情スコア:</b><br>"
-                tag_html = ""
-                for tag, score in per_tag_emotions.items():
-                    tag_style = "display:inline-block; background-color:#E0E0E0; color:#333; padding:2px 6px; margin:2px; border-radius:4px; font-size:12px;"
-                    tag_html += f"<span style='{tag_style}'>{tag} ({score:.2f})</span>"
-                popup_html += tag_html
+        fragment["stop_rows"].append([coords[0], coords[1], icon_key, f"{entry['p']} ({entry['f']})", popup])
+        
+        # --- ヒートマップ用データの集計 ---
+        journal_tags.update(tags)
+        for tag, score in per_tag_emotions.items():
+            fragment["heat"].setdefault(tag, []).append([coords[0], coords[1], score])
+    
+    # --- 軌跡と移動手段の描画ロジック ---
+    ### ★★★ 機能追加: 区間は1回の走査で組み立て済み、距離もまとめて計算済み ★★★
+    ### ★★★ 機能追加: 旅行記1件の軌跡を1本の MultiPolyline にまとめる（除外した区間の所でだけ切る） ★★★
+    fragment["route_paths"] = segments.paths(ROUTE_SIMPLIFY_TOLERANCE)
+    for _, point1, point2, move_event in segments.kept():
+        if move_event:
+            mid_lat = float(point1[0] + point2[0]) / 2
+            mid_lon = float(point1[1] + point2[1]) / 2
+            move_means = move_event.get('means', '不明')
             
-            gif_html = ""
-            if tags: # tags変数が存在することを確認
-                for tag in tags:
-                    if tag in TAG_TO_GIF:
-                        gif_path = TAG_TO_GIF[tag]
-                        base64_gif = get_image_as_base64(gif_path)
-                        if base64_gif:
-                            if not gif_html:
-                                gif_html += f"<hr style='margin: 3px 0;'>"
-                                gif_html += "<b>関連画像:</b><br>"
-                            gif_html += f'<img src="{base64_gif}" alt="{tag}" style="max-width: 95%; height: auto; margin-top: 5px; border-radius: 4px;">'
-            popup_html += gif_html
-
-            if 'reasoning' in stop_data and stop_data['reasoning']:
-                popup_html += f"<hr style='margin: 3px 0;'>"
-                popup_html += f"<b>推定理由:</b><br>{stop_data['reasoning']}<br>"
-            popup_html += f"<hr style='margin: 3px 0;'>"
-            popup_html += f"<b>体験:</b><br>{stop_data['experience']}"
-
-            folium.Marker(
-                location=coords, popup=folium.Popup(popup_html, max_width=350),
-                tooltip=f"{stop_data['place']} ({file_num})", icon=icon_to_use
-            ).add_to(route_group)
+            move_icon_key = assets.icon_key(TAG_TO_IMAGE[move_means], (30, 30)) if move_means in TAG_TO_IMAGE else None
             
-            # --- ヒートマップ用データの集計 ---
-            for tag, score in per_tag_emotions.items():
-                heatmap_data_by_tag[tag].append([coords[0], coords[1], score])
+            entry = move_entry(move_means, move_event.get('experience', '記述なし'))
+            if POPUP_MODE == "lazy":
+                fragment["popups"].append(entry)
+                move_popup = [str(file_num), len(fragment["popups"]) - 1]
+            else:
+                move_popup = move_popup_html(entry)
+
+            fragment["move_rows"].append([mid_lat, mid_lon, move_icon_key, f"移動: {entry['m']}", move_popup])
+
+    fragment["tags"] = sorted(journal_tags)
+    return fragment
+
+def journal_fragments(travels_data, assets, batch_size=RENDER_BATCH_SIZE):
+    """旅行記ごとのフラグメントを travels_data と同じ順に1件ずつ返す（描画キャッシュにあるものは再利用）"""
+    ### ★★★ 機能追加: 旅行記のデータと描画設定が変わっていなければ、前回の描画結果をそのまま使う ★★★
+    ### ★★★ 機能追加: 全件をまとめて持たないよう、batch_size 件ずつ作って返す ★★★
+    render_config = {
+        "popup_mode": POPUP_MODE, "max_distance_km": MAX_DISTANCE_KM, "route_simplify_tolerance": ROUTE_SIMPLIFY_TOLERANCE,
+        "tag_priority": TAG_PRIORITY, "tag_to_image": TAG_TO_IMAGE, "tag_to_gif": TAG_TO_GIF, "default_icon": DEFAULT_ICON_IMAGE,
+    }
+    cache = FragmentCache(RENDER_CACHE_DIR) if RENDER_CACHE_DIR else None
+    for start in range(0, len(travels_data), batch_size):
+        batch = travels_data[start:start + batch_size]
+        keys = [fragment_key(travel, render_config) for travel in batch]
+        fragments = [cache.get(travel["file_num"], key) if cache else None for travel, key in zip(batch, keys)]
+        stale = [i for i, fragment in enumerate(fragments) if fragment is None]
+        route_segments = dict(zip(stale, build_route_segments([batch[i].get('events', []) for i in stale], MAX_DISTANCE_KM)))
+        for i, travel in enumerate(batch):
+            fragment = fragments[i]
+            fragments[i] = None
+            if fragment:
+                AssetRecorder.replay(assets, fragment["assets"])
+            else:
+                recorder = AssetRecorder(assets)
+                fragment = render_journal(travel, route_segments.pop(i), recorder)
+                fragment["assets"] = recorder.used
+                if cache: cache.put(travel["file_num"], keys[i], fragment)
+            yield fragment
+    if cache: cache.report()
+
+def map_emotion_and_routes(travels_data, output_html):
+    """訪問地、移動手段、およびタグ別感情ヒートマップをレイヤー化して地図を生成する"""
+    if not travels_data: print("[ERROR] 地図に描画するデータがありません。"); return
+
+    ### ★★★ 機能追加: 画像は共有表に1回だけ出力し、マーカー・ポップアップからはキーで参照する ★★★
+    assets = AssetTable(mode=ASSET_MODE, output_html=output_html)
+    stops = [event for travel in travels_data for event in travel.get('events', []) if event.get('type') == 'stop' and 'latitude' in event]
+    start_coords = (stops[0]['latitude'], stops[0]['longitude']) if stops else (35.6812, 139.7671)
+
+    ### ★★★ 機能追加: 滞在地が多いときはマーカーを配列データでまとめて出力し、クラスタリング or canvas で描画する ★★★
+    stop_count = len(stops)
+    render_mode = choose_render_mode(RENDER_MODE, stop_count, RENDER_MARKER_THRESHOLD)
+    m = folium.Map(location=start_coords, zoom_start=10, prefer_canvas=(render_mode == "canvas"))
+    cluster = None
+    if render_mode == "cluster":
+        from folium.plugins import MarkerCluster, FeatureGroupSubGroup  # folium.plugins は読み込みが重いので使うときだけ
+        cluster = MarkerCluster(control=False, options={"chunkedLoading": True, "disableClusteringAtZoom": ICON_MIN_ZOOM})
+        m.add_child(cluster)
+    if render_mode != "markers":
+        print(f"🗺️ 滞在地 {stop_count}件を \"{render_mode}\" モードで描画します。")
+
+    m.add_child(assets)
+    popup_loader = None
+    if POPUP_MODE == "lazy":
+        popup_loader = LazyPopupLoader(output_html)
+        m.add_child(popup_loader)
+    
+    ### ★★★ 機能追加: "sharded" では中身をシャードに書き出し、索引HTMLには空のレイヤーと範囲だけを残す ★★★
+    ### ★★★ 機能追加: "panel" では旅行記ごとのレイヤーを作らず、パネルでチェックされたときにシャードから作る ★★★
+    panel = None
+    if LAYER_CONTROL_MODE == "panel" or (LAYER_CONTROL_MODE == "auto" and len(travels_data) > LAYER_PANEL_THRESHOLD):
+        panel = TravelLayerPanel(cluster=cluster, initial=LAYER_PANEL_INITIAL)
+    shard_loader = None
+    if MAP_OUTPUT_MODE == "sharded" or panel:
+        shard_loader = ShardLoader(output_html, marker_mode="canvas" if render_mode == "canvas" else "markers",
+                                   inline=(MAP_OUTPUT_MODE != "sharded"))
+        m.add_child(shard_loader)
+    shard_groups = {}  # シャードID -> (route_group, move_group)
+    toggle_layers = []  # 全表示・全非表示ボタンで切り替えるレイヤーのJS変数名
+
+    ### ★★★ 機能追加: 旅行記が多いときは骨組みを先に書き出し、旅行記ごとのレイヤーはできた順に追記して手放す ★★★
+    stream = STREAM_RENDER == "always" or (STREAM_RENDER == "auto" and len(travels_data) > STREAM_RENDER_THRESHOLD)
+    pending = [assets.pending_script] + ([shard_loader.pending_inline_script] if shard_loader else [])
+    writer = MapWriter(m, output_html, stream=stream, pending=pending)
+    writer.start()
+    
+    emotion_grid = EmotionGrid(levels=HEATMAP_GRID_LEVELS)
+    heatmap_data_by_tag = defaultdict(list)  # "points" のときだけ使う
+
+    for travel, fragment in zip(travels_data, journal_fragments(travels_data, assets)):
+        file_num, color = travel["file_num"], travel["color"]
+        shard_id = (travel.get("region_hint") or "不明") if SHARD_BY == "prefecture" else file_num
+        stop_rows, move_rows, route_paths = fragment["stop_rows"], fragment["move_rows"], fragment["route_paths"]
         
-        # --- 軌跡と移動手段の描画ロジック ---
-        for i in range(len(stop_events) - 1):
-            start_stop = stop_events[i]
-            end_stop = stop_events[i+1]
-            
-            point1 = (start_stop['latitude'], start_stop['longitude'])
-            point2 = (end_stop['latitude'], end_stop['longitude'])
+        if panel:
+            route_group = move_group = None
+        elif shard_loader and shard_id in shard_groups:
+            route_group, move_group = shard_groups[shard_id]
+        else:
+            group_label = shard_id if shard_loader else file_num
+            if cluster:
+                route_group = FeatureGroupSubGroup(cluster, name=f"旅行記ルート: {group_label}", show=True)
+                move_group = FeatureGroupSubGroup(cluster, name=f"移動手段: {group_label}", show=True)
+            else:
+                route_group = folium.FeatureGroup(name=f"旅行記ルート: {group_label}", show=True)
+                move_group = folium.FeatureGroup(name=f"移動手段: {group_label}", show=True)
+            toggle_layers += [route_group.get_name(), move_group.get_name()]
+            if shard_loader:
+                # シャードの範囲は旅行記を足すたびに広がるので、枠のレイヤーは最後に書き出す
+                route_group.add_child(ShardLayer(shard_loader, shard_id, "route"))
+                move_group.add_child(ShardLayer(shard_loader, shard_id, "move"))
+                shard_groups[shard_id] = (route_group, move_group)
+                route_group.add_to(m)
+                move_group.add_to(m)
 
-            dist = distance(point1, point2).km
-            
-            if dist <= MAX_DISTANCE_KM:
-                folium.PolyLine([point1, point2], color=color, weight=5, opacity=0.7).add_to(route_group)
-
-                start_index_in_events = -1
-                try: start_index_in_events = events.index(start_stop)
-                except ValueError: continue
-                
-                if start_index_in_events != -1:
-                    move_event = next((e for e in events[start_index_in_events+1:] if e.get('type') == 'move'), None)
-                    if move_event:
-                        mid_lat = (point1[0] + point2[0]) / 2
-                        mid_lon = (point1[1] + point2[1]) / 2
-                        move_means = move_event.get('means', '不明')
-                        
-                        move_icon = None
-                        if move_means in TAG_TO_IMAGE and os.path.exists(TAG_TO_IMAGE[move_means]):
-                            move_icon = folium.features.CustomIcon(TAG_TO_IMAGE[move_means], icon_size=(30, 30))
-                        else:
-                            move_icon = folium.Icon(color='black', icon='arrow-right', prefix='fa')
-                        
-                        move_popup = f"<b>移動: {move_means}</b><br><hr>"
-                        move_popup += move_event.get('experience', '記述なし')
-
-                        folium.Marker(
-                            location=[mid_lat, mid_lon],
-                            popup=move_popup,
-                            tooltip=f"移動: {move_means}",
-                            icon=move_icon
-                        ).add_to(move_group)
-
-        route_group.add_to(m)
-        move_group.add_to(m)
+        for tag, data_points in fragment["heat"].items():
+            emotion_grid.add_points(tag, data_points)
+            if HEATMAP_MODE != "grid": heatmap_data_by_tag[tag].extend(data_points)
+        if popup_loader:
+            popup_loader.set_entries(file_num, fragment["popups"])
+            popup_loader.flush(file_num)
+
+        if shard_loader:
+            journal_bounds = shard_loader.add_journal(shard_id, file_num, color, route_paths, stop_rows, move_rows)
+            if SHARD_BY != "prefecture": shard_loader.flush(shard_id)
+            if panel: panel.add_journal(file_num, shard_file_name(shard_id), travel.get("region_hint"), fragment["tags"], journal_bounds)
+            writer.add_layers()
+            continue
+
+        if render_mode != "markers":
+            if stop_rows: route_group.add_child(FastMarkers(stop_rows, mode=render_mode, color=color, icon_min_zoom=ICON_MIN_ZOOM))
+            if move_rows: move_group.add_child(FastMarkers(move_rows, mode=render_mode, color="black", radius=3, icon_min_zoom=ICON_MIN_ZOOM))
+        else:
+            for lat, lon, icon_key, tooltip, popup in stop_rows:
+                marker = folium.Marker(
+                    location=(lat, lon), popup=None if popup_loader else folium.Popup(popup, max_width=350), tooltip=tooltip,
+                    icon=None if icon_key else folium.Icon(color="gray", icon="question-sign")
+                )
+                if icon_key: marker.add_child(SharedIcon(icon_key))
+                if popup_loader: marker.add_child(LazyPopup(*popup))
+                marker.add_to(route_group)
+            for lat, lon, icon_key, tooltip, popup in move_rows:
+                move_marker = folium.Marker(
+                    location=[lat, lon],
+                    popup=None if popup_loader else popup,
+                    tooltip=tooltip,
+                    icon=None if icon_key else folium.Icon(color='black', icon='arrow-right', prefix='fa')
+                )
+                if icon_key: move_marker.add_child(SharedIcon(icon_key))
+                if popup_loader: move_marker.add_child(LazyPopup(*popup))
+                move_marker.add_to(move_group)
+        if route_paths:
+            folium.PolyLine(route_paths, color=color, weight=5, opacity=0.7).add_to(route_group)
+        writer.add_layers(route_group, move_group)
+
+    if shard_loader: shard_loader.flush_all()
 
     # --- タグごとのヒートマップレイヤーを生成 ---
-    for tag, data_points in heatmap_data_by_tag.items():
-        if data_points:
-            heatmap_layer = folium.FeatureGroup(name=f"感情ヒートマップ: {tag}", show=False)
-            HeatMap(data_points, radius=20).add_to(heatmap_layer)
-            heatmap_layer.add_to(m)
-
-    folium.LayerControl().add_to(m)
-    m.add_child(LayerToggleButtons())
-    
-    m.save(output_html)
+    ### ★★★ 機能追加: "grid" ではタグごとにセル集計したものを描画する（集計結果はCSV/Parquetにも書き出せる） ★★★
+    for tag in emotion_grid.tags():
+        heatmap_layer = folium.FeatureGroup(name=f"感情ヒートマップ: {tag}", show=False)
+        if HEATMAP_MODE == "grid":
+            heatmap_layer.add_child(emotion_grid.layer(tag))
+        else:
+            from folium.plugins import HeatMap
+            HeatMap(heatmap_data_by_tag[tag], radius=20).add_to(heatmap_layer)
+        heatmap_layer.add_to(m)
+    if HEATMAP_EXPORT_PATH:
+        emotion_grid.export(HEATMAP_EXPORT_PATH)
+
+    layer_control = folium.LayerControl()
+    elements = [layer_control] + ([panel] if panel else [])
+    if toggle_layers: elements.append(LayerToggleButtons(layer_control, toggle_layers))
+    writer.finish(*elements, layer_control=layer_control)
     print(f"\n🌐 タグ別感情分析付きの地図を {output_html} に保存しました。")
 
-def main():
-    """メイン処理"""
-    if not os.path.exists(CACHE_DIR): os.makedirs(CACHE_DIR)
-    input_file_path = input('ファイル番号が記載された.txtファイルのパスを入力してください: ')
-    try:
-        with open(input_file_path, 'r', encoding='utf-8') as f: content = f.read()
-        file_nums = [num.strip() for num in content.strip().split(',') if num.strip()]
-    except Exception as e: print(f"[ERROR] 入力ファイルの読み込みに失敗: {e}"); return
+def place_stops(travel):
+    """地名のある滞在イベント（ジオコーディングとタグ付けの対象）"""
+    return [e for e in travel["events"] if e.get('type') == 'stop' and e.get('place')]
+
+### ★★★ 機能追加: ステージごとのチェックポイントのキーに入れる設定（プロンプトを含む関数のソースも含める） ★★★
+def extract_config():
+    return [MODEL, code_fingerprint(get_visit_hint, extract_events)]
 
-    all_travels_data = []
+def geocode_config():
+    # 環境変数で差し替えるAPIのURL（スタブ・ミラー）は入れない。URLを変えただけで完了済みの旅行記をやり直さないようにする
+    return [GPT_COORDS_POLICY, GEOCODE_HEDGED, GEOCODE_PRECEDENCE, GAZETTEER_PATH, PREFECTURE_GEOJSON_PATH,
+            code_fingerprint(geocode_place_group)]
+
+def tag_config():
+    return [MODEL, ACTION_TAGS, EMOTION_BATCH_MODE, EMOTION_BATCH_TOKEN_BUDGET,
+            code_fingerprint(analyze_stop_emotions_by_tag, analyze_stops_emotions_batch, _analyze_emotion_chunk, _is_valid_emotions)]
+
+def pipeline_fingerprint():
+    """extract / geocode / tag の設定をまとめたハッシュ（マニフェストの done がいまの設定で作られたかの判定に使う）"""
+    return stage_key(extract_config(), geocode_config(), tag_config())
+
+def geocode_key(travel):
+    stops = [[e['place'], e.get('latitude'), e.get('longitude')] for e in place_stops(travel)]
+    return stage_key("geocode", travel.get("region_hint"), stops, geocode_config())
+
+def tag_key(travel):
+    return stage_key("tag", [e.get('experience', '') for e in place_stops(travel)], tag_config())
+
+def seed_checkpoints(file_num, extract_key=None):
+    """
+    チェックポイントが無く、以前の完成データ（results_cache）だけがある旅行記は、
+    その内容を各ステージのチェックポイントとして登録し、抽出ステージの結果を返す（無ければ None）。
+    extract_key が None（元の旅行記が無くキーを作れない）ときは、抽出ステージのチェックポイントは登録しない
+    """
     try:
-        for i, file_num in enumerate(file_nums):
-            cache_path = os.path.join(CACHE_DIR, f"{file_num}.json")
-            if os.path.exists(cache_path):
-                print(f"\n✅ [{file_num}] のキャッシュを読み込みます。")
-                with open(cache_path, 'r', encoding='utf-8') as f:
-                    all_travels_data.append(json.load(f))
-                continue
+        legacy = load_cached_journal(file_num)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    extracted = {
+        "region_hint": legacy.get("region_hint"),
+        "events": [{k: v for k, v in e.items() if k != 'per_tag_emotions'} for e in legacy.get("events", [])],
+    }
+    travel = {"file_num": file_num, **json.loads(json.dumps(extracted))}
+    stops = place_stops(legacy)
+    if extract_key is not None:
+        checkpoints.put("extract", file_num, extract_key, extracted, seeded=True)
+    checkpoints.put("geocode", file_num, geocode_key(travel), [[e['latitude'], e['longitude']] if 'latitude' in e else None for e in stops], seeded=True)
+    checkpoints.put("tag", file_num, tag_key(travel), [e.get('per_tag_emotions', {}) for e in stops], seeded=True)
+    return extracted
+
+def extract_journal(i, file_num, run=True, refresh=False):
+    """
+    抽出ステージ: 地域推定とイベント抽出を行い、旅行記データ（座標はGPTの推定のまま）を返す。
+    チェックポイントがあれば再利用し、run=False ならチェックポイントだけを使う。処理できなければ None。
+    元の旅行記ファイルが無いときは、最後の抽出結果か以前の完成データを使う（抽出はやり直せない）
+    """
+    path_journal = f'{directory}{file_num}.tra.json'
+    if not os.path.exists(path_journal):
+        extracted = checkpoints.latest("extract", file_num) or seed_checkpoints(file_num)
+        if extracted is None: print(f"[WARNING] ファイルが見つかりません: {path_journal}"); return None
+        print(f"\n✅ [{file_num}] の元のファイルが見つからないため、以前の抽出結果を使います。")
+    else:
+        with open(path_journal, "rb") as f: raw = f.read()
+        key = stage_key("extract", hashlib.sha256(raw).hexdigest(), extract_config())
 
+        extracted = None if refresh else checkpoints.get("extract", file_num, key)
+        if extracted is None and not refresh and not checkpoints.exists("extract", file_num):
+            extracted = seed_checkpoints(file_num, key)
+        if extracted is not None:
+            print(f"\n✅ [{file_num}] の抽出結果を読み込みます。")
+        elif not run:
+            print(f"[WARNING] [{file_num}] は抽出ステージが済んでいません。"); return None
+        else:
             print(f"\n{'='*20} [{file_num}] の処理を開始 {'='*20}")
-            path_journal = f'{directory}{file_num}.tra.json'
-            if not os.path.exists(path_journal): print(f"[WARNING] ファイルが見つかりません: {path_journal}"); continue
-            
-            with open(path_journal, "r", encoding="utf-8") as f: travel_data = json.load(f)
+            travel_data = json.loads(raw.decode("utf-8"))
             texts = [entry['text'] for entry in travel_data if entry.get('text')]
             full_text = " ".join(sum(texts, []))
-            if not full_text.strip(): print(f"[WARNING] テキストデータがありません。"); continue
-            
+            if not full_text.strip(): print(f"[WARNING] テキストデータがありません。"); return None
+
+            start_llm_engine()
             region_hint = get_visit_hint(full_text)
             events = extract_events(full_text, region_hint)
-            if not events: print(f"[WARNING] イベントを抽出できませんでした。"); continue
+            if not events: print(f"[WARNING] イベントを抽出できませんでした。"); return None
+            extracted = {"region_hint": region_hint, "events": events}
+            checkpoints.put("extract", file_num, key, extracted)
 
-            stop_events_to_process = [e for e in events if e.get('type') == 'stop']
-            
-            for stop_event in stop_events_to_process:
-                place_name = stop_event.get('place')
-                if not place_name: continue
-
-                coords = geocode_place(place_name, region_hint)
-                if not coords:
-                    coords = (stop_event.get('latitude', 0.0), stop_event.get('longitude', 0.0))
-                    if coords[0] == 0.0 and coords[1] == 0.0: coords = None
-                if not coords:
-                    coords = geocode_gsi(place_name)
-                
-                if coords:
-                    stop_event['latitude'] = coords[0]
-                    stop_event['longitude'] = coords[1]
-                else:
-                    print(f"[!] ジオコーディング失敗: {place_name}")
-                    if 'latitude' in stop_event: del stop_event['latitude']
-
-                # タグ別感情分析
-                experience_text = stop_event.get('experience', '')
-                # 新しい分析関数を呼び出す
-                per_tag_emotions = analyze_stop_emotions_by_tag(experience_text, ACTION_TAGS)
-                stop_event['per_tag_emotions'] = per_tag_emotions
-
-            final_travel_data = {
-                "file_num": file_num, "events": events,
-                "color": COLORS[i % len(COLORS)], "region_hint": region_hint 
-            }
-            all_travels_data.append(final_travel_data)
+    return {
+        "file_num": file_num, "events": extracted["events"],
+        "color": COLORS[i % len(COLORS)], "region_hint": extracted["region_hint"]
+    }
+
+def geocode_journals(travels, run=True, refresh=False):
+    """
+    ジオコーディングステージ: 旅行記ごとに、地名のある滞在地の座標 [[緯度, 経度] or None, ...] を返す。
+    チェックポイントに無い旅行記だけをまとめて名寄せ・ジオコーディングする（run=False なら None のまま）
+    """
+    keys = [geocode_key(travel) for travel in travels]
+    results = [None if refresh else checkpoints.get("geocode", travel["file_num"], key) for travel, key in zip(travels, keys)]
+    stale = [i for i, result in enumerate(results) if result is None]
+    if not run or not stale:
+        return results
+    work = [json.loads(json.dumps(travels[i])) for i in stale]  # 抽出結果は書き換えない
+    start_geocoder()
+    geocode_unique_places(work)
+    for i, travel in zip(stale, work):
+        results[i] = [[e['latitude'], e['longitude']] if 'latitude' in e else None for e in place_stops(travel)]
+        checkpoints.put("geocode", travel["file_num"], keys[i], results[i])
+    return results
 
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(final_travel_data, f, ensure_ascii=False, indent=4)
-            print(f"✅ [{file_num}] の結果をキャッシュに保存しました。")
+def tag_journal(travel, run=True, refresh=False):
+    """タグ付けステージ: 地名のある滞在地ごとのタグ別感情スコアのリストを返す（run=False でチェックポイントが無ければ None）"""
+    key = tag_key(travel)
+    results = None if refresh else checkpoints.get("tag", travel["file_num"], key)
+    if results is not None or not run:
+        return results
 
-    except openai.error.AuthenticationError as e:
-        print(f"\n[FATAL ERROR] OpenAI認証エラー。処理を中断します。: {e}")
-    except Exception as e:
-        print(f"\n[FATAL ERROR] 予期せぬエラーで処理を中断します: {e}")
+    ### ★★★ 機能追加: 滞在地ごとのタグ別感情分析（一括 or 並列） ★★★
+    experience_texts = [e.get('experience', '') for e in place_stops(travel)]
+    start_llm_engine()
+    if EMOTION_BATCH_MODE:
+        results = analyze_stops_emotions_batch(experience_texts, ACTION_TAGS)
+    else:
+        results = llm_engine.map(lambda text: analyze_stop_emotions_by_tag(text, ACTION_TAGS), experience_texts)
+    checkpoints.put("tag", travel["file_num"], key, results)
+    return results
 
-    if all_travels_data:
-        if len(all_travels_data) >= 4:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_filename = f"{base_name}{timestamp}{extension}"
+def finalize_journal(travel, coords, emotions):
+    """ジオコーディングとタグ付けの結果を旅行記データにまとめ、完成データとしてキャッシュに保存する"""
+    for stop_event, event_coords, per_tag_emotions in zip(place_stops(travel), coords, emotions):
+        if event_coords:
+            stop_event['latitude'], stop_event['longitude'] = event_coords
         else:
-            processed_file_nums = [str(t['file_num']) for t in all_travels_data]
-            output_filename = f"{base_name}{'_'.join(processed_file_nums)}{extension}"
-            
-        map_emotion_and_routes(all_travels_data, output_filename)
+            stop_event.pop('latitude', None)
+        stop_event['per_tag_emotions'] = per_tag_emotions
+
+    cache_path = os.path.join(CACHE_DIR, f"{travel['file_num']}.json")
+    write_json_atomic(cache_path, travel, ensure_ascii=False, indent=4)
+    print(f"✅ [{travel['file_num']}] の結果をキャッシュに保存しました。")
+    return travel
+
+def missing_stages(coords, emotions):
+    return [stage for stage, result in (("geocode", coords), ("tag", emotions)) if result is None]
+
+def run_parallel(pool, fn, items, labels, manifest=None):
+    """
+    items に fn を並列適用して入力順の結果を返す。失敗した要素は None（認証エラーだけは残りを取り消して送出）。
+    manifest を渡すと、失敗した要素を failed として記録する
+    """
+    futures = [pool.submit(fn, item) for item in items]
+    results = []
+    for future, label in zip(futures, labels):
+        try:
+            results.append(future.result())
+        except authentication_errors():
+            for f in futures: f.cancel()
+            raise
+        except Exception as e:
+            print(f"\n[ERROR] [{label}] の処理中にエラーが発生しました: {e}")
+            if manifest: manifest.record(label, "failed", error=str(e))
+            results.append(None)
+    return results
+
+def init_journal_worker(settings, processes):
+    """
+    ワーカープロセスの初期化。親プロセスの設定を反映し、APIのレート予算を processes 等分したものを使う
+    （キャッシュは SQLite と results_cache/ を全プロセスで共有する）
+    """
+    global api_share, checkpoints
+    globals().update(settings)
+    api_share = processes
+    checkpoints = StageCheckpoints(PIPELINE_CACHE_DIR)
+
+def process_journal_in_worker(item):
+    """
+    旅行記1件を stages のステージまで処理し、(完成データ or None, 状態, 秒数, 足りないステージ, チェックポイントの集計) を返す。
+    状態は done / skipped / partial（選ばなかったステージのチェックポイントが無い）
+    """
+    color_index, file_num, stages, refresh = item
+    start = time.perf_counter()
+    travel, status, missing = None, "skipped", []
+    journal = extract_journal(color_index, file_num, "extract" in stages, "extract" in refresh)
+    if journal is not None:
+        coords = geocode_journals([journal], "geocode" in stages, "geocode" in refresh)[0]
+        emotions = tag_journal(journal, "tag" in stages, "tag" in refresh)
+        missing = missing_stages(coords, emotions)
+        if missing:
+            status = "partial"
+        else:
+            travel, status = finalize_journal(journal, coords, emotions), "done"
+    return travel, status, time.perf_counter() - start, missing, checkpoints.take_stats()
+
+def run_in_processes(todo, color_index, manifest, results, processes, stages, refresh):
+    """
+    ### ★★★ 機能追加: 旅行記を共有キューから1件ずつワーカープロセスに渡して並列に処理する ★★★
+    結果は完了順に受け取り、results の元の位置に入れる（色は color_index で決まるので完了順に依存しない）
+    """
+    settings = {name: value for name, value in globals().items() if name.isupper() or name == "directory"}
+    fingerprint = pipeline_fingerprint()
+    context = multiprocessing.get_context("spawn")  # SQLite の接続を fork で引き継がないようにする
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                             initializer=init_journal_worker, initargs=(settings, processes)) as pool:
+        futures = {pool.submit(process_journal_in_worker, (color_index[file_num], file_num, stages, refresh)): (i, file_num)
+                   for i, file_num in todo}
+        for future in as_completed(futures):
+            i, file_num = futures[future]
+            try:
+                travel, status, seconds, missing, stage_stats = future.result()
+            except authentication_errors() as e:
+                print(f"\n[FATAL ERROR] OpenAI認証エラー。処理を中断します。: {e}")
+                for f in futures: f.cancel()
+                break
+            except Exception as e:
+                print(f"\n[ERROR] [{file_num}] の処理中にエラーが発生しました: {e}")
+                manifest.record(file_num, "failed", error=str(e))
+                continue
+            checkpoints.merge_stats(stage_stats)
+            if status == "skipped" and manifest.status(file_num) == "done":
+                continue  # 以前の done は skipped で上書きしない（以前の完成データは main で読み込む）
+            extra = {"missing": missing} if missing else {"pipeline": fingerprint} if status == "done" else {}
+            manifest.record(file_num, status, seconds=round(seconds, 3), **extra)
+            results[i] = travel
+
+def load_cached_journal(file_num):
+    with open(os.path.join(CACHE_DIR, f"{file_num}.json"), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def default_output_filename(travels_data):
+    """4件以上なら日時、それ未満なら旅行記番号を並べたファイル名にする"""
+    if len(travels_data) >= 4:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        return f"{base_name}{timestamp}{extension}"
+    processed_file_nums = [str(t['file_num']) for t in travels_data]
+    return f"{base_name}{'_'.join(processed_file_nums)}{extension}"
+
+def main(argv=None):
+    """メイン処理"""
+    if not os.path.exists(CACHE_DIR): os.makedirs(CACHE_DIR)
+    ### ★★★ 機能追加: ID・範囲・glob と --shard i/N を引数で受け取り、旅行記ごとの結果を実行マニフェストに記録する ★★★
+    args = parse_args(argv, description="旅行記からタグ別感情分析付きの地図を生成する", default_manifest=RUN_MANIFEST_PATH,
+                      processes=True, pipeline=True)
+    try:
+        all_file_nums = resolve_ids(args.ids, directory) if args.ids else read_id_file_interactively()
+    except Exception as e: print(f"[ERROR] 入力ファイルの読み込みに失敗: {e}"); return
+    # 色は shard で分ける前の並び順で決める（どの台・どの順で処理しても同じ色になる）
+    color_index = {file_num: i for i, file_num in enumerate(all_file_nums)}
+    file_nums = select_shard(all_file_nums, args.shard)
+    if not file_nums: print("[ERROR] 処理する旅行記IDがありません。"); return
+    manifest = RunManifest(args.manifest)
+
+    ### ★★★ 機能追加: --stages で選んだステージだけを実行し、それ以外はチェックポイントだけを使う ★★★
+    stages, refresh = args.stages, args.refresh
+    fingerprint = pipeline_fingerprint()
+
+    # マニフェストでいまの設定のまま完了済みの旅行記は、キャッシュの有無を調べずにそのまま読み込む
+    results = [None] * len(file_nums)
+    completed = manifest.completed(pipeline=fingerprint) if not refresh else set()
+    todo = []
+    for i, file_num in enumerate(file_nums):
+        if file_num in completed:
+            try:
+                results[i] = load_cached_journal(file_num)
+                continue
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+        elif manifest.status(file_num) == "skipped" and not args.retry_skipped:
+            continue
+        todo.append((i, file_num))
+    print(f"INFO: {len(file_nums)}件中 {len(file_nums) - len(todo)}件 はマニフェストの記録により処理を省略します。")
+    queued = list(todo)
+
+    def extract(item):
+        i, file_num = item
+        with manifest.timed(file_num): return extract_journal(color_index[file_num], file_num, "extract" in stages, "extract" in refresh)
+
+    def tag(travel):
+        with manifest.timed(travel["file_num"]): return tag_journal(travel, "tag" in stages, "tag" in refresh)
+
+    processes = JOURNAL_PROCESSES if args.processes is None else args.processes
+    if processes > 0 and todo:
+        print(f"INFO: {len(todo)}件を {processes}プロセスで処理します。")
+        run_in_processes(todo, color_index, manifest, results, processes, stages, refresh)
+        todo = []
+
+    ### ★★★ 機能追加: バッチごとに 抽出(並列) → 地名の名寄せとジオコーディング → 感情分析(並列) の順に処理する ★★★
+    with ThreadPoolExecutor(max_workers=JOURNAL_WORKERS) as pool:
+        try:
+            for start in range(0, len(todo), JOURNAL_BATCH_SIZE):
+                batch = todo[start:start + JOURNAL_BATCH_SIZE]
+                extracted = run_parallel(pool, extract, batch, [file_num for _, file_num in batch], manifest)
+                pending = []
+                for (i, file_num), travel in zip(batch, extracted):
+                    if travel is None:
+                        # 以前の done は skipped で上書きしない（以前の完成データは下で読み込む）
+                        if not manifest.recorded(file_num) and manifest.status(file_num) != "done":
+                            manifest.record(file_num, "skipped")
+                        continue
+                    pending.append((i, travel))
+                if not pending: continue
+
+                travels = [travel for _, travel in pending]
+                with manifest.timed(*[travel["file_num"] for travel in travels]):
+                    geocoded = geocode_journals(travels, "geocode" in stages, "geocode" in refresh)
+                tagged = run_parallel(pool, tag, travels, [travel["file_num"] for travel in travels], manifest)
+                for (i, travel), coords, emotions in zip(pending, geocoded, tagged):
+                    if manifest.recorded(travel["file_num"]) == "failed": continue
+                    missing = missing_stages(coords, emotions)
+                    if missing:
+                        manifest.record(travel["file_num"], "partial", missing=missing)
+                        continue
+                    results[i] = finalize_journal(travel, coords, emotions)
+                    manifest.record(travel["file_num"], "done", pipeline=fingerprint)
+        except authentication_errors() as e:
+            print(f"\n[FATAL ERROR] OpenAI認証エラー。処理を中断します。: {e}")
+
+    # 今回完成しなかった旅行記も、以前の完成データがあれば地図に使う（やり直しで結果が消えないようにする）
+    for i, file_num in queued:
+        if results[i] is not None: continue
+        try:
+            results[i] = load_cached_journal(file_num)
+        except (FileNotFoundError, json.JSONDecodeError):
+            continue
+        print(f"INFO: [{file_num}] は以前の完成データを地図に使います。")
+    all_travels_data = [r for r in results if r]
+    for client in (llm_engine, llm_cache, geocoder, geocode_cache):
+        if client is not None: print(client.report())
+    print(checkpoints.report())
+    print(manifest.report())
+
+    if args.no_map or "render" not in stages: return
+    if all_travels_data:
+        map_emotion_and_routes(all_travels_data, args.output or default_output_filename(all_travels_data))
     else:
         print("\n地図を生成するための有効なデータがありませんでした。")
 